@@ -4,9 +4,10 @@ import os
 import uuid
 from PyQt5.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton,QDialog,QSpinBox, QPushButton,
                              QLabel, QTextEdit, QListWidget, QLineEdit, QFileDialog, QMessageBox,
-                             QInputDialog)
+                             QInputDialog, QCheckBox, QProgressBar)
 from PyQt5.QtCore import Qt
 from LibraryHandling import LibraryLoadingStrategy, LibraryReformat, LibrarySaveStrategy
+from GUI_worker import TaskWorker, LogBuffer
 
 
 class LibraryReformatterGUI(QWidget):
@@ -21,7 +22,7 @@ class LibraryReformatterGUI(QWidget):
         layout = QVBoxLayout()
         
         # Input Files Label and List
-        self.input_label = QLabel("Input Files (.msp/.mgf):")
+        self.input_label = QLabel("Input Files (.msp/.msp.gz/.mgf):")
         layout.addWidget(self.input_label)
         self.listWidget = QListWidget()
         layout.addWidget(self.listWidget)
@@ -43,6 +44,11 @@ class LibraryReformatterGUI(QWidget):
         self.topnum_spinBox.setMaximum(15)
         self.topnum_spinBox.setValue(1)  # Default value
         layout.addWidget(self.topnum_spinBox)
+
+        # Compiled library output, loaded memory-mapped by the identification
+        self.compiled_checkbox = QCheckBox("Also save a compiled library (.dilib) for fast loading")
+        self.compiled_checkbox.setChecked(True)
+        layout.addWidget(self.compiled_checkbox)
          
         # Log Area
         self.log_label = QLabel("Log:")
@@ -50,6 +56,10 @@ class LibraryReformatterGUI(QWidget):
         self.log_area = QTextEdit()
         self.log_area.setReadOnly(True)
         layout.addWidget(self.log_area)
+        self.log_buffer = LogBuffer(self.log_area)
+        
+        self.progress_bar = QProgressBar()
+        layout.addWidget(self.progress_bar)
         
         # Buttons
         button_layout = QHBoxLayout()
@@ -63,6 +73,10 @@ class LibraryReformatterGUI(QWidget):
         self.process_files_button = QPushButton('Process and Reformat Files')
         self.process_files_button.clicked.connect(self.process_files)
         button_layout.addWidget(self.process_files_button)
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.clicked.connect(self.cancel_processing)
+        self.cancel_button.setEnabled(False)
+        button_layout.addWidget(self.cancel_button)
         
         layout.addLayout(button_layout)
         
@@ -70,12 +84,13 @@ class LibraryReformatterGUI(QWidget):
         
         self.filepaths = []
         self.output_directory = ''
+        self.worker = None
 
         
     def open_files(self):
         options = QFileDialog.Options()
         files, _ = QFileDialog.getOpenFileNames(self, "Open Mass Spectra Files", "",
-                                                "Supported Files (*.mgf *.msp);;All Files (*)", options=options)
+                                                "Supported Files (*.mgf *.msp *.msp.gz);;All Files (*)", options=options)
         if files:
             self.filepaths = files
             self.listWidget.clear()
@@ -92,9 +107,12 @@ class LibraryReformatterGUI(QWidget):
             QMessageBox.warning(self, "Directory Selection", "No directory was selected.")
     
     def log(self, message):
-        self.log_area.append(message)
+        # called from the worker thread as well, the buffer appends to the log area on the GUI thread
+        self.log_buffer.append(message)
         
     def process_files(self):
+        if self.worker is not None and self.worker.isRunning():
+            return
         if not self.filepaths:
             QMessageBox.warning(self, "Error", "Please select one or more input files.")
             return
@@ -103,28 +121,70 @@ class LibraryReformatterGUI(QWidget):
             return
 
         topnum = self.topnum_spinBox.value()
+        filepaths = list(self.filepaths)
+        output_directory = self.output_directory
+        save_compiled = self.compiled_checkbox.isChecked()
         self.log(f"Starting file processing with top {topnum} peaks in library mass spectra...")
-        # 这里添加文件处理逻辑
         
-        try:
+        def reformat_files(worker):
             self.log("Combining libraries...")
-            combined_library = LibraryLoadingStrategy.combine_libraries(self.filepaths)
+            combined_library = []
+            for done, file_path in enumerate(filepaths, 1):
+                worker.check_cancelled()
+                combined_library.extend(LibraryLoadingStrategy(file_path).load_library())
+                worker.report_progress(done, len(filepaths))
             self.log("Libraries combined successfully.")
 
             self.log(f"Reformatting library for top {topnum} peaks in library mass spectra...")
             reformat = LibraryReformat(topnum)
-            reformatted_library = reformat.reformat_library(combined_library)
+            reformatted_library = []
+            chunk = 10000
+            for start in range(0, len(combined_library), chunk):
+                worker.check_cancelled()
+                reformatted_library.extend(reformat.reformat_library(combined_library[start:start + chunk]))
+                worker.report_progress(min(start + chunk, len(combined_library)), len(combined_library))
             self.log("Library reformatted successfully.")
 
+            worker.check_cancelled()
             random_filename = f"reformatted_library_{uuid.uuid4()}.msp"
-            output_file_path = os.path.join(self.output_directory, random_filename)
+            output_file_path = os.path.join(output_directory, random_filename)
             self.log("Saving reformatted library...")
             LibrarySaveStrategy.save_library_to_msp_class(reformatted_library, output_file_path)
             self.log(f"Library saved successfully to {output_file_path}.")
 
-        except Exception as e:
-            QMessageBox.critical(self, "Error", f"An error occurred: {str(e)}")
-            self.log(f"An error occurred: {str(e)}")
+            if save_compiled:
+                compiled_file_path = os.path.splitext(output_file_path)[0] + '.dilib'
+                LibrarySaveStrategy.save_library_to_compiled(reformatted_library, compiled_file_path)
+                self.log(f"Compiled library saved successfully to {compiled_file_path}.")
+
+        self.progress_bar.setValue(0)
+        self.worker = TaskWorker(reformat_files, self)
+        self.worker.progress.connect(self.show_progress)
+        self.worker.failed.connect(self.show_error)
+        self.worker.cancelled.connect(lambda: self.log("Processing cancelled."))
+        self.worker.finished.connect(self.reset_buttons)
+        self.process_files_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self.worker.start()
+
+    def cancel_processing(self):
+        if self.worker is not None and self.worker.isRunning():
+            self.log("Cancelling...")
+            self.worker.cancel()
+            self.cancel_button.setEnabled(False)
+
+    def show_progress(self, done, total):
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(done)
+
+    def show_error(self, error):
+        message = error.strip().splitlines()[-1]
+        QMessageBox.critical(self, "Error", f"An error occurred: {message}")
+        self.log(f"An error occurred: {error}")
+
+    def reset_buttons(self):
+        self.process_files_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
@@ -1,8 +1,10 @@
 import sys
-from PyQt5.QtWidgets import QApplication, QWidget, QPushButton, QVBoxLayout, QFileDialog, QLabel, QStatusBar, QFormLayout, QTextEdit
+from PyQt5.QtWidgets import (QApplication, QWidget, QPushButton, QVBoxLayout, QFileDialog, QLabel, QStatusBar, QFormLayout, QTextEdit, QProgressBar,
+                             QHBoxLayout, QDoubleSpinBox, QComboBox, QCheckBox)
 import os
 import pandas as pd
 from meta_quan_merge import Meta_df_Merge
+from GUI_worker import TaskWorker, LogBuffer
 
 
 
@@ -32,14 +34,43 @@ class Meta_Quantification_GUI(QWidget):
         self.output_folder_label = QLabel('Output Folder: Not selected', self)
         layout.addWidget(self.output_folder_label)
 
+        # Alignment of the precursors across samples
+        self.mz_tolerance_spin = QDoubleSpinBox(self)
+        self.mz_tolerance_spin.setDecimals(4)
+        self.mz_tolerance_spin.setMaximum(1000)
+        self.mz_tolerance_spin.setValue(10)
+        self.mz_unit_combo = QComboBox(self)
+        self.mz_unit_combo.addItems(['ppm', 'Da'])
+        self.cv_tolerance_spin = QDoubleSpinBox(self)
+        self.cv_tolerance_spin.setMaximum(100)
+        self.cv_tolerance_spin.setValue(0)
+        self.rounded_checkbox = QCheckBox('Round precursors to 2 decimals instead', self)
+        tolerance_layout = QHBoxLayout()
+        tolerance_layout.addWidget(self.mz_tolerance_spin)
+        tolerance_layout.addWidget(self.mz_unit_combo)
+        self.formLayout.addRow('Precursor Tolerance:', tolerance_layout)
+        self.formLayout.addRow('CV Tolerance, V (0 = exact):', self.cv_tolerance_spin)
+        self.formLayout.addRow(self.rounded_checkbox)
+        layout.addLayout(self.formLayout)
+
         self.btn_process_files = QPushButton('Process Files in Folder', self)
         self.btn_process_files.clicked.connect(self.process_files)
         layout.addWidget(self.btn_process_files)
 
+        self.btn_cancel = QPushButton('Cancel', self)
+        self.btn_cancel.clicked.connect(self.cancel_processing)
+        self.btn_cancel.setEnabled(False)
+        layout.addWidget(self.btn_cancel)
+
+        self.progress_bar = QProgressBar(self)
+        layout.addWidget(self.progress_bar)
+
         # Text edit for log messages
         self.log_window = QTextEdit(self)
         self.log_window.setReadOnly(True)
         layout.addWidget(self.log_window)
+        self.log_buffer = LogBuffer(self.log_window)
+        self.worker = None
 
         self.resize(700, 600)
         
@@ -47,7 +78,8 @@ class Meta_Quantification_GUI(QWidget):
         
     def log(self, message):
         
-        self.log_window.append(message)
+        # called from the worker thread as well, the buffer appends to the log window on the GUI thread
+        self.log_buffer.append(message)
     
     def select_input_folder(self):
         folder = QFileDialog.getExistingDirectory(self, "Select Folder")
@@ -64,17 +96,50 @@ class Meta_Quantification_GUI(QWidget):
             self.log(f"Selected output folder: {folder}")
 
     def process_files(self):
+        if self.worker is not None and self.worker.isRunning():
+            return
         if hasattr(self, 'input_folder') and hasattr(self, 'output_folder'):
-            try:
-                self.log("Starting file processing...")
-                processor = Meta_df_Merge(self.input_folder)
-                final_df = processor.merge_dfs()
-                message = processor.save_final_df(final_df, self.output_folder)
-                self.log("Process finished")
-            except Exception as e:
-                self.log(f"Error: {str(e)}")
+            input_folder, output_folder = self.input_folder, self.output_folder
+            mz_tolerance = None if self.rounded_checkbox.isChecked() else self.mz_tolerance_spin.value()
+            tolerance_unit = self.mz_unit_combo.currentText().lower()
+            cv_tolerance = self.cv_tolerance_spin.value()
+
+            def merge_files(worker):
+                processor = Meta_df_Merge(input_folder)
+                table = processor.merge_long(progress_callback=worker.report_file, should_stop=worker.should_stop,
+                                             mz_tolerance=mz_tolerance, tolerance_unit=tolerance_unit, cv_tolerance=cv_tolerance)
+                worker.check_cancelled()
+                processor.save_features(table, output_folder)
+                return processor.save_merged(table, output_folder)
+
+            self.log("Starting file processing...")
+            self.progress_bar.setValue(0)
+            self.worker = TaskWorker(merge_files, self)
+            self.worker.file_progress.connect(self.show_progress)
+            self.worker.succeeded.connect(lambda message: self.log(f"{message}\nProcess finished"))
+            self.worker.failed.connect(lambda error: self.log(f"Error: {error}"))
+            self.worker.cancelled.connect(lambda: self.log("Process cancelled"))
+            self.worker.finished.connect(self.reset_buttons)
+            self.btn_process_files.setEnabled(False)
+            self.btn_cancel.setEnabled(True)
+            self.worker.start()
         else:
-            self.status_bar.showMessage("Please select both input and output folders.")
+            self.log("Please select both input and output folders.")
+
+    def cancel_processing(self):
+        if self.worker is not None and self.worker.isRunning():
+            self.log("Cancelling after the current file...")
+            self.worker.cancel()
+            self.btn_cancel.setEnabled(False)
+
+    def show_progress(self, filename, done, total, error):
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(done)
+        self.log(f"[{done}/{total}] Read {filename}")
+
+    def reset_buttons(self):
+        self.btn_process_files.setEnabled(True)
+        self.btn_cancel.setEnabled(False)
             
 
 # if __name__ == '__main__':
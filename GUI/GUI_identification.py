@@ -4,12 +4,13 @@ import os
 import uuid
 from PyQt5.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QDialog, QSpinBox, QPushButton, QCheckBox,
                              QLabel, QTextEdit, QListWidget, QLineEdit, QFileDialog, QMessageBox,QMainWindow, QTabWidget,QFormLayout,
-                             QInputDialog)
+                             QInputDialog, QComboBox, QProgressBar)
 from PyQt5.QtCore import Qt
-from LibraryHandling import LibraryLoadingStrategy, LibraryReformat, LibrarySaveStrategy, read_path
+from GUI_worker import TaskWorker, LogBuffer, QTextEditLogger
+from LibraryHandling import LibraryLoadingStrategy, LibraryReformat, LibrarySaveStrategy, read_path, LibraryCache
 from IdentificationMeta import QueryTargetedSpectrum, match_spectrum, group_tuples_by_same_value, filter_tuples, cosine_similarity, custom_sort, macc_score, normalize_to_100
 
-from querylibrarymatch import get_spectra, match_and_calculate_cosine_similarity, main_processing_function, generate_plot, save_results
+from querylibrarymatch import get_spectra, match_and_calculate_cosine_similarity, main_processing_function, generate_plot, save_results, batch_processing_function
 import pandas as pd
 
 import os
@@ -19,32 +20,6 @@ import heapq
 import logging
 from collections import defaultdict
 
-class QTextEditLogger(logging.Handler, object):
-    def __init__(self, widget):
-        super(QTextEditLogger, self).__init__()
-        self.widget = widget
-        self.widget.setReadOnly(True)
-    
-    def emit(self, record):
-        msg = self.format(record)
-        self.widget.append(msg)
-
-class StreamToLogger(object):
-    """
-    Fake file-like stream object that redirects writes to a logger instance.
-    """
-    def __init__(self, logger, log_level=logging.INFO):
-        self.logger = logger
-        self.log_level = log_level
-        self.linebuf = ''
-    
-    def write(self, buf):
-        for line in buf.rstrip().splitlines():
-            self.logger.log(self.log_level, line.rstrip())
-    
-    def flush(self):
-        pass
-
 
 
 class Identification_GUI(QWidget):
@@ -80,6 +55,8 @@ class Identification_GUI(QWidget):
        
         # Create input fields for analysis parameters
         self.ppmToleranceEdit = QLineEdit()
+        self.toleranceUnitCombo = QComboBox()  # Unit of the fragment tolerance
+        self.toleranceUnitCombo.addItems(['ppm', 'Da'])
         self.minMatchedPeaksEdit = QLineEdit()
         self.precursorIonMassToleranceEdit = QLineEdit()
         self.intensityEdit = QLineEdit()  # New line edit for intensity
@@ -105,7 +82,10 @@ class Identification_GUI(QWidget):
         self.formLayout.addRow('Output Files:', self.figPathBtn)
         self.formLayout.addRow('', self.figPathLabel)
 
-        self.formLayout.addRow('Fragment Tolerance, ppm:', self.ppmToleranceEdit)
+        self.toleranceLayout = QHBoxLayout()
+        self.toleranceLayout.addWidget(self.ppmToleranceEdit)
+        self.toleranceLayout.addWidget(self.toleranceUnitCombo)
+        self.formLayout.addRow('Fragment Tolerance, ppm/Da:', self.toleranceLayout)
         self.formLayout.addRow('Min Matched Peaks:', self.minMatchedPeaksEdit)
         self.formLayout.addRow('Precursor Ion Mass Tolerance,da:', self.precursorIonMassToleranceEdit)
         self.formLayout.addRow('Intensity, 3e3:', self.intensityEdit)
@@ -134,35 +114,111 @@ class Identification_GUI(QWidget):
         # Add the range input layout to the form layout
         self.formLayout.addRow(self.scansRangeLabel, self.scansRangeLayout)
         
+        # Number of worker processes used to identify the scans of a file
+        self.workersSpin = QSpinBox()
+        self.workersSpin.setMinimum(1)
+        self.workersSpin.setMaximum(os.cpu_count() or 1)
+        self.workersSpin.setValue(1)
+        self.formLayout.addRow('Worker Processes:', self.workersSpin)
+        
+        # Open search scores every scan against the library spectra sharing the most fragments, whatever their precursor
+        self.openSearchCheckbox = QCheckBox('Open Search (ignore precursor m/z)')
+        self.openTopKSpin = QSpinBox()
+        self.openTopKSpin.setMinimum(1)
+        self.openTopKSpin.setMaximum(10000)
+        self.openTopKSpin.setValue(50)
+        self.searchModeLayout = QHBoxLayout()
+        self.searchModeLayout.addWidget(self.openSearchCheckbox)
+        self.searchModeLayout.addWidget(QLabel("Candidates per scan:"))
+        self.searchModeLayout.addWidget(self.openTopKSpin)
+        self.formLayout.addRow('Search Mode:', self.searchModeLayout)
+        
+        # Candidates of repeated precursor windows are kept in memory, optionally saved for later runs on the same library
+        self.persistCandidatesCheckbox = QCheckBox('Reuse Saved Window Candidates')
+        self.formLayout.addRow('Candidate Cache:', self.persistCandidatesCheckbox)
+        
+        # Repeated scans of the same window and CV are merged into one consensus spectrum and identified once
+        self.consolidateCheckbox = QCheckBox('Consolidate Repeated Window Scans')
+        self.formLayout.addRow('Scan Consolidation:', self.consolidateCheckbox)
+        
+        # Input files are converted once to a memory-mapped scan store, re-runs with other parameters skip the XML
+        self.storeScansCheckbox = QCheckBox('Reuse Converted Scans')
+        self.formLayout.addRow('Scan Store:', self.storeScansCheckbox)
+        
+        # Keep the parsed library on disk so repeated runs do not parse the .msp again
+        self.libraryCacheCheckbox = QCheckBox('Reuse Cached Library')
+        self.libraryCacheCheckbox.setChecked(True)
+        self.formLayout.addRow(self.libraryCacheCheckbox)
+        
         # Create a checkbox for plot generation
         self.generatePlotsCheckbox = QCheckBox('Generate Identified Plots')
         self.generatePlotsCheckbox.setChecked(False)  # Default is unchecked (no plots generated)
         self.formLayout.addRow(self.generatePlotsCheckbox)
         
+        # Plot file format and how many of the best matches of each compound are plotted (0 plots all)
+        self.plotFormatCombo = QComboBox()
+        self.plotFormatCombo.addItems(['SVG', 'PNG'])
+        self.plotTopNSpin = QSpinBox()
+        self.plotTopNSpin.setMinimum(0)
+        self.plotTopNSpin.setMaximum(1000)
+        self.plotTopNSpin.setValue(0)
+        self.plotOptionsLayout = QHBoxLayout()
+        self.plotOptionsLayout.addWidget(self.plotFormatCombo)
+        self.plotOptionsLayout.addWidget(QLabel("Top hits per compound (0 = all):"))
+        self.plotOptionsLayout.addWidget(self.plotTopNSpin)
+        self.formLayout.addRow('Plot Format:', self.plotOptionsLayout)
+        
+        # Result files are streamed as CSV or Parquet, Excel is an optional copy at the end
+        self.resultFormatCombo = QComboBox()
+        self.resultFormatCombo.addItems(['CSV', 'Parquet'])
+        self.keepPeaksCheckbox = QCheckBox('Save Matched Peaks')
+        self.exportExcelCheckbox = QCheckBox('Also Export Excel')
+        self.profileCheckbox = QCheckBox('Profile Stages')
+        self.profileCheckbox.setToolTip('Log the time spent in every stage and save it to <file>_profile.json')
+        self.resultOptionsLayout = QHBoxLayout()
+        self.resultOptionsLayout.addWidget(self.resultFormatCombo)
+        self.resultOptionsLayout.addWidget(self.keepPeaksCheckbox)
+        self.resultOptionsLayout.addWidget(self.exportExcelCheckbox)
+        self.resultOptionsLayout.addWidget(self.profileCheckbox)
+        self.formLayout.addRow('Result Format:', self.resultOptionsLayout)
+        
         layout.addLayout(self.formLayout)
         
         # Add the Clear button to the layout
 #         layout.addWidget(self.clearBtn)
         
-        # Button to start the analysis
+        # Buttons to start and cancel the analysis, which runs in a background thread
         self.startBtn = QPushButton('Start Analysis',self)
         self.startBtn.clicked.connect(self.startAnalysis)
-        layout.addWidget(self.startBtn)
+        self.cancelBtn = QPushButton('Cancel',self)
+        self.cancelBtn.clicked.connect(self.cancelAnalysis)
+        self.cancelBtn.setEnabled(False)
+        self.runButtonLayout = QHBoxLayout()
+        self.runButtonLayout.addWidget(self.startBtn)
+        self.runButtonLayout.addWidget(self.cancelBtn)
+        layout.addLayout(self.runButtonLayout)
+        
+        # Progress of the files and of the scans in the files started so far
+        self.fileProgressBar = QProgressBar()
+        self.fileProgressBar.setFormat('Files: %v/%m')
+        self.scanProgressBar = QProgressBar()
+        self.scanProgressBar.setFormat('Scans: %v/%m')
+        layout.addWidget(self.fileProgressBar)
+        layout.addWidget(self.scanProgressBar)
         
         #  logging displaying area...
         self.logTextEdit = QTextEdit()  # Log display area
+        self.logTextEdit.setReadOnly(True)
         layout.addWidget(self.logTextEdit)
         
-        # Setup logging
-        logTextBox = QTextEditLogger(self.logTextEdit)
+        # Setup logging, the log lines are flushed to the text area a few times per second
+        self.logBuffer = LogBuffer(self.logTextEdit)
+        logTextBox = QTextEditLogger(self.logBuffer)
         logTextBox.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
         logging.getLogger().addHandler(logTextBox)
         logging.getLogger().setLevel(logging.INFO)
         
-        # Redirect stdout and stderr
-        sys.stdout = StreamToLogger(logging.getLogger('STDOUT'), logging.INFO)
-        sys.stderr = StreamToLogger(logging.getLogger('STDERR'), logging.ERROR)
-        
+        self.worker = None
         
         self.resize(700, 600)
         
@@ -207,52 +263,111 @@ class Identification_GUI(QWidget):
         self.libraryFilePath = ''
         self.figPath = ''
     
+    def logFileProgress(self, file_path, done, total, error):
+        self.fileProgressBar.setMaximum(total)
+        self.fileProgressBar.setValue(done)
+        if not error:
+            logging.info(f"[{done}/{total}] Finished {file_path}")
+        else:
+            logging.error(f"[{done}/{total}] Failed {file_path}: {error}")
+    
+    def logScanProgress(self, done, total):
+        self.scanProgressBar.setMaximum(total)
+        self.scanProgressBar.setValue(done)
+    
     def startAnalysis(self):
         
-        logging.info("Analysis started.")
+        if self.worker is not None and self.worker.isRunning():
+            return
         
         try: 
             
-            library_loader = LibraryLoadingStrategy(self.libraryFilePath)
-            library = library_loader.load_library()
+            library_cache = LibraryCache() if self.libraryCacheCheckbox.isChecked() else None
+            library_loader = LibraryLoadingStrategy(self.libraryFilePath, cache=library_cache)
             ppm_tolerance = float(self.ppmToleranceEdit.text())
+            tolerance_unit = self.toleranceUnitCombo.currentText().lower()
             minmatchedpeaks = int(self.minMatchedPeaksEdit.text())
             PrecursorIonMassTolerance = float(self.precursorIonMassToleranceEdit.text())
             intensity_threshold = float(self.intensityEdit.text()) 
             cosine_threshold = float(self.cosineEdit.text()) 
             lowerscan = self.scansLowerSpin.value()
             higherscan = self.scansUpperSpin.value() 
+            workers = self.workersSpin.value()
             # Retrieve the state of the generate plots checkbox
         
             generate_plots = self.generatePlotsCheckbox.isChecked()
-         # set it to Default scans in the input file if nothing is set
-
-            for InputFilePath in self.InputFilePaths:
-
-
-                analyzer = QueryTargetedSpectrum(InputFilePath,intensity_threshold)
-
-                if higherscan == 1:
-                      # Adjust based on your implementation
-                    total_scans = analyzer.get_scans()     
-                    higherscan = total_scans 
-
-                 # Get the number of scans from the input field
-
-                result_dicts = main_processing_function(lowerscan, higherscan, analyzer, library, PrecursorIonMassTolerance,
-                                                        cosine_threshold,ppm_tolerance, minmatchedpeaks, self.figPath, 
-                                                        generate_plots = generate_plots
-                                                       )
-            
-                # higherscan = self.scansUpperSpin.value() 
-            
-                save_results(result_dicts, self.figPath, InputFilePath)
-            
-            logging.info("Analysis completed successfully.")
+            plot_format = self.plotFormatCombo.currentText().lower()
+            plot_top_n = self.plotTopNSpin.value() or None
+            result_format = self.resultFormatCombo.currentText().lower()
+            keep_peaks = self.keepPeaksCheckbox.isChecked()
+            export_excel = self.exportExcelCheckbox.isChecked()
+            profile = self.profileCheckbox.isChecked()
+            search_mode = 'open' if self.openSearchCheckbox.isChecked() else 'precursor'
+            open_top_k = self.openTopKSpin.value()
+            persist_candidates = self.persistCandidatesCheckbox.isChecked()
+            consolidate_scans = self.consolidateCheckbox.isChecked()
+            store_scans = self.storeScansCheckbox.isChecked()
+            InputFilePaths = list(self.InputFilePaths)
+            figPath = self.figPath
             
         except Exception as e:
             
             logging.error(f"An error occurred: {str(e)}")
+            return
+        
+        def analysis(worker):
+            # with several files in workers the scans of all files started so far add up in one bar
+            scan_progress = {}
+            def report_scans(path, done, total):
+                scan_progress[path] = (done, total)
+                worker.report_progress(*map(sum, zip(*scan_progress.values())))
+            library = library_loader.load_library()
+            worker.check_cancelled()
+            # set it to Default scans in the input file if nothing is set (higherscan == 1), per input file
+            return batch_processing_function(InputFilePaths, library, lowerscan, higherscan, PrecursorIonMassTolerance,
+                                             cosine_threshold, ppm_tolerance, minmatchedpeaks, intensity_threshold, figPath,
+                                             generate_plots = generate_plots, tolerance_unit = tolerance_unit,
+                                             workers = workers, progress_callback = worker.report_file,
+                                             scan_progress_callback = report_scans,
+                                             should_stop = worker.should_stop,
+                                             plot_format = plot_format, plot_top_n = plot_top_n,
+                                             result_format = result_format, keep_peaks = keep_peaks, export_excel = export_excel,
+                                             profile = profile, search_mode = search_mode, open_top_k = open_top_k,
+                                             persist_candidates = persist_candidates, consolidate_scans = consolidate_scans,
+                                             store_scans = store_scans
+                                            )
+        
+        logging.info("Analysis started.")
+        self.fileProgressBar.setMaximum(len(InputFilePaths))
+        self.fileProgressBar.setValue(0)
+        self.scanProgressBar.setValue(0)
+        self.worker = TaskWorker(analysis, self)
+        self.worker.file_progress.connect(self.logFileProgress)
+        self.worker.progress.connect(self.logScanProgress)
+        self.worker.succeeded.connect(self.analysisFinished)
+        self.worker.failed.connect(lambda error: logging.error(f"An error occurred: {error}"))
+        self.worker.cancelled.connect(lambda: logging.warning("Analysis cancelled."))
+        self.worker.finished.connect(self.resetRunButtons)
+        self.startBtn.setEnabled(False)
+        self.cancelBtn.setEnabled(True)
+        self.worker.start()
+    
+    def cancelAnalysis(self):
+        if self.worker is not None and self.worker.isRunning():
+            logging.info("Cancelling after the current chunk of scans...")
+            self.worker.cancel()
+            self.cancelBtn.setEnabled(False)
+    
+    def analysisFinished(self, status):
+        failed = [path for path, error in status.items() if error is not None]
+        if failed:
+            logging.error(f"{len(failed)} of {len(status)} files failed: {', '.join(failed)}")
+        else:
+            logging.info("Analysis completed successfully.")
+    
+    def resetRunButtons(self):
+        self.startBtn.setEnabled(True)
+        self.cancelBtn.setEnabled(False)
             
 
 # def main():
@@ -0,0 +1,90 @@
+import threading
+import traceback
+import logging
+from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal
+
+
+class LogBuffer(QObject):
+    """
+    Collects log lines from any thread and appends them to a QTextEdit in batches on the GUI thread,
+    so a busy worker does not flood the event loop with one repaint per line.
+    """
+    def __init__(self, widget, interval=250):
+        super().__init__(widget)
+        self.widget = widget
+        self.lines = []
+        self.lock = threading.Lock()
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.flush)
+        self.timer.start(interval)
+
+    def append(self, message):
+        with self.lock:
+            self.lines.append(message)
+
+    def flush(self):
+        with self.lock:
+            lines, self.lines = self.lines, []
+        if lines:
+            self.widget.append('\n'.join(lines))
+
+
+class QTextEditLogger(logging.Handler):
+    """Logging handler that writes formatted records to a LogBuffer; safe to use from worker threads."""
+    def __init__(self, log_buffer):
+        super().__init__()
+        self.log_buffer = log_buffer
+
+    def emit(self, record):
+        self.log_buffer.append(self.format(record))
+
+
+class TaskWorker(QThread):
+    """
+    Runs task(worker) in a background thread.
+    The task reports through worker.report_progress / worker.report_file and checks worker.should_stop
+    (or calls worker.check_cancelled) at its chunk boundaries; cancel() only sets the flag.
+    Exactly one of succeeded(result), failed(traceback) or cancelled() is emitted when the task ends.
+    """
+    progress = pyqtSignal(int, int)               # done, total within the current item
+    file_progress = pyqtSignal(str, int, int, str)  # item, done items, total items, error ('' on success)
+    succeeded = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+    def __init__(self, task, parent=None):
+        super().__init__(parent)
+        self.task = task
+        self.stop_event = threading.Event()
+
+    def cancel(self):
+        self.stop_event.set()
+
+    def should_stop(self):
+        return self.stop_event.is_set()
+
+    def check_cancelled(self):
+        if self.should_stop():
+            raise TaskCancelled()
+
+    def report_progress(self, done, total):
+        self.progress.emit(done, total)
+
+    def report_file(self, file_path, done, total, error=None):
+        self.file_progress.emit(file_path, done, total, error or '')
+
+    def run(self):
+        try:
+            result = self.task(self)
+        except Exception:
+            # whatever the task raises once it was asked to stop counts as the cancellation
+            if self.should_stop():
+                self.cancelled.emit()
+            else:
+                self.failed.emit(traceback.format_exc())
+            return
+        self.succeeded.emit(result)
+
+
+class TaskCancelled(Exception):
+    """Raised by TaskWorker.check_cancelled after cancel() was requested."""
@@ -4,25 +4,38 @@ from pyteomics import mgf
 import os
 from pyteomics import mzml
 import pyteomics
-import matplotlib.pyplot as plt
 import pandas as pd
 import glob
 import heapq
+import json
+import gzip
+import re
+import warnings
+import hashlib
+import tempfile
+import numpy as np
 
 
 class LibraryLoadingStrategy:
     
     '''class for loading Libraries'''
-    def __init__(self, file_path):
+    def __init__(self, file_path, cache=None):
         self.file_path = file_path
+        self.cache = cache   # optional LibraryCache that keeps parsed .msp libraries on disk between runs
 
     def load_library(self):
         """Automatically load library based on file extension."""
         _, file_extension = os.path.splitext(self.file_path)
+        if self.file_path.lower().endswith('.msp.gz'):
+            file_extension = '.msp'
         if file_extension.lower() == '.mgf':
-            return self._load_mgf()
+            return PrecursorIndexedLibrary(self._load_mgf())
         elif file_extension.lower() == '.msp':
-            return self._load_msp()
+            if self.cache is not None:
+                return self.cache.load(self.file_path, lambda: PrecursorIndexedLibrary(self._load_msp()))
+            return PrecursorIndexedLibrary(self._load_msp())
+        elif file_extension.lower() == '.dilib':
+            return CompiledLibrary(self.file_path)
         else:
             raise ValueError(f"Unsupported file format: {file_extension}")
 
@@ -32,30 +45,92 @@ class LibraryLoadingStrategy:
         spectra_library = mgf.IndexedMGF(self.file_path, index_by_scans=True)
         return spectra_library
 
+    # metadata converted to numbers once at load time, everything else is kept as text
+    NUMERIC_KEYS = {'precursormz': float, 'exactmass': float, 'num peaks': int,
+                    'base peak mz': float, 'base peak intensity': float}
+
     def _load_msp(self)-> list:
-        """Load a library from a .msp file."""
-        
-        with open(self.file_path, 'r', encoding='utf-8') as file:
-            spectra = []
-            spectrum = {} # Start with an empty dictionary
-            for line in file:
-                line = line.strip().lower() # remove leading and trailing whitespace characters, format uppercase to lowercase
-                if not line:  # Skip empty lines
-                    continue
-                if line.startswith('name:'):   
-                    if 'mz' in spectrum:         # Check if the current spectrum already has 'mz' key
-                        spectra.append(spectrum)
-                        spectrum = {}            # Reset for new spectrum
-                if ':' in line:                 # Meta data line
-                    key, value = line.split(':', 1)
-                    spectrum[key.strip()] = value.strip()
-                else:                          # Spectrum data line
-                    mz, intensity = line.split()
-                    spectrum.setdefault('mz', []).append(float(mz))
-                    spectrum.setdefault('intensity', []).append(float(intensity))
-            if 'mz' in spectrum:       # append the last spectrum
-                spectra.append(spectrum)
-            return spectra
+        """Load a library from a .msp (or .msp.gz) file."""
+        return list(self.iter_msp())
+
+    # searched from the preceding newline, which is much faster than a multiline '^' pattern
+    _NAME_LINE = re.compile(r'\n[ \t]*[Nn][Aa][Mm][Ee]:')
+    _FIRST_NAME_LINE = re.compile(r'[ \t]*name:', re.IGNORECASE)
+    _TEXT_LINE = re.compile(r'\S[^\n]*')
+    BLOCK_SIZE = 1 << 22
+
+    def iter_msp(self):
+        """
+        Stream the spectra of a .msp (or .msp.gz) file one at a time.
+        The file is read in large blocks cut at 'Name:' lines; only the metadata lines of a record are handled in Python,
+        its peak block is converted in bulk into float 'mz' and 'intensity' arrays.
+        Metadata keys are lowercased, values keep their original casing and the NUMERIC_KEYS are converted to numbers.
+        """
+        opener = gzip.open if self.file_path.lower().endswith('.gz') else open
+        with opener(self.file_path, 'rt', encoding='utf-8') as file:
+            spectrum, peak_texts, pending = {}, [], ''
+            while True:
+                block = file.read(self.BLOCK_SIZE)
+                text = pending + block
+                starts = [match.start() + 1 for match in self._NAME_LINE.finditer(text)]
+                if self._FIRST_NAME_LINE.match(text):
+                    starts.insert(0, 0)
+                if block:   # the record after the last 'Name:' line may continue in the next block
+                    cut = starts[-1] if starts else 0
+                    text, pending = text[:cut], text[cut:]
+                    starts = starts[:-1]
+                bounds = ([0] if not starts or starts[0] > 0 else []) + starts + [len(text)]
+                for begin, end in zip(bounds[:-1], bounds[1:]):
+                    if peak_texts and (begin > 0 or starts[:1] == [0]):   # a 'Name:' line after the peaks of the current spectrum
+                        yield self._finish_msp_spectrum(spectrum, peak_texts)
+                        spectrum, peak_texts = {}, []
+                    self._parse_msp_record(text[begin:end], spectrum, peak_texts)
+                if not block:
+                    break
+            if peak_texts:       # the last spectrum
+                yield self._finish_msp_spectrum(spectrum, peak_texts)
+
+    @staticmethod
+    def _parse_msp_record(record, spectrum, peak_texts):
+        """Add the metadata of one record (the text from a 'Name:' line up to the next one) to spectrum and collect its peak text."""
+        # metadata lines come first, everything after the last line containing ':' is peak data
+        colon = record.rfind(':')
+        split_at = record.find('\n', colon) if colon >= 0 else 0
+        if split_at < 0:
+            split_at = len(record)
+        for line in record[:split_at].splitlines():
+            line = line.strip() # remove leading and trailing whitespace characters
+            if not line:  # Skip empty lines
+                continue
+            if ':' in line:                 # Meta data line
+                key, value = line.split(':', 1)
+                spectrum[key.strip().lower()] = value.strip()
+            else:                          # Spectrum data line between meta data lines
+                peak_texts.append(line)
+        if record[split_at:].strip():
+            peak_texts.append(record[split_at:])
+
+    def _finish_msp_spectrum(self, spectrum, peak_texts) -> dict:
+        text = '\n'.join(peak_texts).strip()
+        values = None
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)   # raised by numpy for text it cannot parse to the end
+            try:
+                values = np.fromstring(text, dtype=np.float64, sep=' ')
+            except ValueError:
+                pass
+        if values is None or len(values) != 2 * (text.count('\n') + 1):
+            # blank or annotated peak lines, parse line by line and keep the first two columns
+            values = np.array([value for line in self._TEXT_LINE.findall(text) for value in line.split()[:2]], dtype=np.float64)
+        spectrum['mz'] = values[0::2].copy()
+        spectrum['intensity'] = values[1::2].copy()
+        for key, convert in self.NUMERIC_KEYS.items():
+            if key in spectrum:
+                try:
+                    spectrum[key] = convert(spectrum[key])
+                except ValueError:
+                    pass
+        return spectrum
     
     @classmethod
     def combine_libraries(cls, file_paths) -> list:
@@ -67,6 +142,332 @@ class LibraryLoadingStrategy:
         return combined_library
 
 
+class PrecursorIndexedLibrary:
+
+    '''Library spectra indexed by a sorted numeric precursor m/z array, so the spectra inside a precursor window
+    can be found by binary search instead of scanning the whole library for every scan.
+    It behaves like the plain list of spectrum dicts returned by the loaders (len, indexing, iteration).'''
+
+    def __init__(self, spectra):
+        self.spectra = list(spectra)
+        precursors = np.array([self._precursor_of(spectrum) for spectrum in self.spectra], dtype=np.float64)
+        self.order = np.argsort(precursors, kind='stable')   # spectra without a precursor (NaN) are sorted to the end
+        self.precursors = precursors[self.order]
+
+    @staticmethod
+    def _precursor_of(spectrum) -> float:
+        try:
+            return float(spectrum['precursormz'])
+        except (KeyError, TypeError, ValueError):
+            return float('nan')
+
+    def __len__(self):
+        return len(self.spectra)
+
+    def __getitem__(self, index):
+        return self.spectra[index]
+
+    def __iter__(self):
+        return iter(self.spectra)
+
+    def window_bounds(self, low, high):
+        """Return the (start, stop) positions of the spectra with low < precursor m/z < high."""
+        start = int(np.searchsorted(self.precursors, low, side='right'))
+        stop = int(np.searchsorted(self.precursors, high, side='left'))
+        return start, max(start, stop)
+
+    def search(self, precursor, PIMT) -> list:
+        """Return the spectra whose precursor m/z lies strictly within precursor +/- PIMT, kept in library order."""
+        return [self.spectra[i] for i in self.search_positions(precursor, PIMT).tolist()]
+
+    def search_positions(self, precursor, PIMT) -> np.ndarray:
+        """Library positions, ascending, of the spectra search(precursor, PIMT) returns."""
+        start, stop = self.window_bounds(precursor - PIMT, precursor + PIMT)
+        return np.sort(self.order[start:stop])
+
+    def fragment_index(self, bin_width=None):
+        """The FragmentIndex of this library, built on first use and kept for later calls."""
+        bin_width = bin_width or FragmentIndex.BIN_WIDTH
+        cache = self.__dict__.setdefault('_fragment_indexes', {})
+        if bin_width not in cache:
+            cache[bin_width] = FragmentIndex(self, bin_width)
+        return cache[bin_width]
+
+    def fingerprint(self) -> str:
+        """The library_fingerprint of this library, computed on first use and kept for later calls."""
+        if '_fingerprint' not in self.__dict__:
+            self._fingerprint = _library_fingerprint(self)
+        return self._fingerprint
+
+
+class FragmentIndex:
+
+    '''Inverted index from binned fragment m/z to the library spectra having a peak in that bin.
+
+    The postings are stored in CSR form: bin_keys holds the occupied bins in ascending order and the spectrum positions
+    of bin_keys[i] are spectrum_ids[offsets[i]:offsets[i + 1]], each spectrum listed once per bin. It lets an open search
+    rank the whole library by the number of query peaks it shares with a scan, independent of the precursor m/z.'''
+
+    BIN_WIDTH = 0.01   # Da, the shortlist looks up every bin a query peak tolerance window touches, so any width is exact
+
+    def __init__(self, library, bin_width=BIN_WIDTH):
+        self.bin_width = bin_width
+        source_order = getattr(library, 'source_order', None)   # CompiledLibrary, shortlists follow the source library order
+        self.rank = None if source_order is None else np.asarray(source_order)
+        if hasattr(library, 'peak_offsets'):   # CompiledLibrary, the flat peak arrays are used as they are
+            mz, counts = np.asarray(library.mz, dtype=np.float64), np.diff(library.peak_offsets)
+        else:
+            spectra = list(library)
+            counts = np.array([len(spectrum.get('mz', [])) for spectrum in spectra], dtype=np.int64)
+            mz = np.concatenate([np.asarray(spectrum.get('mz', []), dtype=np.float64) for spectrum in spectra] or [np.empty(0)])
+        self.size = len(counts)
+        ids = np.repeat(np.arange(self.size, dtype=np.int64), counts)
+        valid = np.isfinite(mz)
+        bins = np.floor(mz[valid] / bin_width).astype(np.int64)
+        # one posting per (bin, spectrum), sorted by bin and then by spectrum
+        keys = np.unique(bins * max(self.size, 1) + ids[valid])
+        bins, ids = keys // max(self.size, 1), keys % max(self.size, 1)
+        self.bin_keys, starts = np.unique(bins, return_index=True)
+        self.offsets = np.append(starts, len(ids)).astype(np.int64)
+        self.spectrum_ids = ids.astype(np.int32)
+
+    def shared_peaks(self, query_mz, tolerance, unit='ppm') -> tuple:
+        """
+        Count for every library spectrum the query peaks that have a library peak in one of the bins touched by their
+        tolerance window. Returns (spectrum positions, counts) of the spectra with at least one shared peak.
+        The count is an upper bound of the peaks the exact matching can pair up.
+        """
+        query_mz = np.asarray(query_mz, dtype=np.float64)
+        if unit.lower() == 'ppm':
+            tolerances = query_mz * tolerance / 1e6
+        elif unit.lower() == 'da':
+            tolerances = np.full(query_mz.shape, float(tolerance))
+        else:
+            raise ValueError(f"Unsupported tolerance unit: {unit}")
+        low = np.floor((query_mz - tolerances) / self.bin_width).astype(np.int64)
+        high = np.floor((query_mz + tolerances) / self.bin_width).astype(np.int64)
+        bin_counts = high - low + 1
+        query_of = np.repeat(np.arange(len(query_mz)), bin_counts)
+        bins = np.repeat(low, bin_counts) + np.arange(int(bin_counts.sum())) - np.repeat(np.cumsum(bin_counts) - bin_counts, bin_counts)
+
+        position = np.searchsorted(self.bin_keys, bins)
+        found = position < len(self.bin_keys)
+        found[found] = self.bin_keys[position[found]] == bins[found]
+        position, query_of = position[found], query_of[found]
+        starts, counts = self.offsets[position], self.offsets[position + 1] - self.offsets[position]
+        total = int(counts.sum())
+        if total == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        postings = np.repeat(starts, counts) + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        # one vote per query peak and spectrum, also when its window covers several bins or peaks of the spectrum
+        votes = np.unique(np.repeat(query_of, counts).astype(np.int64) * self.size + self.spectrum_ids[postings])
+        return np.unique(votes % self.size, return_counts=True)
+
+    def shortlist(self, query_mz, tolerance, unit='ppm', top_k=50, min_shared=1) -> np.ndarray:
+        """Positions, in library order, of the top_k spectra sharing the most peaks (at least min_shared) with the query;
+        ties are broken by library position."""
+        spectra, shared = self.shared_peaks(query_mz, tolerance, unit)
+        keep = shared >= min_shared
+        spectra, shared = spectra[keep], shared[keep]
+        rank = spectra if self.rank is None else self.rank[spectra]
+        if top_k and len(spectra) > top_k:
+            best = np.lexsort((rank, -shared))[:top_k]
+            spectra, rank = spectra[best], rank[best]
+        return spectra[np.argsort(rank, kind='stable')]
+
+
+def library_fingerprint(library) -> str:
+    """SHA-1 of the precursor m/z, peak counts and peaks of a library in its own order, to tell whether data derived
+    from library positions (such as a saved candidate cache) still matches it. Cached on PrecursorIndexedLibrary and
+    CompiledLibrary objects."""
+    if hasattr(library, 'fingerprint'):
+        return library.fingerprint()
+    return _library_fingerprint(library)
+
+
+def _library_fingerprint(library) -> str:
+    if hasattr(library, 'peak_offsets'):   # CompiledLibrary
+        arrays = [library.precursors, library.peak_offsets, library.mz, library.intensity]
+        if library.source_order is not None:   # the order searches return the positions in
+            arrays.append(library.source_order)
+    else:
+        spectra = list(library)
+        arrays = [np.array([PrecursorIndexedLibrary._precursor_of(spectrum) for spectrum in spectra], dtype=np.float64),
+                  np.array([len(spectrum.get('mz', [])) for spectrum in spectra], dtype=np.int64)]
+        arrays += [np.concatenate([np.asarray(spectrum.get(key, []), dtype=np.float64) for spectrum in spectra] or [np.empty(0)])
+                   for key in ('mz', 'intensity')]
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(f"{array.dtype.str}{len(array)}".encode('ascii'))
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def build_fragment_index(library, bin_width=None) -> FragmentIndex:
+    """FragmentIndex of a library, cached on PrecursorIndexedLibrary and CompiledLibrary objects."""
+    if hasattr(library, 'fragment_index'):
+        return library.fragment_index(bin_width)
+    return FragmentIndex(library, bin_width or FragmentIndex.BIN_WIDTH)
+
+
+class CompiledLibrary(PrecursorIndexedLibrary):
+
+    '''Library in the compiled .dilib format written by LibrarySaveStrategy.save_library_to_compiled.
+
+    The file holds flat peak arrays with per-spectrum offsets, the ascending precursor m/z array and a side table
+    with the remaining metadata (name, formula, adduct, ...), all memory-mapped instead of parsed. Loading takes
+    milliseconds and worker processes reading the same file share its pages. Spectra are built on access as
+    dicts whose 'mz', 'intensity' and 'normalized intensity' are read-only views into the mapped file.
+    The position every spectrum had in the saved library is kept as source_order, so searches return the spectra of a
+    window in the order of the source library, like PrecursorIndexedLibrary, and not in precursor order.'''
+
+    MAGIC = b'DILIB001'
+    ALIGNMENT = 64
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        _, arrays = read_array_file(file_path, self.MAGIC, 'compiled library')
+        self.precursors = arrays['precursormz']
+        self.peak_offsets = arrays['peak_offsets']
+        self.mz = arrays['mz']
+        self.intensity = arrays['intensity']
+        self.normalized_intensity = arrays.get('normalized_intensity')   # not in files written before it was added
+        self.meta_offsets = arrays['meta_offsets']
+        self.meta = arrays['meta']
+        self.source_order = arrays.get('source_order')   # not in files written before it was added
+
+    def __getstate__(self):
+        # only the path is pickled, a worker process maps the same file again
+        return {'file_path': self.file_path}
+
+    def __setstate__(self, state):
+        self.__init__(state['file_path'])
+
+    def __len__(self):
+        return len(self.precursors)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('library index out of range')
+        spectrum = json.loads(self.meta[self.meta_offsets[index]:self.meta_offsets[index + 1]].tobytes().decode('utf-8'))
+        start, stop = self.peak_offsets[index], self.peak_offsets[index + 1]
+        spectrum['mz'] = self.mz[start:stop]
+        spectrum['intensity'] = self.intensity[start:stop]
+        if self.normalized_intensity is not None:
+            spectrum['normalized intensity'] = self.normalized_intensity[start:stop]
+        return spectrum
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def search(self, precursor, PIMT) -> list:
+        """Return the spectra whose precursor m/z lies strictly within precursor +/- PIMT, in source library order."""
+        return [self[i] for i in self.search_positions(precursor, PIMT).tolist()]
+
+    def search_positions(self, precursor, PIMT) -> np.ndarray:
+        """File positions of the spectra search(precursor, PIMT) returns, the file is already in precursor order."""
+        start, stop = self.window_bounds(precursor - PIMT, precursor + PIMT)
+        positions = np.arange(start, stop)
+        if self.source_order is not None:
+            positions = positions[np.argsort(self.source_order[start:stop], kind='stable')]
+        return positions
+
+
+class LibraryCache:
+
+    '''On-disk cache of parsed and indexed libraries, stored in the compiled .dilib format.
+
+    An entry is keyed by the absolute path of the source library plus its size and modification time, and
+    optionally a SHA-256 of its content (content_hash=True) for sources whose mtime cannot be trusted.
+    A changed source gets a new entry and its stale entries are dropped; the least recently used entries
+    are evicted once the cache grows beyond max_size bytes. VERSION is part of the key, it is raised whenever the
+    parsers, the reformatting or the .dilib layout change what an entry holds, so older entries are rebuilt.'''
+
+    VERSION = 2   # 2: spectra keep their source library order (source_order)
+
+    def __init__(self, cache_dir=None, max_size=2 * 1024 ** 3, content_hash=False):
+        self.cache_dir = cache_dir or os.path.join(os.path.expanduser('~'), '.cache', 'dimeta', 'libraries')
+        self.max_size = max_size
+        self.content_hash = content_hash
+
+    def _path_prefix(self, file_path) -> str:
+        return hashlib.sha1(os.path.abspath(file_path).encode('utf-8')).hexdigest()[:16]
+
+    def entry_path(self, file_path) -> str:
+        """Path of the cache entry for the current state of file_path."""
+        stat = os.stat(file_path)
+        state = f"{self.VERSION}:{stat.st_size}:{stat.st_mtime_ns}"
+        if self.content_hash:
+            digest = hashlib.sha256()
+            with open(file_path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(chunk)
+            state += ':' + digest.hexdigest()
+        state_key = hashlib.sha1(state.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{self._path_prefix(file_path)}_{state_key}.dilib")
+
+    def load(self, file_path, loader):
+        """Return the cached library of file_path, calling loader() and storing its result on a miss."""
+        entry = self.entry_path(file_path)
+        if os.path.exists(entry):
+            os.utime(entry)   # mark as recently used for the eviction
+            return CompiledLibrary(entry)
+
+        library = loader()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.invalidate(file_path)   # drop entries of earlier versions of the file
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        os.close(fd)
+        try:
+            LibrarySaveStrategy.save_library_to_compiled(library, tmp_path)
+            os.replace(tmp_path, entry)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict(keep=entry)
+        return CompiledLibrary(entry)
+
+    def _entries(self) -> list:
+        if not os.path.isdir(self.cache_dir):
+            return []
+        return [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.dilib')]
+
+    def invalidate(self, file_path):
+        """Remove every cached entry of file_path."""
+        prefix = self._path_prefix(file_path) + '_'
+        for entry in self._entries():
+            if os.path.basename(entry).startswith(prefix):
+                self._remove(entry)
+
+    def clear(self):
+        """Remove all cached entries."""
+        for entry in self._entries():
+            self._remove(entry)
+
+    def evict(self, keep=None):
+        """Remove the least recently used entries until the cache fits in max_size bytes."""
+        entries = sorted(self._entries(), key=os.path.getmtime)
+        total = sum(os.path.getsize(entry) for entry in entries)
+        for entry in entries:
+            if total <= self.max_size:
+                break
+            if entry != keep:
+                total -= os.path.getsize(entry)
+                self._remove(entry)
+
+    @staticmethod
+    def _remove(entry):
+        try:
+            os.remove(entry)
+        except OSError:   # still mapped by a running analysis on some platforms, removed on a later call
+            pass
+
+
 class LibraryReformat:
     
     def __init__(self, topnum):
@@ -74,7 +475,7 @@ class LibraryReformat:
 
     def reformat_spectrum(self, spectrum):
         if len(spectrum['mz']) <= self.topnum:
-            return spectrum.copy()
+            return self.add_features(spectrum.copy())
 
         # Use a min heap to keep track of top elements
         paired = zip(spectrum['mz'], spectrum['intensity'])
@@ -82,10 +483,29 @@ class LibraryReformat:
 
         top_mz, top_intensity = zip(*top_pairs) if top_pairs else ([], [])
 
-        new_spectrum = {**spectrum, 'mz': list(top_mz), 'intensity': list(top_intensity)}
-        new_spectrum['num peaks'] = str(len(top_mz))
+        new_spectrum = {**spectrum, 'mz': np.array(top_mz), 'intensity': np.array(top_intensity)}
+        new_spectrum['num peaks'] = len(top_mz)
 
-        return new_spectrum
+        return self.add_features(new_spectrum)
+
+    @staticmethod
+    def add_features(spectrum):
+        """
+        Store the per-spectrum values the identification would otherwise derive again for every scan:
+        peaks sorted by m/z, 'normalized intensity' (base peak = 100, used by the mirror plots),
+        'base peak mz' and 'base peak intensity'. They are kept in memory and in .dilib files, the FEATURE_KEYS are
+        only written to .msp files on request.
+        """
+        mz = np.asarray(spectrum['mz'])
+        intensity = np.asarray(spectrum['intensity'])
+        order = np.argsort(mz, kind='stable')
+        spectrum['mz'], spectrum['intensity'] = mz[order], intensity[order]
+        if len(mz):
+            base = int(np.argmax(spectrum['intensity']))
+            spectrum['base peak mz'] = float(spectrum['mz'][base])
+            spectrum['base peak intensity'] = float(spectrum['intensity'][base])
+        spectrum['normalized intensity'] = normalized_intensity(spectrum['intensity'])
+        return spectrum
 
     def reformat_library(self, library):
 
@@ -96,16 +516,30 @@ class LibraryReformat:
             if 'precursormz' in spectrum:
                 reformatted_library.append(self.reformat_spectrum(spectrum))
         return reformatted_library
+
+
+def normalized_intensity(intensity) -> np.ndarray:
+    """Intensities scaled to a base peak of 100, all zeros for an empty or all-zero spectrum."""
+    intensity = np.asarray(intensity, dtype=np.float64)
+    base = intensity.max() if len(intensity) else 0.0
+    return intensity * (100.0 / base) if base > 0 else np.zeros(len(intensity))
+
+# per-peak arrays of a spectrum, stored as peak data rather than metadata
+PEAK_ARRAYS = ('mz', 'intensity', 'normalized intensity')
+# metadata added by LibraryReformat.add_features
+FEATURE_KEYS = ('base peak mz', 'base peak intensity')
+
     
 class LibrarySaveStrategy:
 
     @classmethod
-    def save_library_to_msp_class(cls, library, output_file_path):
-        """Save the library to a new .msp file using a class method."""
+    def save_library_to_msp_class(cls, library, output_file_path, include_features=False):
+        """Save the library to a new .msp file using a class method, with the FEATURE_KEYS only when include_features."""
+        skipped = PEAK_ARRAYS if include_features else PEAK_ARRAYS + FEATURE_KEYS
         with open(output_file_path, 'w', encoding='utf-8') as file:
             for spectrum in library:
                 for key, value in spectrum.items():
-                    if key not in ['mz', 'intensity']:
+                    if key not in skipped:
                         file.write(f"{key.capitalize()}: {value}\n")
 
                 mz_intensities = zip(spectrum.get('mz', []), spectrum.get('intensity', []))
@@ -114,6 +548,86 @@ class LibrarySaveStrategy:
 
                 file.write("\n")    
 
+    @classmethod
+    def save_library_to_compiled(cls, library, output_file_path):
+        """Save the library to the compiled .dilib format read by CompiledLibrary, spectra sorted by precursor m/z
+        with their position in library as source order."""
+        spectra = list(library)
+        precursors = np.array([PrecursorIndexedLibrary._precursor_of(spectrum) for spectrum in spectra], dtype=np.float64)
+        order = np.argsort(precursors, kind='stable')
+        spectra = [spectra[i] for i in order]
+        source_order = order if getattr(library, 'source_order', None) is None else np.asarray(library.source_order)[order]
+
+        counts = np.array([len(spectrum.get('mz', [])) for spectrum in spectra], dtype=np.int64)
+        peak_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+        mz = np.concatenate([np.asarray(spectrum.get('mz', []), dtype=np.float64) for spectrum in spectra] or [np.empty(0)])
+        intensity = np.concatenate([np.asarray(spectrum.get('intensity', []), dtype=np.float64) for spectrum in spectra] or [np.empty(0)])
+        normalized = np.concatenate([np.asarray(spectrum['normalized intensity'], dtype=np.float64)
+                                     if 'normalized intensity' in spectrum else normalized_intensity(spectrum.get('intensity', []))
+                                     for spectrum in spectra] or [np.empty(0)])
+        metas = [json.dumps({key: value for key, value in spectrum.items() if key not in PEAK_ARRAYS},
+                            default=_json_default).encode('utf-8') for spectrum in spectra]
+        meta_offsets = np.concatenate(([0], np.cumsum([len(meta) for meta in metas]))).astype(np.int64)
+        meta = np.frombuffer(b''.join(metas), dtype=np.uint8)
+
+        arrays = [('precursormz', precursors[order]), ('peak_offsets', peak_offsets), ('mz', mz),
+                  ('intensity', intensity), ('normalized_intensity', normalized), ('meta_offsets', meta_offsets), ('meta', meta),
+                  ('source_order', source_order.astype(np.int64))]
+        write_array_file(output_file_path, CompiledLibrary.MAGIC, arrays, alignment=CompiledLibrary.ALIGNMENT)
+
+
+_WRITE_BLOCK = 1 << 20   # array elements written at once by write_array_file
+
+
+def write_array_file(file_path, magic, arrays, header=None, alignment=64):
+    """
+    Write named arrays after a magic string and a JSON header, each aligned so it can be viewed straight from a memory
+    map (the layout of the .dilib files). arrays is a list of (name, array); header holds extra JSON values.
+    """
+    header = dict(header or {}, arrays={})
+    header_size = 0
+    while True:   # reserve room for the header, grow it until the offsets it describes fit
+        position = len(magic) + 8 + header_size
+        for name, array in arrays:
+            position = -(-position // alignment) * alignment
+            header['arrays'][name] = [position, array.dtype.str, len(array)]
+            position += array.nbytes
+        header_bytes = json.dumps(header).encode('utf-8')
+        if len(header_bytes) <= header_size:
+            header_bytes = header_bytes.ljust(header_size)
+            break
+        header_size = len(header_bytes) + alignment
+
+    with open(file_path, 'wb') as file:
+        file.write(magic)
+        file.write(len(header_bytes).to_bytes(8, 'little'))
+        file.write(header_bytes)
+        for name, array in arrays:
+            file.write(b'\0' * (header['arrays'][name][0] - file.tell()))
+            # in blocks, an array may be a memory-mapped file larger than the memory
+            for start in range(0, len(array), _WRITE_BLOCK):
+                file.write(np.ascontiguousarray(array[start:start + _WRITE_BLOCK]).tobytes())
+
+
+def read_array_file(file_path, magic, kind='array') -> tuple:
+    """(header, {name: read-only array}) of a file written by write_array_file, the arrays are memory-mapped."""
+    with open(file_path, 'rb') as file:
+        if file.read(len(magic)) != magic:
+            raise ValueError(f"Not a {kind} file: {file_path}")
+        header_length = int.from_bytes(file.read(8), 'little')
+        header = json.loads(file.read(header_length).decode('utf-8'))
+    buffer = np.memmap(file_path, dtype=np.uint8, mode='r')
+    arrays = {name: np.asarray(buffer[offset:offset + length * np.dtype(dtype).itemsize]).view(dtype)
+              for name, (offset, dtype, length) in header['arrays'].items()}
+    return header, arrays
+
+
+def _json_default(value):
+    # numpy scalars in the metadata are stored as plain numbers
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
 def read_path(dir)-> list:
     return([os.path.join(dir, file) for file in os.listdir(dir)])
 
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''Micro-benchmarks of the identification kernels and of the full main_processing_function.
+
+    python benchmarks/run_benchmarks.py --spectra 20000 --scans 2000 --output results.json
+    python benchmarks/run_benchmarks.py --compare results.json
+
+The synthetic library and mzML file are generated once per size/seed into --data-dir and reused. Every benchmark
+is timed --repeat times (best and mean are reported) and run once more under tracemalloc for its peak Python memory.
+Results are saved as JSON together with the parameters and the versions, --compare prints the speed-up of the
+current run against a saved one.'''
+
+import os
+import sys
+import gc
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+
+_here = os.path.dirname(os.path.abspath(__file__))
+_root = os.path.dirname(_here)
+for _folder in (os.path.join(_root, 'Library loading'), os.path.join(_root, 'identification'), _here):
+    if _folder not in sys.path:
+        sys.path.insert(0, _folder)
+
+import numpy as np
+from synthetic_data import make_library, write_msp, write_mzml
+from LibraryHandling import LibraryLoadingStrategy, FragmentIndex
+from IdentificationMeta import (QueryTargetedSpectrum, match_spectrum, group_tuples_by_same_value, filter_tuples,
+                                cosine_similarity, batch_cosine_similarity)
+from querylibrarymatch import main_processing_function
+from candidate_cache import CandidateCache
+from scan_consolidation import ConsolidatedSpectra
+from scan_store import ScanStore, store_path
+
+
+def prepare_data(args) -> tuple:
+    os.makedirs(args.data_dir, exist_ok=True)
+    name = f"s{args.spectra}_p{args.library_peaks}_n{args.scans}_q{args.noise_peaks}_seed{args.seed}"
+    msp_path = os.path.join(args.data_dir, name + '.msp')
+    mzml_path = os.path.join(args.data_dir, name + '.mzML')
+    if not (os.path.exists(msp_path) and os.path.exists(mzml_path)):
+        library = make_library(args.spectra, args.library_peaks, args.seed)
+        write_msp(library, msp_path)
+        write_mzml(library, mzml_path, args.scans, args.noise_peaks, seed=args.seed)
+    return msp_path, mzml_path
+
+
+def measure(function, repeat=3) -> dict:
+    '''Best and mean wall time of `repeat` calls and the tracemalloc peak of one more call.'''
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'best_s': min(times), 'mean_s': sum(times) / len(times), 'repeat': repeat, 'peak_memory_bytes': peak}
+
+
+def kernel_inputs(analyzer, library, scans, args) -> list:
+    '''(scan, query spectrum, realtime library, target spectrum, matched peaks) of the MS2 scans.'''
+    inputs = []
+    for scan in scans:
+        query = analyzer.get_query_spectrum(scan)
+        if not query:
+            continue
+        realtime = analyzer.get_realtime_lib(scan, library, args.pimt)
+        target = analyzer.get_target_spectrum(scan, library, args.pimt, realtime)
+        inputs.append((scan, query, realtime, target, match_spectrum(query, target, args.ppm)))
+    return inputs
+
+
+def group_filter_cosine(query, target, args) -> list:
+    '''The per-candidate scoring of a scan that batch_cosine_similarity replaced.'''
+    cosine_scores = []
+    for matched_spectrum in group_tuples_by_same_value(match_spectrum(query, target, args.ppm), -1):
+        filtered_matches = filter_tuples(matched_spectrum)
+        if len(filtered_matches) >= args.min_matched_peaks:
+            cosine_scores.append((cosine_similarity([t[1] for t in filtered_matches], [t[4] for t in filtered_matches]),
+                                  filtered_matches))
+    return cosine_scores
+
+
+def run(args) -> dict:
+    msp_path, mzml_path = prepare_data(args)
+    results = {}
+
+    def record(name, function, calls, scans=None):
+        result = measure(function, args.repeat)
+        result['calls'] = calls
+        result['per_call_us'] = result['best_s'] / max(calls, 1) * 1e6
+        if scans is not None:
+            result['scans_per_second'] = scans / result['best_s'] if result['best_s'] > 0 else None
+        results[name] = result
+        print(f"{name:28s} {result['best_s'] * 1e3:10.2f} ms  {result['per_call_us']:10.2f} us/call  "
+              f"peak {result['peak_memory_bytes'] / 2**20:8.1f} MiB", flush=True)
+
+    record('load_library_msp', lambda: LibraryLoadingStrategy(msp_path).load_library(), 1)
+    library = LibraryLoadingStrategy(msp_path).load_library()
+
+    scans = range(args.scans)
+
+    def decode_scans():
+        reader = QueryTargetedSpectrum(mzml_path, args.intensity)
+        return [reader.get_query_spectrum(scan) for scan in scans]
+
+    record('decode_scans', decode_scans, args.scans, args.scans)
+
+    def decode_scans_pyteomics():
+        reader = QueryTargetedSpectrum(mzml_path, args.intensity, reader='pyteomics')
+        return [reader.get_query_spectrum(scan) for scan in scans]
+
+    record('decode_scans_pyteomics', decode_scans_pyteomics, args.scans, args.scans)
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        def convert_scan_store():
+            reader = QueryTargetedSpectrum(mzml_path)
+            return ScanStore.write(store_path(mzml_path, store_dir), (reader.read_scan(scan) for scan in scans))
+
+        record('convert_scan_store', convert_scan_store, 1)
+
+        def decode_scans_store():
+            reader = QueryTargetedSpectrum(mzml_path, args.intensity, scan_store=store_dir)
+            return [reader.get_query_spectrum(scan) for scan in scans]
+
+        record('decode_scans_store', decode_scans_store, args.scans, args.scans)
+
+    analyzer = QueryTargetedSpectrum(mzml_path, args.intensity, cache_size=args.scans + 1)
+    inputs = kernel_inputs(analyzer, library, scans, args)
+    ms2_scans = [item[0] for item in inputs]
+    groups = [group for item in inputs for group in group_tuples_by_same_value(item[4], -1)]
+    filtered = [filter_tuples(group) for group in groups]
+    vectors = [([t[1] for t in matches], [t[4] for t in matches]) for matches in filtered if matches]
+
+    record('get_realtime_lib', lambda: [analyzer.get_realtime_lib(scan, library, args.pimt) for scan in ms2_scans], len(ms2_scans))
+    record('get_target_spectrum', lambda: [analyzer.get_target_spectrum(item[0], library, args.pimt, item[2]) for item in inputs],
+           len(inputs))
+    record('get_target_arrays', lambda: [analyzer.get_target_arrays(item[0], library, args.pimt, item[2]) for item in inputs],
+           len(inputs))
+    record('build_fragment_index', lambda: FragmentIndex(library), 1)
+    fragment_index = FragmentIndex(library)
+    record('open_shortlist', lambda: [fragment_index.shortlist(analyzer.get_scan_record(scan).mz, args.ppm, 'ppm', args.open_top_k,
+                                                               args.min_matched_peaks) for scan in ms2_scans], len(ms2_scans))
+    candidate_cache = CandidateCache(library)
+    for scan in ms2_scans:
+        analyzer.get_candidates(scan, library, args.pimt, candidate_cache)
+    record('get_candidates_cached', lambda: [analyzer.get_candidates(scan, library, args.pimt, candidate_cache) for scan in ms2_scans],
+           len(ms2_scans))
+    record('match_spectrum', lambda: [match_spectrum(item[1], item[3], args.ppm) for item in inputs], len(inputs))
+    record('group_tuples_by_same_value', lambda: [group_tuples_by_same_value(item[4], -1) for item in inputs], len(inputs))
+    record('filter_tuples', lambda: [filter_tuples(group) for group in groups], len(groups))
+    record('cosine_similarity', lambda: [cosine_similarity(query, target) for query, target in vectors], len(vectors))
+    record('batch_cosine_similarity', lambda: [batch_cosine_similarity(item[1], item[3], args.ppm, args.min_matched_peaks)
+                                               for item in inputs], len(inputs))
+    # the scoring batch_cosine_similarity replaced, per scan, and the batch scoring of the TargetSpectrum arrays
+    # get_spectra passes in an identification run
+    record('match_group_filter_cosine', lambda: [group_filter_cosine(item[1], item[3], args) for item in inputs], len(inputs))
+    targets = [analyzer.get_target_arrays(item[0], library, args.pimt, item[2]) for item in inputs]
+    record('batch_cosine_similarity_arrays', lambda: [batch_cosine_similarity(item[1], target, args.ppm, args.min_matched_peaks)
+                                                      for item, target in zip(inputs, targets)], len(inputs))
+
+    with tempfile.TemporaryDirectory() as fig_path:
+        for workers in sorted(set([1] + args.workers)):
+            name = 'main_processing_function' + ('' if workers == 1 else f'_workers{workers}')
+            record(name, lambda: main_processing_function(
+                0, args.scans, QueryTargetedSpectrum(mzml_path, args.intensity), library, args.pimt, args.cosine,
+                args.ppm, args.min_matched_peaks, fig_path, workers=workers), args.scans, args.scans)
+        record('main_processing_function_prefetch', lambda: main_processing_function(
+            0, args.scans, QueryTargetedSpectrum(mzml_path, args.intensity), library, args.pimt, args.cosine,
+            args.ppm, args.min_matched_peaks, fig_path, prefetch_depth=args.prefetch), args.scans, args.scans)
+        record('main_processing_function_open', lambda: main_processing_function(
+            0, args.scans, QueryTargetedSpectrum(mzml_path, args.intensity), library, args.pimt, args.cosine,
+            args.ppm, args.min_matched_peaks, fig_path, search_mode='open', open_top_k=args.open_top_k), args.scans, args.scans)
+        record('main_processing_function_consolidated', lambda: main_processing_function(
+            0, args.scans, ConsolidatedSpectra(mzml_path, args.intensity, args.ppm, scan_range=(0, args.scans)), library,
+            args.pimt, args.cosine, args.ppm, args.min_matched_peaks, fig_path), args.scans, args.scans)
+    return results
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=_root, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    info = {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(), 'git_commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    try:
+        import resource   # not available on Windows
+        info['max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    except ImportError:
+        pass
+    return info
+
+
+def compare(current, baseline):
+    print(f"\n{'benchmark':28s} {'baseline ms':>12s} {'current ms':>12s} {'speed-up':>9s}")
+    for name, result in current['results'].items():
+        if name in baseline.get('results', {}):
+            before, after = baseline['results'][name]['best_s'], result['best_s']
+            print(f"{name:28s} {before * 1e3:12.2f} {after * 1e3:12.2f} {before / after if after else float('inf'):8.2f}x")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Benchmark the DImeta identification kernels on synthetic data.')
+    parser.add_argument('--spectra', type=int, default=5000, help='number of library spectra')
+    parser.add_argument('--library-peaks', type=int, default=10, help='mean number of peaks per library spectrum')
+    parser.add_argument('--scans', type=int, default=500, help='number of scans in the mzML file')
+    parser.add_argument('--noise-peaks', type=int, default=50, help='random peaks per scan besides the library fragments')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--ppm', type=float, default=10.0)
+    parser.add_argument('--pimt', type=float, default=0.5)
+    parser.add_argument('--intensity', type=float, default=3e3)
+    parser.add_argument('--cosine', type=float, default=0.7)
+    parser.add_argument('--min-matched-peaks', type=int, default=3)
+    parser.add_argument('--prefetch', type=int, default=64, help='read-ahead depth of the prefetch benchmark')
+    parser.add_argument('--open-top-k', type=int, default=50, help='candidates per scan of the open search benchmarks')
+    parser.add_argument('--workers', type=int, nargs='*', default=[], help='also time main_processing_function with these worker counts')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'dimeta_benchmark_data'))
+    parser.add_argument('--output', help='JSON file for the results')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    results = run(args)
+    report = {'environment': environment(), 'parameters': vars(args), 'results': results}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+        print(f"Saved results to {args.output}")
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            compare(report, json.load(file))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
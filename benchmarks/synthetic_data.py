@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''Deterministic synthetic inputs for the benchmarks: an MSP library and an indexed mzML run whose MS2 scans
+contain fragments of the library spectra in their isolation window plus random noise peaks.
+The same seed and sizes always give byte-identical files.'''
+
+import base64
+import zlib
+import numpy as np
+
+
+def make_library(n_spectra=5000, peaks_per_spectrum=10, seed=0, precursor_range=(100.0, 1000.0)) -> list:
+    '''List of (precursor m/z, m/z array, intensity array) tuples.'''
+    rng = np.random.default_rng(seed)
+    library = []
+    for _ in range(n_spectra):
+        precursor = round(float(rng.uniform(*precursor_range)), 4)
+        n_peaks = max(1, int(rng.poisson(peaks_per_spectrum)))
+        mz = np.sort(rng.uniform(50.0, precursor, n_peaks)).round(4)
+        intensity = rng.uniform(1.0, 1000.0, n_peaks).round(2)
+        library.append((precursor, mz, intensity))
+    return library
+
+
+def write_msp(library, path):
+    with open(path, 'w', encoding='utf-8') as file:
+        for number, (precursor, mz, intensity) in enumerate(library):
+            file.write(f"Name: Compound {number}\nPrecursorMZ: {precursor}\nPrecursor_type: [M+H]+\n"
+                       f"Formula: C{number}H2\nNum Peaks: {len(mz)}\n")
+            file.write(''.join(f"{m} {i}\n" for m, i in zip(mz.tolist(), intensity.tolist())))
+            file.write("\n")
+
+
+def _encode(array) -> str:
+    return base64.b64encode(zlib.compress(np.asarray(array, dtype='<f8').tobytes())).decode('ascii')
+
+
+def _spectrum_xml(index, ms_level, cv, window, mz, intensity) -> str:
+    parts = [f'<spectrum index="{index}" id="scan={index + 1}" defaultArrayLength="{len(mz)}">',
+             f'<cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="{ms_level}"/>',
+             f'<cvParam cvRef="MS" accession="MS:1001581" name="FAIMS compensation voltage" value="{cv}"/>']
+    if ms_level == 2:
+        parts.append('<precursorList count="1"><precursor><isolationWindow>'
+                     f'<cvParam cvRef="MS" accession="MS:1000827" name="isolation window target m/z" value="{window}"/>'
+                     '</isolationWindow></precursor></precursorList>')
+    parts.append('<binaryDataArrayList count="2">')
+    for array, accession, name in ((mz, 'MS:1000514', 'm/z array'), (intensity, 'MS:1000515', 'intensity array')):
+        encoded = _encode(array)
+        parts.append(f'<binaryDataArray encodedLength="{len(encoded)}">'
+                     '<cvParam cvRef="MS" accession="MS:1000523" name="64-bit float" value=""/>'
+                     '<cvParam cvRef="MS" accession="MS:1000574" name="zlib compression" value=""/>'
+                     f'<cvParam cvRef="MS" accession="{accession}" name="{name}" value=""/>'
+                     f'<binary>{encoded}</binary></binaryDataArray>')
+    parts.append('</binaryDataArrayList></spectrum>\n')
+    return ''.join(parts)
+
+
+def write_mzml(library, path, n_scans=1000, noise_peaks=50, candidates_per_scan=5, seed=0, window_width=1.0,
+               ms1_every=10, compensation_voltages=(-40.0, -60.0)):
+    '''Indexed mzML with n_scans spectra; every ms1_every-th scan is MS1, the others are MS2 scans of isolation
+    windows cycling over the library precursors. An MS2 scan holds the fragments (with a few ppm of m/z error and
+    scaled intensities) of up to candidates_per_scan library spectra inside its window and noise_peaks random peaks.'''
+    rng = np.random.default_rng(seed)
+    precursors = np.array([spectrum[0] for spectrum in library])
+    order = np.argsort(precursors)
+    # windows centred on library precursors spread over the whole range
+    centres = precursors[order][np.linspace(0, len(order) - 1, 64).astype(int)] if len(order) else np.array([500.0])
+    header = ('<?xml version="1.0" encoding="utf-8"?>\n'
+              '<indexedmzML xmlns="http://psi.hupo.org/ms/mzml">\n'
+              '<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">\n'
+              f'<run id="synthetic"><spectrumList count="{n_scans}">\n')
+    offsets = []
+    with open(path, 'wb') as file:
+        file.write(header.encode('ascii'))
+        for index in range(n_scans):
+            cv = compensation_voltages[index % len(compensation_voltages)]
+            if ms1_every and index % ms1_every == 0:
+                ms_level, window = 1, None
+                mz = np.sort(rng.uniform(100.0, 1000.0, noise_peaks))
+                intensity = rng.uniform(1e3, 1e5, noise_peaks)
+            else:
+                ms_level = 2
+                window = round(float(centres[index % len(centres)]), 4)
+                low, high = np.searchsorted(precursors[order], [window - window_width / 2, window + window_width / 2])
+                chosen = order[low:high][:candidates_per_scan]
+                mz_parts, intensity_parts = [rng.uniform(50.0, window, noise_peaks)], [rng.uniform(100.0, 2e4, noise_peaks)]
+                for number in chosen.tolist():
+                    _, fragment_mz, fragment_intensity = library[number]
+                    mz_parts.append(fragment_mz * (1 + rng.normal(0, 3e-6, len(fragment_mz))))
+                    intensity_parts.append(fragment_intensity * rng.uniform(5, 50))
+                mz, intensity = np.concatenate(mz_parts), np.concatenate(intensity_parts)
+                peak_order = np.argsort(mz, kind='stable')
+                mz, intensity = mz[peak_order], intensity[peak_order]
+            offsets.append(file.tell())
+            file.write(_spectrum_xml(index, ms_level, cv, window, mz, intensity).encode('ascii'))
+        file.write(b'</spectrumList></run>\n</mzML>\n')
+        index_offset = file.tell()
+        index_xml = ['<indexList count="1">\n<index name="spectrum">\n']
+        index_xml += [f'<offset idRef="scan={index + 1}">{offset}</offset>\n' for index, offset in enumerate(offsets)]
+        index_xml.append('</index>\n</indexList>\n')
+        file.write(''.join(index_xml).encode('ascii'))
+        file.write(f'<indexListOffset>{index_offset}</indexListOffset>\n</indexedmzML>\n'.encode('ascii'))
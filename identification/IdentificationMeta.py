@@ -2,11 +2,26 @@
 import pyteomics.mzml
 from pyteomics import mzxml, mzml
 import os
+import math
 import pandas as pd
 import glob
 import numpy as np
 import heapq
-from collections import defaultdict
+import queue
+import threading
+from contextlib import contextmanager
+from collections import defaultdict, namedtuple, OrderedDict
+
+from mzml_reader import DirectMzMLReader, UnsupportedSpectrum
+
+READERS = ('direct', 'pyteomics')
+
+
+# one decoded scan: intensity-filtered MS2 peak arrays plus the header values the identification needs
+ScanRecord = namedtuple('ScanRecord', ['ms_level', 'mz', 'intensity', 'precursor', 'compensation_voltage'])
+
+# the peaks of all library candidates of a scan sorted by m/z, label is the position of the candidate in the realtime library
+TargetSpectrum = namedtuple('TargetSpectrum', ['mz', 'intensity', 'label'])
 
 
 class QueryTargetedSpectrum:
@@ -15,174 +30,395 @@ class QueryTargetedSpectrum:
     read how many scans in a specific input file,
     label all spectra in the real-time library and name it as target spectrum"""
 
-    def __init__(self, filepath,intensity_threshold=3000):
+    def __init__(self, filepath,intensity_threshold=3000, cache_size=8, reader='direct', scan_store=None):
         
+        """reader='direct' decodes mzML scans with a DirectMzMLReader and falls back to pyteomics for the scans it does not
+        handle, reader='pyteomics' decodes every scan with pyteomics. mzXML files are always read with pyteomics.
+        With a scan_store folder the scans are read from the ScanStore of the file in that folder, which the first
+        reader of the file converts; the XML is then not opened at all."""
+        if reader not in READERS:
+            raise ValueError(f"Unsupported reader: {reader}")
         self.filepath = filepath
         _, file_extension = os.path.splitext(filepath)
         self.intensity_threshold = intensity_threshold
+        self.cache_size = cache_size
+        self.reader = reader
+        self.scan_store = scan_store
+        self._scan_cache = OrderedDict()   # scan -> ScanRecord, least recently used first
+        self._prefetcher = None
+        self._reader_lock = threading.Lock()   # the reader thread of prefetching and get_scan_record share the reader
+        self._tmp = None
+        self._direct = None
+        self._store = None
         
         if file_extension.lower() == '.mzml':
             self.file_type = 'mzml'
-            self.tmp = pyteomics.mzml.read(filepath, use_index=True)
         elif file_extension.lower() == '.mzxml':
             self.file_type = 'mzxml'
-            self.tmp = pyteomics.mzxml.read(filepath, use_index=True)
         else:
             raise ValueError(f"Unsupported file format: {file_extension}")
-
-            
-    def get_query_spectrum(self, scan) -> list:
-        if self.file_type == 'mzml':
-            return self._get_query_spectrum_mzml(scan)
-        elif self.file_type == 'mzxml':
-            return self._get_query_spectrum_mzxml(scan)
-    
-    def _get_query_spectrum_mzml(self, scan) -> list:
-        # Implementation for mzML files
-        ms_level = self.tmp.get_by_index(scan)['ms level']
-        mzs, intens, label = [], [], []
-
-        if ms_level == 2:
-            mz = self.tmp.get_by_index(scan)['m/z array']
-            inten = self.tmp.get_by_index(scan)['intensity array']
-            filter_mz_inten = [(x, y) for x, y in zip(mz, inten) if y > self.intensity_threshold]   # filter the input spectrum intensity 
-            if filter_mz_inten:
-                mzs, intens = zip(*filter_mz_inten)
-            else:
-                mzs, intens = [], []
-            label = [str(scan)] * len(mzs)
+        if scan_store is not None:
+            from scan_store import store_path   # needs LibraryHandling, which plain XML reading does not
+            self._store = self._open_store(store_path(filepath, scan_store))
         else:
-            label = []
-
-        return list(zip(mzs, intens, label))
-
-    def _get_query_spectrum_mzxml(self, scan) -> list:
-        ms_level = self.tmp[scan]['msLevel']
-        mzs, intens, label = [], [], []
-
+            self._open_readers()
+
+    def _open_readers(self):
+        if self.file_type == 'mzml' and self.reader == 'direct':
+            try:
+                self._direct = DirectMzMLReader(self.filepath)
+            except UnsupportedSpectrum:
+                self._direct = None
+        if self._direct is None:
+            self._tmp = self._open_pyteomics()
+
+    def _open_pyteomics(self):
+        if self.file_type == 'mzml':
+            return pyteomics.mzml.read(self.filepath, use_index=True)
+        return pyteomics.mzxml.read(self.filepath, use_index=True)
+
+    def _open_store(self, path):
+        """The ScanStore at path, converted from the XML when it does not exist yet or can not be read."""
+        from scan_store import ScanStore
+        if os.path.exists(path):
+            try:
+                return ScanStore(path)
+            except (ValueError, KeyError, OSError):
+                pass
+        self._open_readers()
+        ScanStore.write(path, (self.read_scan(scan) for scan in range(self.get_scans())), self.filepath)
+        return ScanStore(path)
+
+    @property
+    def tmp(self):
+        """The indexed pyteomics reader, opened on first use when scans are read directly (indexing takes a while)."""
+        if self._tmp is None:
+            self._tmp = self._open_pyteomics()
+        return self._tmp
+
+    def settings(self) -> dict:
+        '''Constructor arguments of an equivalent reader, e.g. for a worker process to open the same file.'''
+        return {'filepath': self.filepath, 'intensity_threshold': self.intensity_threshold, 'cache_size': self.cache_size,
+                'reader': self.reader, 'scan_store': self.scan_store}
+
+    def close(self):
+        """Release the memory map, file handles and scan store of the readers; closing twice does nothing."""
+        with self._reader_lock:
+            if self._direct is not None:
+                self._direct.close()
+                self._direct = None
+            if self._tmp is not None:
+                self._tmp.__exit__(None, None, None)   # the pyteomics readers close their file as context managers
+                self._tmp = None
+            self._store = None
+            self._scan_cache.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+            
+    def get_scan_record(self, scan) -> ScanRecord:
+        """Decode a scan once and share the record between all accessors through a small LRU cache."""
+        record = self._scan_cache.get(scan)
+        if record is not None:
+            self._scan_cache.move_to_end(scan)
+            return record
+        if self._prefetcher is not None:
+            record = self._prefetcher.take(scan)
+        if record is None:
+            record = self.decode_scan(scan)
+        self._scan_cache[scan] = record
+        if len(self._scan_cache) > self.cache_size:
+            self._scan_cache.popitem(last=False)
+        return record
+
+    def decode_scan(self, scan) -> ScanRecord:
+        """Decode a scan without the cache."""
+        return self._make_record(*self.read_scan(scan))
+
+    def read_scan(self, scan) -> tuple:
+        """(ms level, precursor m/z, compensation voltage, m/z array, intensity array) of a scan as stored in the file,
+        without the intensity filter; the arrays are only read for MS2 scans (None otherwise)."""
+        if self._store is not None:
+            return self._store.scan(scan)
+        with self._reader_lock:
+            if self.file_type == 'mzml':
+                return self._read_scan_mzml(scan)
+            return self._read_scan_mzxml(scan)
+
+    def decode_order(self, lowerscan, higherscan) -> list:
+        """The scans get_scan_record decodes, in order, when the scans of range(lowerscan, higherscan) are identified."""
+        return list(range(lowerscan, higherscan))
+
+    @contextmanager
+    def prefetching(self, lowerscan, higherscan, depth=64):
+        '''
+        While the block runs, a reader thread decodes up to `depth` scans of decode_order ahead and get_scan_record
+        takes them from its queue, so decoding overlaps with scoring. The thread uses this reader (behind a lock),
+        opening a second one would index the file again. An error of the reader thread is raised by get_scan_record.
+        Nested calls, depth 0 and scans read from a scan store (nothing to decode) do nothing.
+        '''
+        if not depth or self._prefetcher is not None or self._store is not None:
+            yield
+            return
+        self._prefetcher = ScanPrefetcher(self, self.decode_order(lowerscan, higherscan), depth)
+        try:
+            yield
+        finally:
+            self._prefetcher.close()
+            self._prefetcher = None
+
+    def _read_scan_mzml(self, scan) -> tuple:
+        if self._direct is not None:
+            try:
+                return self._direct.spectrum(scan, array_levels=(2,))
+            except UnsupportedSpectrum:
+                pass
+        return self._arrays(self.tmp.get_by_index(scan), self._header_mzml)
+
+    def _read_scan_mzxml(self, scan) -> tuple:
+        return self._arrays(self.tmp.get_by_index(scan), self._header_mzxml)
+
+    @staticmethod
+    def _arrays(spectrum, header) -> tuple:
+        ms_level, precursor, comp_vol = header(spectrum)
+        if ms_level != 2:
+            return ms_level, precursor, comp_vol, None, None
+        return ms_level, precursor, comp_vol, spectrum['m/z array'], spectrum['intensity array']
+
+    @staticmethod
+    def _header_mzml(spectrum) -> tuple:
+        precursor = float(spectrum['precursorList']['precursor'][0]['isolationWindow']['isolation window target m/z']
+                          if 'precursorList' in spectrum else 'Nan')
+        comp_vol = float(spectrum['FAIMS compensation voltage'] if 'FAIMS compensation voltage' in spectrum else 'Nan')
+        return spectrum['ms level'], precursor, comp_vol
+
+    @staticmethod
+    def _header_mzxml(spectrum) -> tuple:
+        precursor = float(spectrum['precursorMz'][0]['precursorMz'] if 'precursorMz' in spectrum else 'Nan')
+        comp_vol = float(spectrum['compensationVoltage'] if 'compensationVoltage' in spectrum else 'Nan')
+        return spectrum['msLevel'], precursor, comp_vol
+
+    def _make_record(self, ms_level, precursor, comp_vol, mz, inten) -> ScanRecord:
         if ms_level == 2:
-            mz = self.tmp[scan]['m/z array']
-            inten = self.tmp[scan]['intensity array']
-            filter_mz_inten = [(x, y) for x, y in zip(mz, inten) if y > self.intensity_threshold]  # filter the input spectrum intensity 
-            if filter_mz_inten:
-                mzs, intens = zip(*filter_mz_inten)
-            else:
-                mzs, intens = [], []
-            label = [str(scan)] * len(mzs)
+            mz = np.asarray(mz)
+            inten = np.asarray(inten)
+            keep = inten > self.intensity_threshold   # filter the input spectrum intensity 
+            mz, inten = mz[keep], inten[keep]
         else:
-            label = []
+            mz, inten = np.empty(0), np.empty(0)
+        return ScanRecord(ms_level, mz, inten, precursor, comp_vol)
 
-        return list(zip(mzs, intens, label))
+    def get_query_spectrum(self, scan) -> list:
+        record = self.get_scan_record(scan)
+        if record.ms_level != 2:
+            return []
+        # Python floats, the scoring compares and sums the peaks one by one, much slower on numpy scalars
+        return list(zip(record.mz.tolist(), record.intensity.tolist(), [str(scan)] * len(record.mz)))
 
-    
     def get_realtime_lib(self, scan, library, PIMT) -> list:
-        if self.file_type == 'mzml':
-            return self._get_realtime_lib_mzml(scan, library, PIMT)
-        elif self.file_type == 'mzxml':
-            return self._get_realtime_lib_mzxml(scan, library, PIMT)
-            
-
-    def _get_realtime_lib_mzml(self, scan, library, PIMT) -> list:
-        
-        ms_level = self.tmp.get_by_index(scan)['ms level']
-        
-        realtime_lib = []
-        
-        if ms_level == 2:
-            precursor = float(self.tmp.get_by_index(scan)['precursorList']['precursor'][0]['isolationWindow']['isolation window target m/z'])
-            realtime_lib = [item for item in library if (precursor - PIMT < float(item['precursormz']) < precursor + PIMT)]
-        
-        return realtime_lib
-
-    def _get_realtime_lib_mzxml(self, scan, library, PIMT) -> list:
         
         '''Library should be reformatted by the DIMA LibraryReformatted class and define the maximum peaks in each library mass spectrum,
         PIMT: Precursor Ion Mass Tolerance, defines mass tolerance for MS1 '''
         
-        ms_level = self.tmp[scan]['msLevel']
-        
+        record = self.get_scan_record(scan)
         realtime_lib = []
-        if ms_level == 2:
-            precursor = float(self.tmp[scan]['precursorMz'][0]['precursorMz'])
-            realtime_lib = [item for item in library if (precursor - PIMT < float(item['precursormz']) < precursor + PIMT)]
+        if record.ms_level == 2:
+            realtime_lib = search_library(library, record.precursor, PIMT)
         
         return realtime_lib
+
+    def get_candidates(self, scan, library, PIMT, candidate_cache=None) -> tuple:
+        '''(realtime library, TargetSpectrum) of a scan, taken from a CandidateCache of the library when one is given.'''
+        record = self.get_scan_record(scan)
+        if candidate_cache is None or record.ms_level != 2 or np.isnan(record.precursor):
+            realtime_lib = self.get_realtime_lib(scan, library, PIMT)
+            return realtime_lib, target_arrays(realtime_lib)
+        return candidate_cache.candidates(record.precursor, PIMT)
+
+    def get_open_lib(self, scan, library, fragment_index, tolerance, unit='ppm', top_k=50, min_shared=1) -> list:
+        '''Precursor-agnostic candidates for the open search: the top_k spectra of the whole library sharing the most
+        fragment peaks (at least min_shared) with the scan, looked up in the FragmentIndex of the library.'''
+        record = self.get_scan_record(scan)
+        if record.ms_level != 2 or len(record.mz) == 0:
+            return []
+        return [library[i] for i in fragment_index.shortlist(record.mz, tolerance, unit, top_k, min_shared).tolist()]
     
     
-    def get_scans(self):
-        if self.file_type == 'mzml':
-            return self._countscans_mzml()
-        elif self.file_type == 'mzxml':
-            return self._countscans_mzxml()
-    
-    def _countscans_mzml(self)->int:
-        # Initialize a counter
-        scan_count = 0
-        # Read the .mzML file and iterate over its contents
-        for spectrum in self.tmp:
-        # Increment the counter for each spectrum found
-            scan_count += 1
-        return scan_count
-
-    def _countscans_mzxml(self)->int:
-        # Initialize a counter
-        scan_count = 0
-        # Read the .mzXML file and iterate over its contents
-        for spectrum in self.tmp:
-        # Increment the counter for each spectrum found
-            scan_count += 1
-        return scan_count
-    
-    
-    def get_precusorMZ(self,scan):
+    def get_scans(self)->int:
+        """Number of spectra in the file, taken from the offset index of the reader without decoding any spectrum."""
+        if self._store is not None:
+            return len(self._store)
+        if self._direct is not None:
+            return len(self._direct)
+        try:
+            return len(self.tmp)
+        except (TypeError, AttributeError):
+            # no offset index available, count the spectra with a header-only pass
+            return len(self.get_scan_table())
+
+    def get_scan_table(self) -> pd.DataFrame:
+        """
+        Read ms level, precursor m/z and compensation voltage of every scan in one pass over the file
+        with binary array decoding turned off (with the direct reader when it handles every scan).
+        Returns a DataFrame indexed by scan number with columns 'ms_level', 'precursor' and 'compensation_voltage'.
+        """
+        if self._store is not None:
+            return self._store.scan_table()
+        if self._direct is not None:
+            try:
+                with self._reader_lock:
+                    rows = [self._direct.spectrum(scan, array_levels=())[:3] for scan in range(len(self._direct))]
+                return pd.DataFrame(rows, columns=['ms_level', 'precursor', 'compensation_voltage'])
+            except UnsupportedSpectrum:
+                pass
         if self.file_type == 'mzml':
-            return self._getprecusor_mzml(scan)
+            reader, header = pyteomics.mzml.read(self.filepath, decode_binary=False), self._header_mzml
         elif self.file_type == 'mzxml':
-            return self._getprecusor_mzxml(scan)
+            reader, header = pyteomics.mzxml.read(self.filepath, decode_binary=False), self._header_mzxml
+        with reader:
+            rows = [header(spectrum) for spectrum in reader]
+        return pd.DataFrame(rows, columns=['ms_level', 'precursor', 'compensation_voltage'])
     
-    def _getprecusor_mzml(self,scan)->float:
-        # Initialize a counter
-        precusormz= float(self.tmp.get_by_index(scan)['precursorList']['precursor'][0]['isolationWindow']['isolation window target m/z']
-                if 'precursorList' in self.tmp.get_by_index(scan) else 'Nan')
-        return precusormz
-
-    def _getprecusor_mzxml(self,scan)->float:
-        
-        precusormz= float(self.tmp.get_by_index(scan)['precursorMz'][0]['precursorMz']
-                if 'precursorMz' in self.tmp.get_by_index(scan) else 'Nan')
-        return precusormz
     
-    def get_compensation_voltage(self,scan):
-        
-        if self.file_type == 'mzml':
-            return self._get_compensation_voltage_mzml(scan)
-        
-        elif self.file_type == 'mzxml':
-            return self._get_compensation_voltage_mzxml(scan)
-    
-    def _get_compensation_voltage_mzml(self,scan)->str:
-        
-        comp_vol = float(self.tmp.get_by_index(scan)['FAIMS compensation voltage'] if 'FAIMS compensation voltage' in self.tmp.get_by_index(scan) else 'Nan')
-        return comp_vol
-
-    def _get_compensation_voltage_mzxml(self,scan)->str:
-        
-        comp_vol= float(self.tmp.get_by_index(scan)['compensationVoltage'] if 'compensationVoltage' in self.tmp.get_by_index(scan) else 'Nan')
-        return comp_vol
+    def get_precusorMZ(self,scan)->float:
+        return self.get_scan_record(scan).precursor
     
+    def get_compensation_voltage(self,scan)->float:
+        return self.get_scan_record(scan).compensation_voltage
       
-    def get_target_spectrum(self, scan, library, PIMT) -> list:
-        # This method can remain largely unchanged, as it calls get_realtime_lib
-        real = self.get_realtime_lib(scan, library, PIMT)
+    def get_target_spectrum(self, scan, library, PIMT, realtime_lib=None) -> list:
+        # pass the realtime library of the scan when it is already known to avoid selecting it twice
+        real = self.get_realtime_lib(scan, library, PIMT) if realtime_lib is None else realtime_lib
         target_spectrum = []
         for i in range(len(real)):
-            target_spectrum.extend(list(zip(real[i]['mz'], real[i]['intensity'], [str(i)] * len(real[i]['mz']))))
+            target_spectrum.extend(list(zip(np.asarray(real[i]['mz']).tolist(), np.asarray(real[i]['intensity']).tolist(),
+                                            [str(i)] * len(real[i]['mz']))))
         return sorted(target_spectrum, key=lambda x: x[0])
 
+    def get_target_arrays(self, scan, library, PIMT, realtime_lib=None) -> TargetSpectrum:
+        '''The target spectrum of get_target_spectrum as arrays, in the same order, without building a tuple per peak.'''
+        real = self.get_realtime_lib(scan, library, PIMT) if realtime_lib is None else realtime_lib
+        return target_arrays(real)
+
 
     
     
 
+class ScanPrefetcher:
+
+    '''Decodes the scans of `order` with reader.decode_scan in a daemon thread into a queue of at most `depth` ScanRecords.
+
+    The queue gives backpressure: the thread waits while the consumer is `depth` scans behind. take() returns the
+    records in order; scans the consumer never asks for are dropped. close() stops the thread.'''
+
+    _END = object()
+
+    def __init__(self, reader, order, depth=64):
+        self.reader = reader
+        self.order = list(order)
+        self.position = {}
+        for number, scan in enumerate(self.order):
+            self.position.setdefault(scan, number)
+        self.queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._pending = None
+        self._finished = False
+        self._thread = threading.Thread(target=self._run, name='scan-prefetch', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            for scan in self.order:
+                if self._stop.is_set():
+                    return
+                self._put((scan, self.reader.decode_scan(scan)))
+            self._put((self._END, None))
+        except Exception as e:
+            self._put((self._END, e))
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def take(self, scan):
+        '''The prefetched record of scan, None when the scan is not (or no longer) ahead in the queue.'''
+        wanted = self.position.get(scan)
+        while wanted is not None and not self._finished:
+            if self._pending is None:
+                self._pending = self.queue.get()
+            prefetched, record = self._pending
+            if prefetched is self._END:
+                self._finished = True
+                if record is not None:
+                    raise record
+                return None
+            if prefetched == scan:
+                self._pending = None
+                return record
+            if self.position[prefetched] > wanted:
+                return None     # asked out of order, the queued scans are kept for later
+            self._pending = None   # a scan that was skipped
+        return None
+
+    def close(self):
+        self._stop.set()
+        while self._thread.is_alive():
+            try:   # unblock a waiting put
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._thread.join()
+
+
+def search_library(library, precursor, PIMT) -> list:
+    """
+    Select the library spectra whose precursor m/z is strictly within precursor +/- PIMT.
+    A PrecursorIndexedLibrary (as returned by LibraryLoadingStrategy.load_library) is searched by binary search,
+    a plain list of spectrum dicts falls back to a linear scan. Spectra without a usable precursor m/z are never
+    selected, either way.
+    """
+    if hasattr(library, 'search'):
+        return library.search(precursor, PIMT)
+    return [item for item in library if (precursor - PIMT < _precursor_mz(item) < precursor + PIMT)]
+
+def _precursor_mz(spectrum) -> float:
+    """The precursor m/z of a library spectrum, NaN when it is missing or not a number (as PrecursorIndexedLibrary)."""
+    try:
+        return float(spectrum['precursormz'])
+    except (KeyError, TypeError, ValueError):
+        return float('nan')
+
+def target_arrays(realtime_lib) -> TargetSpectrum:
+    """
+    Concatenate the peak arrays of the candidates and sort them by m/z with a stable sort, so equal m/z values keep
+    the candidate order just like get_target_spectrum. Spectra reformatted by LibraryReformat are already sorted by m/z,
+    which the stable sort (a merge of sorted runs) takes advantage of.
+    """
+    counts = [len(spectrum['mz']) for spectrum in realtime_lib]
+    if sum(counts) == 0:
+        return TargetSpectrum(np.empty(0), np.empty(0), np.empty(0, dtype=np.intp))
+    mz = np.concatenate([np.asarray(spectrum['mz']) for spectrum in realtime_lib])
+    intensity = np.concatenate([np.asarray(spectrum['intensity']) for spectrum in realtime_lib])
+    label = np.repeat(np.arange(len(realtime_lib)), counts)
+    if np.any(mz[1:] < mz[:-1]):
+        order = np.argsort(mz, kind='stable')
+        mz, intensity, label = mz[order], intensity[order], label[order]
+    return TargetSpectrum(mz, intensity, label)
+
+def search_library_positions(library, precursor, PIMT) -> np.ndarray:
+    """The library positions of the spectra search_library selects, in the order search_library returns them."""
+    if hasattr(library, 'search_positions'):
+        return library.search_positions(precursor, PIMT)
+    return np.array([i for i, item in enumerate(library) if precursor - PIMT < _precursor_mz(item) < precursor + PIMT],
+                    dtype=np.intp)
+
 def within_tolerance_ppm(mz1, mz2, ppm):
     """ Check if mz2 is within the "ppm" tolerance of mz1. """
     tolerance = mz1 * ppm / 1e6
@@ -193,24 +429,201 @@ def within_tolerance_da(mz1, mz2, da):
     tolerance = da
     return abs(mz1 - mz2) <= tolerance
 
-def match_spectrum(query_spectrum, target_spectrum, ppm_tolerance):
+def _peak_column(spectrum, position) -> np.ndarray:
+    """Collect one value (m/z or intensity) of every peak tuple into a float array."""
+    return np.fromiter((peak[position] for peak in spectrum), dtype=np.float64, count=len(spectrum))
+
+def match_peak_indices(query_mz, target_mz, tolerance, unit='ppm'):
+    """
+    Find every (query peak, target peak) pair within the given tolerance with a binary-search window per query peak.
+
+    :param query_mz: Array of query m/z values.
+    :param target_mz: Array of target m/z values, sorted in ascending order.
+    :param tolerance: Fragment mass tolerance, in ppm of the query m/z or in Da depending on unit.
+    :param unit: 'ppm' or 'da'.
+    :return: Two index arrays (query_index, target_index), ordered by query peak and then by target peak.
     """
-    Match a spectrum to a query spectrum within a given PPM tolerance and return the matched peaks along with their three-dimensional values.
+    query_mz = np.asarray(query_mz, dtype=np.float64)
+    target_mz = np.asarray(target_mz, dtype=np.float64)
+    if unit.lower() == 'ppm':
+        tolerances = query_mz * tolerance / 1e6       # same arithmetic as within_tolerance_ppm
+    elif unit.lower() == 'da':
+        tolerances = np.full(query_mz.shape, float(tolerance))
+    else:
+        raise ValueError(f"Unsupported tolerance unit: {unit}")
+
+    # slightly widened windows, the exact tolerance test below decides which pairs are kept
+    slack = 1e-9 * (1.0 + np.abs(query_mz))
+    starts = np.searchsorted(target_mz, query_mz - tolerances - slack, side='left')
+    stops = np.searchsorted(target_mz, query_mz + tolerances + slack, side='right')
+    counts = stops - starts
+    total = int(counts.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+    query_index = np.repeat(np.arange(len(query_mz)), counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    target_index = np.repeat(starts, counts) + offsets
+    keep = np.abs(query_mz[query_index] - target_mz[target_index]) <= tolerances[query_index]
+    return query_index[keep], target_index[keep]
+
+def match_spectrum(query_spectrum, target_spectrum, tolerance, unit='ppm'):
+    """
+    Match a spectrum to a query spectrum within a given PPM (or Da) tolerance and return the matched peaks along with their three-dimensional values.
     
     :param query_spectrum: List of (m/z, intensity, value) tuples for the query spectrum.
-    :param target_spectrum: List of (m/z, intensity, value) tuples for the target spectrum.
-    :param ppm_tolerance: PPM tolerance for matching.
+    :param target_spectrum: List of (m/z, intensity, value) tuples for the target spectrum, ideally sorted by m/z as returned by get_target_spectrum.
+    :param tolerance: PPM tolerance for matching, or Da tolerance when unit is 'da'.
+    :param unit: 'ppm' (within_tolerance_ppm) or 'da' (within_tolerance_da).
     :return: Matched peaks as a list of tuples (query_mz, query_intensity, query_value, target_mz, target_intensity, target_value).
     """
-    matches = []
-    for query_mz, query_intensity, query_label in query_spectrum:
-        for target_mz, target_intensity, target_label in target_spectrum:
-            if within_tolerance_ppm(query_mz, target_mz, ppm_tolerance):
-                matches.append((query_mz, query_intensity, query_label,target_mz, target_intensity, target_label))
-                #break  # Assuming only one match per query peak
-            #if within_tolerance_da(query_mz, target_mz, da):
-                #matches.append((query_mz, query_intensity, query_label, target_mz, target_intensity, target_label)) 
-    return matches
+    if not query_spectrum or not target_spectrum:
+        return []
+    query_index, target_index = _match_spectrum_indices(_peak_column(query_spectrum, 0), _peak_column(target_spectrum, 0), tolerance, unit)
+    return [(*query_spectrum[i], *target_spectrum[j]) for i, j in zip(query_index.tolist(), target_index.tolist())]
+
+def _match_spectrum_indices(query_mz, target_mz, tolerance, unit='ppm'):
+    """match_peak_indices for a target spectrum that may not be sorted, pairs reported in the original target order."""
+    order = None
+    if np.any(np.diff(target_mz) < 0):
+        order = np.argsort(target_mz, kind='stable')
+        target_mz = target_mz[order]
+
+    query_index, target_index = match_peak_indices(query_mz, target_mz, tolerance, unit)
+    if order is not None:
+        # report the pairs in the original target order for each query peak
+        target_index = order[target_index]
+        resort = np.lexsort((target_index, query_index))
+        query_index, target_index = query_index[resort], target_index[resort]
+    return query_index, target_index
+
+def _group_starts(*keys) -> np.ndarray:
+    """Start positions of the runs of equal keys in already sorted key arrays."""
+    changed = np.zeros(len(keys[0]), dtype=bool)
+    changed[0] = True
+    for key in keys:
+        changed[1:] |= key[1:] != key[:-1]
+    return np.flatnonzero(changed)
+
+# candidates with matched peak pairs below which the group/filter path beats the fixed cost of the sorts of the batch path
+SMALL_WINDOW = 8
+
+def batch_cosine_similarity(query_spectrum, target_spectrum, tolerance, minmatchedpeaks, unit='ppm', pair_counts=None) -> list:
+    """
+    Score all library candidates of a scan at once.
+
+    The matched peak pairs of every candidate are kept as one sparse (candidate, pair) table, the filter_tuples rule
+    (one query peak per library fragment and one library fragment per query peak, highest query intensity wins) is applied
+    with sorts over that table, and the dot products, norms, matched-peak counts and MACC scores of all candidates
+    are computed with segmented sums. Scans with fewer than SMALL_WINDOW candidates having matched peak pairs take the
+    group_tuples_by_same_value and filter_tuples path on the matched pairs instead, which is faster for them.
+
+    :param query_spectrum: List of (m/z, intensity, label) tuples for the query spectrum.
+    :param target_spectrum: List of (m/z, intensity, label) tuples of all candidates, as returned by get_target_spectrum,
+                            or the TargetSpectrum arrays of get_target_arrays.
+    :param tolerance: Fragment tolerance, in ppm or Da depending on unit.
+    :param minmatchedpeaks: Minimum number of matched peaks for a candidate to be scored.
+    :param pair_counts: Optional list, the number of peak pairs within the tolerance (before the filter_tuples and
+                        minmatchedpeaks filters) is appended to it.
+    :return: List of (cosine_score, filtered_matches, macc_score) tuples, in the same order and with the same
+             matched peak tuples as match_spectrum, group_tuples_by_same_value and filter_tuples give.
+    """
+    if pair_counts is None:
+        pair_counts = []
+    if not query_spectrum or len(target_spectrum) == 0:
+        pair_counts.append(0)
+        return []
+    arrays = isinstance(target_spectrum, TargetSpectrum)
+    target_mz = np.asarray(target_spectrum.mz, dtype=np.float64) if arrays else _peak_column(target_spectrum, 0)
+    query_mz = _peak_column(query_spectrum, 0)
+
+    query_index, target_index = _match_spectrum_indices(query_mz, target_mz, tolerance, unit)
+    pair_counts.append(len(query_index))
+    if len(query_index) == 0:
+        return []
+    # the work of both paths grows with the candidates having matched pairs, not with all candidates of the window
+    if arrays:
+        matched_labels = len(set(np.asarray(target_spectrum.label)[target_index].tolist()))
+    else:
+        matched_labels = len({target_spectrum[j][2] for j in target_index.tolist()})
+    if matched_labels < SMALL_WINDOW:
+        return _small_window_cosine_similarity(query_spectrum, target_spectrum, query_index, target_index, minmatchedpeaks)
+    query_intensity = _peak_column(query_spectrum, 1)
+    if arrays:
+        target_intensity = np.asarray(target_spectrum.intensity, dtype=np.float64)
+        target_label = np.asarray(target_spectrum.label, dtype=np.intp)
+        label_count = int(np.max(target_label)) + 1
+    else:
+        target_intensity = _peak_column(target_spectrum, 1)
+        codes = {}
+        target_label = np.fromiter((codes.setdefault(peak[2], len(codes)) for peak in target_spectrum),
+                                   dtype=np.intp, count=len(target_spectrum))
+        label_count = len(codes)
+    position = np.arange(len(query_index))
+    label = target_label[target_index]
+    matched_query_mz, matched_query_intensity = query_mz[query_index], query_intensity[query_index]
+    matched_target_mz = target_mz[target_index]
+
+    # filter_tuples step 1: per candidate and library m/z keep the pair with the highest query intensity (first one on ties)
+    order = np.lexsort((position, -matched_query_intensity, matched_target_mz, label))
+    starts = _group_starts(label[order], matched_target_mz[order])
+    kept = order[starts]
+    first_seen = np.minimum.reduceat(position[order], starts)
+
+    # filter_tuples step 2: per candidate and query m/z keep the highest query intensity (earliest kept pair on ties)
+    order = np.lexsort((first_seen, -matched_query_intensity[kept], matched_query_mz[kept], label[kept]))
+    starts = _group_starts(label[kept][order], matched_query_mz[kept][order])
+    first_seen = np.minimum.reduceat(first_seen[order], starts)
+    kept = kept[order[starts]]
+
+    # candidates in order of their first matched pair, pairs in the order filter_tuples returns them
+    label_first_seen = np.full(label_count, len(position))
+    np.minimum.at(label_first_seen, label, position)
+    order = np.lexsort((first_seen, label_first_seen[label[kept]]))
+    kept, kept_label = kept[order], label[kept[order]]
+
+    starts = _group_starts(kept_label)
+    counts = np.diff(np.append(starts, len(kept)))
+    q = matched_query_intensity[kept]
+    t = target_intensity[target_index[kept]]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.add.reduceat(q * t, starts) / (np.sqrt(np.add.reduceat(q * q, starts)) * np.sqrt(np.add.reduceat(t * t, starts)))
+    maccs = macc_score(counts, scores)
+
+    query_pairs, target_peaks = query_index[kept].tolist(), _target_peaks(target_spectrum, target_index[kept])
+    cosine_scores = []
+    for start, count, score, macc in zip(starts.tolist(), counts.tolist(), scores.tolist(), maccs.tolist()):
+        if count >= minmatchedpeaks:
+            filtered_matches = [(*query_spectrum[i], *target_peak)
+                                for i, target_peak in zip(query_pairs[start:start + count], target_peaks[start:start + count])]
+            cosine_scores.append((score, filtered_matches, macc))
+    return cosine_scores
+
+def _small_window_cosine_similarity(query_spectrum, target_spectrum, query_index, target_index, minmatchedpeaks) -> list:
+    """batch_cosine_similarity of the matched pairs of a few candidates, scored one candidate at a time."""
+    matches = [(*query_spectrum[i], *target_peak)
+               for i, target_peak in zip(query_index.tolist(), _target_peaks(target_spectrum, target_index))]
+    cosine_scores = []
+    for matched_spectrum in group_tuples_by_same_value(matches, -1):
+        filtered_matches = filter_tuples(matched_spectrum)
+        if len(filtered_matches) >= minmatchedpeaks:
+            score = _short_cosine_similarity([t[1] for t in filtered_matches], [t[4] for t in filtered_matches])
+            cosine_scores.append((score, filtered_matches, macc_score(len(filtered_matches), score)))
+    return cosine_scores
+
+def _short_cosine_similarity(vector1, vector2) -> float:
+    """cosine_similarity of two short lists of floats, summed in Python instead of converting them to arrays
+    (NaN when a vector is all zeros, like the batch path)."""
+    norm = math.sqrt(sum(a * a for a in vector1)) * math.sqrt(sum(b * b for b in vector2))
+    return sum(a * b for a, b in zip(vector1, vector2)) / norm if norm else float('nan')
+
+def _target_peaks(target_spectrum, indices) -> list:
+    """The (m/z, intensity, label) tuples of the target peaks at an index array, also for TargetSpectrum arrays."""
+    if isinstance(target_spectrum, TargetSpectrum):
+        # Python floats, like the peaks of get_target_spectrum
+        return list(zip(target_spectrum.mz[indices].tolist(), target_spectrum.intensity[indices].tolist(),
+                        map(str, target_spectrum.label[indices].tolist())))
+    return [target_spectrum[j] for j in indices.tolist()]
 
 def cosine_similarity(vector1, vector2):
     """
@@ -255,7 +668,7 @@ def group_tuples_by_same_value(tuples_list,same_value_position):
 
 def normalize_to_100(numbers):
     """normalize the spectrum to 0 to 100"""
-    if not numbers or max(numbers) == 0:
+    if len(numbers) == 0 or max(numbers) == 0:
         return [0] * len(numbers)
 
     max_value = max(numbers)
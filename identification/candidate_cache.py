@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''Memoized precursor-window candidates.
+
+In direct-infusion runs the same isolation window target m/z comes back hundreds of times, and every time the same
+library spectra are selected and merged into the same target spectrum. A CandidateCache keeps the candidates of a
+window (their library positions, spectra and TargetSpectrum arrays) in a bounded LRU, so a repeated window costs a
+dictionary lookup. The cache can be saved to an .npz file and loaded by later runs on the same library.'''
+
+import os
+import logging
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+from IdentificationMeta import TargetSpectrum, target_arrays, search_library_positions
+from LibraryHandling import library_fingerprint
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'dimeta', 'candidates')
+
+
+class CandidateCache:
+
+    '''Candidates of precursor windows keyed by (precursor m/z, PIMT).
+
+    The compensation voltage is not part of the key, the candidate selection does not depend on it.
+    An entry is [positions, target, spectra]; spectra is built from the library on the first hit of an entry
+    loaded from a file. new_entries() hands the entries added since the last call to another cache (e.g. from a worker
+    process to the cache of the file), update() takes them in.'''
+
+    def __init__(self, library, max_entries=4096, cache_dir=None):
+        '''With a cache_dir the entries are loaded from and saved to <cache_dir>/<library fingerprint>.npz, so runs
+        on the same library (e.g. files acquired with the same method) share them.'''
+        self.library = library
+        self.max_entries = max_entries
+        self._fingerprint = None
+        self.path = os.path.join(cache_dir, self.fingerprint + '.npz') if cache_dir else None
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._new = {}
+        if self.path is not None and os.path.exists(self.path):
+            self.load(self.path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def fingerprint(self) -> str:
+        # hashing the library is only needed to save or load entries, a cache without a file never computes it
+        if self._fingerprint is None:
+            self._fingerprint = library_fingerprint(self.library)
+        return self._fingerprint
+
+    def candidates(self, precursor, PIMT) -> tuple:
+        '''(realtime library, TargetSpectrum) of the window precursor +/- PIMT.'''
+        key = (float(precursor), float(PIMT))
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            if entry[2] is None:
+                entry[2] = [self.library[i] for i in entry[0].tolist()]
+            return entry[2], entry[1]
+        self.misses += 1
+        positions = search_library_positions(self.library, precursor, PIMT)
+        spectra = [self.library[i] for i in positions.tolist()]
+        entry = [positions, target_arrays(spectra), spectra]
+        self._store(key, entry)
+        self._new[key] = entry
+        return entry[2], entry[1]
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def new_entries(self) -> dict:
+        '''{key: (positions, target)} of the entries added since the last call.'''
+        new, self._new = self._new, {}
+        return {key: (entry[0], entry[1]) for key, entry in new.items()}
+
+    def update(self, entries):
+        for key, (positions, target) in entries.items():
+            if key not in self._entries:
+                self._store(key, [positions, target, None])
+
+    def save(self, path=None):
+        '''Write the entries to an .npz file, replaced atomically so concurrent runs never see a partial file.'''
+        path = path or self.path
+        entries = list(self._entries.items())
+        keys = np.array([key for key, _ in entries], dtype=np.float64).reshape(-1, 2)
+        positions = [entry[0] for _, entry in entries]
+        targets = [entry[1] for _, entry in entries]
+        arrays = {'fingerprint': np.array(self.fingerprint),
+                  'keys': keys,
+                  'position_offsets': np.concatenate(([0], np.cumsum([len(p) for p in positions]))).astype(np.int64),
+                  'positions': np.concatenate(positions or [np.empty(0)]).astype(np.int64),
+                  'peak_offsets': np.concatenate(([0], np.cumsum([len(t.mz) for t in targets]))).astype(np.int64),
+                  'mz': np.concatenate([np.asarray(t.mz, dtype=np.float64) for t in targets] or [np.empty(0)]),
+                  'intensity': np.concatenate([np.asarray(t.intensity, dtype=np.float64) for t in targets] or [np.empty(0)]),
+                  'label': np.concatenate([np.asarray(t.label, dtype=np.int64) for t in targets] or [np.empty(0)]).astype(np.int64)}
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.npz', dir=folder)
+        os.close(fd)
+        try:
+            np.savez(tmp_path, **arrays)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
+
+    def load(self, path):
+        '''Add the entries of a saved cache; a cache saved for another library is ignored.'''
+        with np.load(path, allow_pickle=False) as data:
+            if str(data['fingerprint']) != self.fingerprint:
+                logging.info(f"Candidate cache {path} belongs to another library, it is rebuilt")
+                return
+            position_offsets, peak_offsets = data['position_offsets'], data['peak_offsets']
+            positions, mz, intensity, label = data['positions'], data['mz'], data['intensity'], data['label']
+            for number, key in enumerate(data['keys'].tolist()):
+                start, stop = peak_offsets[number], peak_offsets[number + 1]
+                target = TargetSpectrum(mz[start:stop], intensity[start:stop], label[start:stop].astype(np.intp))
+                self._store(tuple(key), [positions[position_offsets[number]:position_offsets[number + 1]], target, None])
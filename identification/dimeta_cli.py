@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''Command-line entry point for running DImeta without the GUI, e.g. on headless cluster nodes.
+
+    python dimeta_cli.py reformat --inputs lib1.msp lib2.mgf --output-dir libs --topnum 10
+    python dimeta_cli.py identify --library libs/reformatted.msp --inputs runs/ --output-dir results --ppm 10 --pimt 0.5
+    python dimeta_cli.py merge --input-folder results --output-folder results
+
+Every option can also come from a JSON file given with --config, either at the top level or in a section named
+after the subcommand ({"identify": {"ppm": 10, "workers": 8}}); options on the command line take precedence.
+Matplotlib and PyQt are only imported when a step needs them.'''
+
+import sys
+import os
+import json
+import glob
+import uuid
+import argparse
+import logging
+
+# the modules are imported by name like in the GUI, so make the sibling folders importable
+_here = os.path.dirname(os.path.abspath(__file__))
+for _folder in (os.path.join(os.path.dirname(_here), 'Library loading'), _here):
+    if _folder not in sys.path:
+        sys.path.insert(0, _folder)
+
+
+def expand_inputs(paths, patterns=('*.mzML', '*.mzml', '*.mzXML', '*.mzxml')) -> list:
+    '''Expand folders to the mass spectrometry files they contain, keep files as given.'''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = set()
+            for pattern in patterns:
+                found.update(glob.glob(os.path.join(path, pattern)))
+            files.extend(sorted(found))
+        else:
+            files.append(path)
+    return files
+
+
+def run_reformat(args) -> int:
+    from LibraryHandling import LibraryLoadingStrategy, LibraryReformat, LibrarySaveStrategy
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    logging.info(f"Combining {len(args.inputs)} libraries...")
+    combined_library = LibraryLoadingStrategy.combine_libraries(args.inputs)
+    logging.info(f"Reformatting library for top {args.topnum} peaks in library mass spectra...")
+    reformatted_library = LibraryReformat(args.topnum).reformat_library(combined_library)
+
+    output_name = args.output_name or f"reformatted_library_{uuid.uuid4()}"
+    output_file_path = os.path.join(args.output_dir, output_name + '.msp')
+    LibrarySaveStrategy.save_library_to_msp_class(reformatted_library, output_file_path)
+    logging.info(f"Library saved successfully to {output_file_path}.")
+    if args.compiled:
+        compiled_file_path = os.path.join(args.output_dir, output_name + '.dilib')
+        LibrarySaveStrategy.save_library_to_compiled(reformatted_library, compiled_file_path)
+        logging.info(f"Compiled library saved successfully to {compiled_file_path}.")
+    return 0
+
+
+def run_identify(args) -> int:
+    from LibraryHandling import LibraryLoadingStrategy, LibraryCache
+    from querylibrarymatch import batch_processing_function
+
+    input_files = expand_inputs(args.inputs)
+    if not input_files:
+        logging.error("No input files found.")
+        return 1
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    cache = None if args.no_cache else LibraryCache(args.cache_dir)
+    library = LibraryLoadingStrategy(args.library, cache=cache).load_library()
+    logging.info(f"Loaded {len(library)} library spectra, identifying {len(input_files)} files...")
+
+    def log_progress(file_path, done, total, error):
+        if error is None:
+            logging.info(f"[{done}/{total}] Finished {file_path}")
+        else:
+            logging.error(f"[{done}/{total}] Failed {file_path}: {error}")
+
+    lowerscan, higherscan = args.scan_range
+    status = batch_processing_function(input_files, library, lowerscan, higherscan, args.pimt, args.cosine, args.ppm,
+                                       args.min_matched_peaks, args.intensity, args.output_dir,
+                                       generate_plots=args.plots, tolerance_unit=args.unit, workers=args.workers,
+                                       progress_callback=log_progress, plot_format=args.plot_format,
+                                       plot_top_n=args.plot_top_n, result_format=args.result_format,
+                                       keep_peaks=args.keep_peaks, export_excel=args.excel,
+                                       profile=args.profile, profile_scans=args.profile_scans,
+                                       profile_backend=args.profile_backend,
+                                       search_mode='open' if args.open_search else 'precursor', open_top_k=args.open_top_k,
+                                       cache_candidates=not args.no_candidate_cache, persist_candidates=args.persist_candidates,
+                                       candidate_cache_dir=args.candidate_cache_dir, consolidate_scans=args.consolidate,
+                                       consolidation_min_fraction=args.consolidate_min_fraction, prefetch_scans=args.prefetch,
+                                       reader=args.reader, store_scans=args.store_scans,
+                                       scan_store_dir=args.scan_store_dir)
+    failed = [path for path, error in status.items() if error is not None]
+    if failed:
+        logging.error(f"{len(failed)} of {len(status)} files failed.")
+        return 1
+    logging.info("Analysis completed successfully.")
+    return 0
+
+
+def run_merge(args) -> int:
+    from meta_quan_merge import Meta_df_Merge
+
+    processor = Meta_df_Merge(args.input_folder)
+    mz_tolerance = None if args.rounded else args.mz_tolerance
+    table = processor.merge_long(workers=args.workers, mz_tolerance=mz_tolerance, tolerance_unit=args.unit,
+                                 cv_tolerance=args.cv_tolerance)
+    logging.info(f"Merged {len(table.features)} features of {len(table.samples)} samples.")
+    processor.save_features(table, args.output_folder, os.path.splitext(args.output_filename)[0] + '_features.csv')
+    processor.save_merged(table, args.output_folder, args.output_filename)
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='dimeta', description='DImeta library reformatting, identification and quantification.')
+    parser.add_argument('--config', help='JSON file with option values, per subcommand section or at the top level')
+    parser.add_argument('--verbose', action='store_true', help='log debug messages')
+    subparsers = parser.add_subparsers(dest='command')
+
+    reformat = subparsers.add_parser('reformat', help='combine and reformat library files')
+    reformat.add_argument('--inputs', nargs='+', help='.msp/.msp.gz/.mgf library files')
+    reformat.add_argument('--output-dir', help='folder for the reformatted library')
+    reformat.add_argument('--output-name', help='file name without extension (default: random)')
+    reformat.add_argument('--topnum', type=int, default=10, help='number of top intensity peaks kept per spectrum')
+    reformat.add_argument('--compiled', action='store_true', help='also save a compiled .dilib library')
+    reformat.set_defaults(func=run_reformat, required=['inputs', 'output_dir'])
+
+    identify = subparsers.add_parser('identify', help='identify metabolites in .mzML/.mzXML files')
+    identify.add_argument('--library', help='library file (.msp, .msp.gz, .dilib)')
+    identify.add_argument('--inputs', nargs='+', help='input files or folders containing them')
+    identify.add_argument('--output-dir', help='folder for the result files and plots')
+    identify.add_argument('--ppm', type=float, default=10.0, help='fragment tolerance')
+    identify.add_argument('--unit', choices=['ppm', 'da'], default='ppm', help='unit of the fragment tolerance')
+    identify.add_argument('--min-matched-peaks', type=int, default=3)
+    identify.add_argument('--pimt', type=float, default=0.5, help='precursor ion mass tolerance, Da')
+    identify.add_argument('--intensity', type=float, default=3e3, help='fragment intensity cutoff')
+    identify.add_argument('--cosine', type=float, default=0.7, help='cosine score threshold')
+    identify.add_argument('--open-search', action='store_true',
+                          help='ignore the precursor m/z and score every scan against the library spectra sharing the most fragments')
+    identify.add_argument('--open-top-k', type=int, default=50, help='candidates per scan of the open search')
+    identify.add_argument('--no-candidate-cache', action='store_true',
+                          help='select the library candidates again for every scan instead of once per precursor window')
+    identify.add_argument('--persist-candidates', action='store_true',
+                          help='save the candidates of the precursor windows for later runs on the same library')
+    identify.add_argument('--candidate-cache-dir', help='folder of the saved candidates')
+    identify.add_argument('--consolidate', action='store_true',
+                          help='identify the MS2 scans of every precursor window and CV once, on their consensus spectrum')
+    identify.add_argument('--consolidate-min-fraction', type=float, default=0.0,
+                          help='drop consensus peaks found in fewer than this fraction of the scans of a window')
+    identify.add_argument('--scan-range', type=int, nargs=2, default=[1, 1], metavar=('LOWER', 'UPPER'),
+                          help='scan range, an upper bound of 1 means the last scan of each file')
+    identify.add_argument('--plots', action='store_true', help='generate mirror plots of the identified spectra')
+    identify.add_argument('--plot-format', choices=['svg', 'png'], default='svg', help='file format of the mirror plots')
+    identify.add_argument('--plot-top-n', type=int, help='only plot the N best matches of every compound')
+    identify.add_argument('--result-format', choices=['csv', 'parquet'], default='csv', help='format of the result files')
+    identify.add_argument('--keep-peaks', action='store_true', help='also save the matched peaks of every result row')
+    identify.add_argument('--excel', action='store_true', help='also export the results of every file to .xlsx')
+    identify.add_argument('--profile', action='store_true',
+                          help='log the time spent in every stage and save it to <file>_profile.json')
+    identify.add_argument('--profile-scans', type=int, nargs=2, metavar=('LOWER', 'UPPER'),
+                          help='run a profiling session over the scans LOWER <= scan < UPPER')
+    identify.add_argument('--profile-backend', choices=['cprofile', 'pyinstrument'], default='cprofile',
+                          help='profiler of the --profile-scans session')
+    identify.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    identify.add_argument('--prefetch', type=int, default=64,
+                          help='scans decoded ahead by a reader thread while scoring, 0 to turn it off')
+    identify.add_argument('--reader', choices=['direct', 'pyteomics'], default='direct',
+                          help='decode mzML scans directly from their index offsets or with pyteomics')
+    identify.add_argument('--store-scans', action='store_true',
+                          help='convert every input file once to a memory-mapped scan store and read later runs from it')
+    identify.add_argument('--scan-store-dir', help='folder of the scan stores')
+    identify.add_argument('--no-cache', action='store_true', help='do not use the parsed library cache')
+    identify.add_argument('--cache-dir', help='folder of the parsed library cache')
+    identify.set_defaults(func=run_identify, required=['library', 'inputs', 'output_dir'])
+
+    merge = subparsers.add_parser('merge', help='merge identification results for quantification')
+    merge.add_argument('--input-folder', help='folder with the identification results')
+    merge.add_argument('--output-folder', help='folder for the merged table (default: input folder)')
+    merge.add_argument('--output-filename', default='merged_output.csv')
+    merge.add_argument('--workers', type=int, help='number of processes reading result files (default: all CPUs)')
+    merge.add_argument('--mz-tolerance', type=float, default=10.0, help='precursor tolerance for aligning the samples')
+    merge.add_argument('--unit', choices=['ppm', 'da'], default='ppm', help='unit of the precursor tolerance')
+    merge.add_argument('--cv-tolerance', type=float, default=0.0, help='compensation voltage tolerance, 0 for exact')
+    merge.add_argument('--rounded', action='store_true', help='group precursors rounded to 2 decimals instead')
+    merge.set_defaults(func=run_merge, required=['input_folder'])
+    return parser
+
+
+def load_config(config_path, command) -> tuple:
+    '''(top-level options, options of the command section) of a JSON config file, with the keys as argparse dests.'''
+    with open(config_path, 'r', encoding='utf-8') as file:
+        config = json.load(file)
+    shared = {key.replace('-', '_'): value for key, value in config.items() if not isinstance(value, dict)}
+    section = {key.replace('-', '_'): value for key, value in config.get(command, {}).items()}
+    return shared, section
+
+
+def _subcommands(parser) -> dict:
+    for action in parser._actions:
+        if isinstance(action, argparse._SubParsersAction):
+            return action.choices
+    return {}
+
+
+def _dests(parser) -> set:
+    return {action.dest for action in parser._actions
+            if action.dest not in ('help', 'config', 'command') and not isinstance(action, argparse._SubParsersAction)}
+
+
+def apply_config(parser, args, argv):
+    '''Parse argv again with the options of args.config as defaults, so only options given on the command line win.
+    Top-level keys must be options of the main parser or of some subcommand, section keys options of that subcommand.'''
+    subcommands = _subcommands(parser)
+    main_dests, command_dests = _dests(parser), _dests(subcommands[args.command])
+    shared, section = load_config(args.config, args.command)
+    known = main_dests.union(*(_dests(subparser) for subparser in subcommands.values()))
+    unknown = [key for key in shared if key not in known] + [key for key in section if key not in command_dests | main_dests]
+    if unknown:
+        parser.error(f"{args.config}: unknown {args.command} options {', '.join(unknown)}")
+    options = {**shared, **section}
+    parser.set_defaults(**{key: value for key, value in options.items() if key in main_dests})
+    subcommands[args.command].set_defaults(**{key: value for key, value in options.items() if key in command_dests})
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    if args.config:
+        args = apply_config(parser, args, argv)
+    missing = [name for name in args.required if getattr(args, name, None) in (None, [])]
+    if missing:
+        parser.error(f"{args.command}: missing {', '.join('--' + name.replace('_', '-') for name in missing)}")
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,8 +2,90 @@
 import numpy as np 
 import pandas as pd
 import os
+import csv
+from collections import namedtuple
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from result_writer import read_results
 
+# result files written by the identification, newest format first
+RESULT_EXTENSIONS = ('.parquet', '.csv', '.xlsx')
+MERGE_COLUMNS = ['PrecursorMZ', 'Compensation Voltage', 'Ion_count']
 
+# merged quantification in long format: features (precursor, m/z range, compensation_voltage, sample count and label
+# per feature id), the sample labels, and one (feature, sample, Ion_count) row per feature found in a sample
+MergedTable = namedtuple('MergedTable', ['features', 'samples', 'values'])
+
+
+
+class MergeCancelled(Exception):
+    '''Raised by merge_dfs when should_stop() returns True between files'''
+
+
+def read_sample(path, decimals=None):
+    '''Strongest Ion_count per (precursor, CV) of one result file, as numpy arrays, with the precursor rounded
+    to `decimals` when given; None when the file is not an identification result.'''
+    try:
+        df = read_results(path, columns=MERGE_COLUMNS)
+    except ValueError:
+        return None
+    precursor = df['PrecursorMZ'].to_numpy(dtype=np.float64)
+    if decimals is not None:
+        precursor = precursor.round(decimals)
+    cv = pd.to_numeric(df['Compensation Voltage'], errors='coerce').to_numpy(dtype=np.float64)
+    ion_count = df['Ion_count'].to_numpy(dtype=np.float64)
+    # same as sort_values(Ion_count, descending) + drop_duplicates(label) of reformat_df, without string labels
+    order = np.lexsort((-ion_count, cv, precursor))
+    precursor, cv, ion_count = precursor[order], cv[order], ion_count[order]
+    first = _key_starts(precursor, cv)
+    return precursor[first], cv[first], ion_count[first]
+
+
+def _key_starts(precursor, cv):
+    # start of every run of equal (precursor, cv) keys in sorted arrays, NaN compensation voltages are equal to each other
+    if len(precursor) == 0:
+        return np.zeros(0, dtype=np.intp)
+    same_cv = (cv[1:] == cv[:-1]) | (np.isnan(cv[1:]) & np.isnan(cv[:-1]))
+    changed = (precursor[1:] != precursor[:-1]) | ~same_cv
+    return np.concatenate(([0], np.flatnonzero(changed) + 1))
+
+
+def feature_label(precursor, cv) -> str:
+    # the label format of reformat_df
+    return f"{precursor}_{cv}"
+
+
+def _cv_groups(cv, cv_tolerance=0.0):
+    # group number per row: equal CVs, or with a tolerance CVs whose sorted neighbours are at most cv_tolerance apart;
+    # rows without a CV form group -1
+    groups = np.full(len(cv), -1, dtype=np.int64)
+    valid = ~np.isnan(cv)
+    values = np.unique(cv[valid])
+    if cv_tolerance > 0:
+        value_groups = np.concatenate(([0], np.cumsum(np.diff(values) > cv_tolerance)))
+    else:
+        value_groups = np.arange(len(values))
+    groups[valid] = value_groups[np.searchsorted(values, cv[valid])]
+    return groups
+
+
+def align_features(precursor, cv, mz_tolerance=10.0, tolerance_unit='ppm', cv_tolerance=0.0):
+    '''Feature id for every (precursor m/z, CV) row of all samples.
+
+    The rows are sorted by CV group and m/z, and one sweep starts a new feature wherever the CV group changes or
+    the gap to the previous m/z is larger than mz_tolerance (ppm of the previous m/z, or Da). Neighbours closer than
+    the tolerance are chained into one feature, so values near a rounding boundary are not split.
+    Feature ids are numbered in (CV group, m/z) order.'''
+    if len(precursor) == 0:
+        return np.zeros(0, dtype=np.int64)
+    cv_group = _cv_groups(cv, cv_tolerance)
+    order = np.lexsort((precursor, cv_group))
+    mz, group = precursor[order], cv_group[order]
+    limit = mz[:-1] * mz_tolerance * 1e-6 if tolerance_unit == 'ppm' else mz_tolerance
+    new_feature = (group[1:] != group[:-1]) | (np.diff(mz) > limit)
+    feature = np.empty(len(mz), dtype=np.int64)
+    feature[order] = np.concatenate(([0], np.cumsum(new_feature)))
+    return feature
 
 
 class Meta_df_Merge:
@@ -22,22 +104,133 @@ class Meta_df_Merge:
         
         return selected_columns
 
-    def merge_dfs(self):
-        '''Merge DataFrames from all Excel files in the specified directory'''
-        dfs = []
-        
-        for filename in os.listdir(self.folder_path):
-            if filename.endswith('.xlsx'):
-                path = os.path.join(self.folder_path, filename)
-                df = pd.read_excel(path)
-                df_reformatted = self.reformat_df(df)
-                file_label = filename.replace('.xlsx', '')
-                df_reformatted.columns = [f"{file_label}" for col in df_reformatted.columns]
-                dfs.append(df_reformatted)
+    def result_files(self) -> dict:
+        '''{file label: path} of the identification results in the folder; when a run was saved in several
+        formats the first of RESULT_EXTENSIONS is used.'''
+        files = {}
+        for extension in reversed(RESULT_EXTENSIONS):
+            for filename in sorted(os.listdir(self.folder_path)):
+                if filename.endswith(extension):
+                    files[filename[:-len(extension)]] = os.path.join(self.folder_path, filename)
+        return dict(sorted(files.items()))
 
-        final_df = pd.concat(dfs, axis=1)
+    def merge_long(self, workers=None, progress_callback=None, should_stop=None,
+                   mz_tolerance=10.0, tolerance_unit='ppm', cv_tolerance=0.0) -> MergedTable:
+        '''Read all result files, with up to `workers` processes (default: all CPUs), into a MergedTable.
+        The precursors of all samples are aligned with align_features; a mz_tolerance of None instead groups them by
+        the precursor rounded to 2 decimals like reformat_df. A sample with several rows in a feature keeps the
+        strongest Ion_count. No wide label x sample frame is built, see save_merged for writing it.
+        progress_callback(filename, done, total) is called after every file, should_stop() is checked after each.'''
+        files = self.result_files()
+        paths = list(files.values())
+        workers = min(workers or os.cpu_count() or 1, max(1, len(paths)))
+        reader = partial(read_sample, decimals=2 if mz_tolerance is None else None)
+        pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        samples, columns = [], []
+        try:
+            results = pool.map(reader, paths, chunksize=8) if pool is not None else map(reader, paths)
+            for done, (file_label, path, result) in enumerate(zip(files, paths, results), 1):
+                if result is not None:   # skipped: matched peak tables, earlier merged output
+                    columns.append(result + (np.full(len(result[0]), len(samples), dtype=np.int32),))
+                    samples.append(file_label)
+                if progress_callback is not None:
+                    progress_callback(os.path.basename(path), done, len(files))
+                if should_stop is not None and should_stop():
+                    raise MergeCancelled(f"Cancelled after {done} of {len(files)} files")
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+        if columns:
+            precursor, cv, ion_count, sample = (np.concatenate(arrays) for arrays in zip(*columns))
+        else:
+            precursor, cv, ion_count, sample = np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int32)
+        if mz_tolerance is None:
+            feature = align_features(precursor, cv, 0.0, 'da')   # equal rounded precursors only
+        else:
+            feature = align_features(precursor, cv, mz_tolerance, tolerance_unit, cv_tolerance)
+
+        # feature m/z is the mean of its rows; the CV is the one of its strongest row, a mean of equal CVs can drift
+        # in the last digit and change the label (rows of a feature share their CV unless cv_tolerance is set).
+        # The ids are renumbered in (m/z, CV) order
+        count = np.bincount(feature)
+        feature_mz = (np.bincount(feature, weights=precursor) / count).round(4)
+        strongest = np.lexsort((-ion_count, feature))
+        feature_cv = cv[strongest[np.cumsum(count) - count]]   # NaN for the features without a CV
+        feature_mz_min = np.full(len(count), np.inf)
+        feature_mz_max = np.full(len(count), -np.inf)
+        np.minimum.at(feature_mz_min, feature, precursor)
+        np.maximum.at(feature_mz_max, feature, precursor)
+        renumber = np.empty(len(count), dtype=np.int64)
+        feature_order = np.lexsort((feature_cv, feature_mz))
+        renumber[feature_order] = np.arange(len(count))
+        feature = renumber[feature]
+
+        # strongest Ion_count per feature and sample, sorted by feature, then sample
+        order = np.lexsort((-ion_count, sample, feature))
+        feature, sample, ion_count = feature[order], sample[order], ion_count[order]
+        first = np.concatenate(([0], np.flatnonzero((np.diff(feature) != 0) | (np.diff(sample) != 0)) + 1)) if len(feature) else feature
+        feature, sample, ion_count = feature[first], sample[first], ion_count[first]
+
+        features = pd.DataFrame({'precursor': feature_mz[feature_order],
+                                 'mz_min': feature_mz_min[feature_order], 'mz_max': feature_mz_max[feature_order],
+                                 'compensation_voltage': feature_cv[feature_order],
+                                 'n_samples': np.bincount(feature, minlength=len(count))})
+        features['label'] = [feature_label(p, c) for p, c in zip(features['precursor'].tolist(), features['compensation_voltage'].tolist())]
+        features.index.name = 'feature'
+        values = pd.DataFrame({'feature': feature, 'sample': sample, 'Ion_count': ion_count})
+        return MergedTable(features, samples, values)
+
+    def merge_dfs(self, progress_callback=None, should_stop=None, workers=None, **alignment):
+        '''Merge DataFrames from all result files (.parquet, .csv or .xlsx) in the specified directory.
+        Builds the whole label x sample frame in memory, large cohorts should use merge_long and save_merged.
+        The alignment keywords are those of merge_long.'''
+        return self.to_wide(self.merge_long(workers, progress_callback, should_stop, **alignment))
+
+    @staticmethod
+    def to_wide(table, first=0, last=None) -> pd.DataFrame:
+        '''Label x sample frame of the features first..last (all by default), NaN where a sample lacks a feature.'''
+        last = len(table.features) if last is None else last
+        feature = table.values['feature'].to_numpy()
+        begin, end = np.searchsorted(feature, [first, last])
+        matrix = np.full((last - first, len(table.samples)), np.nan)
+        matrix[feature[begin:end] - first, table.values['sample'].to_numpy()[begin:end]] = table.values['Ion_count'].to_numpy()[begin:end]
+        index = pd.Index(table.features['label'].to_numpy()[first:last], name='label')
+        return pd.DataFrame(matrix, index=index, columns=table.samples)
+
+    def save_merged(self, table, output_folder=None, output_filename='merged_output.csv', chunk_features=2000):
+        '''Write the label x sample CSV of a MergedTable, chunk_features rows at a time.
+        The rows are formatted from the long values directly and quoted by csv.writer, pandas to_csv of the mostly
+        empty wide chunks is several times slower; the file reads back the same as save_final_df(merge_dfs()).'''
+        if output_folder is None:
+            output_folder = self.folder_path  # Use the initial folder path if no output folder is specified
+        output_path = os.path.normpath(os.path.join(output_folder, output_filename))
+        
+        feature = table.values['feature'].to_numpy()
+        sample = table.values['sample'].to_numpy()
+        ion_count = table.values['Ion_count'].to_numpy()
+        labels = table.features['label'].tolist()
+        with open(output_path, 'w', newline='') as file:
+            writer = csv.writer(file, lineterminator='\n')
+            writer.writerow(['label'] + list(table.samples))
+            for first in range(0, len(labels), chunk_features):
+                last = min(first + chunk_features, len(labels))
+                begin, end = np.searchsorted(feature, [first, last])
+                cells = np.full((last - first, len(table.samples)), '', dtype=object)
+                cells[feature[begin:end] - first, sample[begin:end]] = [repr(value) for value in ion_count[begin:end].tolist()]
+                writer.writerows([label] + row for label, row in zip(labels[first:last], cells.tolist()))
         
-        return final_df
+        message = f"Saved merged DataFrame to {output_path}"
+        print(message)
+        return message
+
+    def save_features(self, table, output_folder=None, output_filename='merged_features.csv'):
+        '''Save the feature id table of a MergedTable (m/z, m/z range, CV, number of samples and label per feature).'''
+        if output_folder is None:
+            output_folder = self.folder_path
+        output_path = os.path.normpath(os.path.join(output_folder, output_filename))
+        table.features.to_csv(output_path)
+        return output_path
 
     def save_final_df(self, final_df, output_folder=None, output_filename='merged_output.csv'):
         
@@ -49,7 +242,9 @@ class Meta_df_Merge:
         
         final_df.to_csv(output_path)
         
-        print(f"Saved merged DataFrame to {output_path}")
+        message = f"Saved merged DataFrame to {output_path}"
+        print(message)
+        return message
 
 
 
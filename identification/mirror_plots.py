@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''Mirror plots of identified matches, rendered apart from the scoring.
+
+The identification only makes a PlotRecord per match and hands it to a PlotStream, which draws the records with the
+non-interactive Agg backend while the identification goes on, reusing one Figure/Axes per process, optionally in
+parallel worker processes. render_plots draws a list of records the same way.'''
+
+import os
+import re
+import heapq
+import multiprocessing
+from collections import namedtuple, defaultdict, deque
+
+from IdentificationMeta import normalize_to_100
+
+# library_intensity is normalized to a base peak of 100, query_intensity is raw
+PlotRecord = namedtuple('PlotRecord', ['name', 'score', 'scan', 'library_mz', 'library_intensity', 'query_mz', 'query_intensity'])
+
+PLOT_FORMATS = ('png', 'svg')
+PNG_DPI = 150
+
+
+def sanitize_filename(filename):
+    # Replace any invalid characters with an underscore
+    return re.sub(r'[<>:"/\\|?*]', '_', filename)
+
+
+def make_plot_record(compound_info, cos, scan_index) -> PlotRecord:
+    '''Keep what the mirror plot of one match needs: the library spectrum, with its intensities normalized to 100
+    (precomputed by LibraryReformat when available), and the matched query peaks in cos[1].'''
+    if 'normalized intensity' in compound_info:
+        library_intensity = list(compound_info['normalized intensity'])
+    else:
+        library_intensity = normalize_to_100(list(compound_info.get('intensity', [])))
+    return PlotRecord(compound_info.get('name', 'Unknown Compound'), cos[0], scan_index,
+                      list(compound_info.get('mz', [])), library_intensity,
+                      [x[0] for x in cos[1]], [x[1] for x in cos[1]])
+
+
+def select_top_hits(records, top_n=None) -> list:
+    '''Keep the top_n best scoring records of every compound, all records when top_n is None.'''
+    if not top_n:
+        return list(records)
+    by_compound = defaultdict(list)
+    for record in records:
+        by_compound[record.name].append(record)
+    selected = []
+    for compound_records in by_compound.values():
+        selected.extend(sorted(compound_records, key=lambda record: record.score, reverse=True)[:top_n])
+    return sorted(selected, key=lambda record: record.scan)
+
+
+def plot_filename(record, plot_format) -> str:
+    return f"{sanitize_filename(record.name)}_{record.scan}.{plot_format}"
+
+
+class MirrorPlotter:
+
+    '''Draws mirror plots on one reused Agg figure; pyplot and its global state are never touched.'''
+
+    def __init__(self, plot_format='svg'):
+        if plot_format not in PLOT_FORMATS:
+            raise ValueError(f"Unsupported plot format: {plot_format}")
+        import matplotlib   # imported on first use, identification without plots never loads matplotlib
+        from matplotlib import font_manager
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        # Arial when it is installed, otherwise the default font instead of a font lookup warning per text
+        if any(font.name == 'Arial' for font in font_manager.fontManager.ttflist):
+            matplotlib.rcParams['font.family'] = 'Arial'
+        from matplotlib.collections import LineCollection
+        self.plot_format = plot_format
+        self.figure = Figure()
+        FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot()
+        # fixed margins, a tight bounding box would draw every figure twice
+        self.figure.subplots_adjust(left=0.1, right=0.97, bottom=0.08, top=0.92)
+        # the artists are created once and only get new data per plot, clearing the axes would rebuild the ticks
+        self.library_lines = LineCollection([], colors="red", label='Library Spectrum')
+        self.query_lines = LineCollection([], colors="blue", label='Query Spectrum')
+        self.axes.add_collection(self.library_lines)
+        self.axes.add_collection(self.query_lines)
+        # Plot horizontal line at y=0
+        self.axes.axhline(y=0, color='gray', alpha=0.8, linewidth=1)
+        self.axes.legend(loc='upper right')
+        self.axes.set_ylim(-110, 110)
+
+    def render(self, record, fig_path) -> str:
+        # Plot library spectrum, and the query spectrum inverted below it
+        self.library_lines.set_segments([[(mz, 0), (mz, intensity)]
+                                         for mz, intensity in zip(record.library_mz, record.library_intensity)])
+        self.query_lines.set_segments([[(mz, 0), (mz, -intensity)]
+                                       for mz, intensity in zip(record.query_mz, normalize_to_100(record.query_intensity))])
+        all_mz = list(record.library_mz) + list(record.query_mz)
+        if all_mz:
+            low, high = min(all_mz), max(all_mz)
+            pad = (high - low) * 0.05 or 1.0
+            self.axes.set_xlim(low - pad, high + pad)
+        self.axes.set_title(f"{record.name} | Cosine Score: {record.score:.2f} | Scan: {record.scan}")
+        path = os.path.join(fig_path, plot_filename(record, self.plot_format))
+        dpi = PNG_DPI if self.plot_format == 'png' else 300
+        self.figure.savefig(path, dpi=dpi)
+        return path
+
+
+_plotter_state = {}
+
+def _init_plot_worker(plot_format, fig_path):
+    _plotter_state['plotter'] = MirrorPlotter(plot_format)
+    _plotter_state['fig_path'] = fig_path
+
+def _render_chunk(records):
+    return [_plotter_state['plotter'].render(record, _plotter_state['fig_path']) for record in records]
+
+
+class PlotStream:
+
+    '''Renders PlotRecords while they are being produced, so the records of a whole run are never held at once.
+
+    Without top_n the added records are rendered in chunks of `chunksize`, by a pool of `workers` processes with at
+    most two chunks per worker waiting, or in this process when workers <= 1. With top_n only the top_n best records
+    of every compound are kept, in a heap per compound (the selection of select_top_hits), and rendered on close.
+    should_stop() is checked before every chunk; rendering then stops early. Use it as a context manager: the
+    remaining records are rendered when the block ends, and dropped when it ends with an exception.'''
+
+    def __init__(self, fig_path, plot_format='svg', top_n=None, workers=1, chunksize=16, should_stop=None):
+        if plot_format not in PLOT_FORMATS:
+            raise ValueError(f"Unsupported plot format: {plot_format}")
+        self.fig_path = fig_path
+        self.plot_format = plot_format
+        self.top_n = top_n
+        self.workers = workers or 1
+        self.chunksize = chunksize
+        self.should_stop = should_stop
+        self.paths = []
+        self._buffer = []
+        self._best = {}       # compound name -> heap of (score, -sequence, record), the lowest score (latest on ties) on top
+        self._sequence = 0
+        self._pending = deque()
+        self._plotter = None
+        self._pool = None
+        self._stopped = False
+
+    def add(self, records):
+        for record in records:
+            if self.top_n:
+                heap = self._best.setdefault(record.name, [])
+                item = (record.score, -self._sequence, record)
+                self._sequence += 1
+                if len(heap) < self.top_n:
+                    heapq.heappush(heap, item)
+                else:
+                    heapq.heappushpop(heap, item)
+            else:
+                self._buffer.append(record)
+                if len(self._buffer) >= self.chunksize:
+                    self._submit(self._buffer)
+                    self._buffer = []
+
+    def _stop_requested(self) -> bool:
+        self._stopped = self._stopped or (self.should_stop is not None and self.should_stop())
+        return self._stopped
+
+    def _submit(self, chunk, parallel=True):
+        if self._stop_requested():
+            return
+        if self.workers <= 1 or not parallel:
+            if self._plotter is None:
+                self._plotter = MirrorPlotter(self.plot_format)
+            self.paths.extend(self._plotter.render(record, self.fig_path) for record in chunk)
+            return
+        if self._pool is None:
+            # never forked from this process, which runs the scan reader thread (and the GUI threads); the workers
+            # only need the plot format and folder
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+                                                  else 'spawn')
+            self._pool = context.Pool(self.workers, initializer=_init_plot_worker, initargs=(self.plot_format, self.fig_path))
+        self._pending.append(self._pool.apply_async(_render_chunk, (chunk,)))
+        while len(self._pending) > 2 * self.workers:
+            self.paths.extend(self._pending.popleft().get())
+
+    def close(self) -> list:
+        '''Render what is left and wait for the workers; returns the paths of all rendered plots.'''
+        try:
+            if self.top_n:
+                selected = []
+                for heap in self._best.values():
+                    selected.extend(item[2] for item in sorted(heap, key=lambda item: (-item[0], -item[1])))
+                self._best = {}
+                self._buffer = sorted(selected, key=lambda record: record.scan)
+            chunks = [self._buffer[start:start + self.chunksize] for start in range(0, len(self._buffer), self.chunksize)]
+            self._buffer = []
+            # a pool is only started for more than one chunk
+            parallel = self._pool is not None or len(chunks) > 1
+            for chunk in chunks:
+                self._submit(chunk, parallel)
+            while self._pending and not self._stop_requested():
+                self.paths.extend(self._pending.popleft().get())
+        finally:
+            self._shutdown()
+        return self.paths
+
+    def _shutdown(self):
+        if self._pool is not None:
+            self._pool.terminate()   # after close all results are collected, or they are no longer wanted
+            self._pool.join()
+            self._pool = None
+        self._pending.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._shutdown()
+
+
+def render_plots(records, fig_path, plot_format='svg', top_n=None, workers=1, chunksize=16, should_stop=None) -> list:
+    '''Render the mirror plots of the records into fig_path and return the written paths.
+    With workers > 1 the records are split into chunks that are rendered by a pool of worker processes,
+    each drawing on its own figure. should_stop() is checked between chunks; rendering then stops early.'''
+    with PlotStream(fig_path, plot_format, top_n, workers, chunksize, should_stop) as stream:
+        stream.add(records)
+    return stream.paths
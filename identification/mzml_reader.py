@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''Direct reader for mzML scans.
+
+pyteomics builds a nested dictionary with every cvParam of a spectrum and decodes all of its binary arrays, while the
+identification only needs the ms level, the isolation window target m/z, the FAIMS compensation voltage and, for MS2
+scans, the m/z and intensity arrays. A DirectMzMLReader memory-maps the file, finds a spectrum through the offsets of
+the mzML index (or one regular expression pass over the file when it is not indexed), parses only that spectrum and
+decodes the two arrays (base64, zlib, MS-Numpress when pynumpress is installed) straight into NumPy arrays.
+
+A spectrum the reader does not handle (referenceable parameter groups, unknown compression, ...) raises
+UnsupportedSpectrum, QueryTargetedSpectrum then decodes it with pyteomics. So does opening a file in which it finds no
+spectra, such as one whose elements carry a namespace prefix; the whole file is then read with pyteomics.'''
+
+import re
+import mmap
+import zlib
+import base64
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+try:
+    import pynumpress   # optional dependency, only needed for MS-Numpress compressed arrays
+except ImportError:
+    pynumpress = None
+
+DTYPES = {'MS:1000521': np.dtype('<f4'), 'MS:1000523': np.dtype('<f8'),
+          'MS:1000519': np.dtype('<i4'), 'MS:1000522': np.dtype('<i8')}
+
+# compression accession -> (zlib first, numpress decoder name)
+COMPRESSIONS = {'MS:1000576': (False, None), 'MS:1000574': (True, None),
+                'MS:1002312': (False, 'decode_linear'), 'MS:1002313': (False, 'decode_pic'), 'MS:1002314': (False, 'decode_slof'),
+                'MS:1002746': (True, 'decode_linear'), 'MS:1002747': (True, 'decode_pic'), 'MS:1002748': (True, 'decode_slof')}
+
+MZ_ARRAY, INTENSITY_ARRAY = 'MS:1000514', 'MS:1000515'
+MS_LEVEL = 'MS:1000511'
+ISOLATION_TARGET = 'MS:1000827'
+COMPENSATION_VOLTAGE = 'MS:1001581'
+
+_INDEX_LIST_OFFSET = re.compile(rb'<indexListOffset>\s*(\d+)\s*</indexListOffset>')
+_SPECTRUM_INDEX = re.compile(rb'<index\s+name="spectrum"\s*>(.*?)</index>', re.S)
+_OFFSET = re.compile(rb'<offset\b[^>]*>\s*(\d+)\s*</offset>')
+_SPECTRUM_START = re.compile(rb'<spectrum[\s>]')
+
+
+class UnsupportedSpectrum(ValueError):
+    '''The spectrum uses mzML features the direct reader does not decode.'''
+
+
+def _local(tag) -> str:
+    return tag.rsplit('}', 1)[-1]
+
+
+def _cv_params(element) -> dict:
+    '''{accession: value} of the cvParams directly under element.'''
+    params = {}
+    for child in element:
+        tag = _local(child.tag)
+        if tag == 'cvParam':
+            params[child.get('accession')] = child.get('value')
+        elif tag == 'referenceableParamGroupRef':
+            raise UnsupportedSpectrum('referenceable parameter groups are read with pyteomics')
+    return params
+
+
+def _child(element, name):
+    for child in element:
+        if _local(child.tag) == name:
+            return child
+    return None
+
+
+def decode_array(text, dtype, compression) -> np.ndarray:
+    '''Decode the base64 text of a binaryDataArray.'''
+    if not text or not text.strip():
+        return np.empty(0, dtype=np.float64 if compression[1] else dtype)
+    data = base64.b64decode(text)
+    use_zlib, numpress = compression
+    if use_zlib:
+        data = zlib.decompress(data)
+    if numpress is not None:
+        if pynumpress is None:
+            raise UnsupportedSpectrum('MS-Numpress arrays need pynumpress')
+        return np.asarray(getattr(pynumpress, numpress)(np.frombuffer(data, dtype=np.uint8)))
+    return np.frombuffer(data, dtype=dtype)
+
+
+class DirectMzMLReader:
+
+    '''Random access to the scans of an mzML file by their position in the file.'''
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._file = open(filepath, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:   # an empty file can not be mapped
+            self._file.close()
+            raise UnsupportedSpectrum(f"{filepath} is empty")
+        self.offsets = self._index_offsets()
+        if self.offsets is None:
+            self.offsets = [match.start() for match in _SPECTRUM_START.finditer(self._map)]
+        if not self.offsets:   # e.g. namespace prefixed elements (<mzml:spectrum>), or no spectra at all
+            self.close()
+            raise UnsupportedSpectrum(f"no <spectrum> elements found in {filepath}")
+
+    def _index_offsets(self):
+        '''Spectrum offsets of the mzML index, None when there is no index or it does not point at spectra.'''
+        tail = self._map[max(0, len(self._map) - 4096):]
+        match = _INDEX_LIST_OFFSET.search(tail)
+        if match is None:
+            return None
+        index_list = self._map[int(match.group(1)):]
+        match = _SPECTRUM_INDEX.search(index_list)
+        if match is None:
+            return None
+        offsets = [int(offset) for offset in _OFFSET.findall(match.group(1))]
+        for offset in offsets[:1] + offsets[-1:]:
+            if not _SPECTRUM_START.match(self._map, offset):
+                return None
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def _element(self, scan):
+        start = self.offsets[scan]
+        stop = self._map.find(b'</spectrum>', start)
+        if stop < 0:
+            raise UnsupportedSpectrum(f"spectrum {scan} is not closed")
+        try:
+            return ET.fromstring(self._map[start:stop + len(b'</spectrum>')])
+        except ET.ParseError as e:   # e.g. namespace prefixes declared outside of the spectrum
+            raise UnsupportedSpectrum(str(e))
+
+    @staticmethod
+    def _header(spectrum) -> tuple:
+        '''ms level, precursor and compensation voltage with the same rules as QueryTargetedSpectrum._header_mzml.'''
+        params = _cv_params(spectrum)
+        if MS_LEVEL not in params:
+            raise UnsupportedSpectrum('no ms level')
+        precursor = float('Nan')
+        precursor_list = _child(spectrum, 'precursorList')
+        if precursor_list is not None:
+            first = _child(precursor_list, 'precursor')
+            window = _child(first, 'isolationWindow') if first is not None else None
+            target = _cv_params(window).get(ISOLATION_TARGET) if window is not None else None
+            if target is None:
+                raise UnsupportedSpectrum('precursor without isolation window target m/z')
+            precursor = float(target)
+        comp_vol = float(params[COMPENSATION_VOLTAGE]) if COMPENSATION_VOLTAGE in params else float('Nan')
+        return int(params[MS_LEVEL]), precursor, comp_vol
+
+    def header(self, scan) -> tuple:
+        '''(ms level, precursor m/z, compensation voltage) of a scan without decoding its arrays.'''
+        return self._header(self._element(scan))
+
+    def spectrum(self, scan, array_levels=None) -> tuple:
+        '''(ms level, precursor m/z, compensation voltage, m/z array, intensity array); the arrays are only decoded
+        for the ms levels in array_levels (all when None), they are None otherwise.'''
+        spectrum = self._element(scan)
+        ms_level, precursor, comp_vol = self._header(spectrum)
+        if array_levels is not None and ms_level not in array_levels:
+            return ms_level, precursor, comp_vol, None, None
+        decoded = {}
+        array_list = _child(spectrum, 'binaryDataArrayList')
+        for array in (array_list if array_list is not None else ()):
+            params = _cv_params(array)
+            kind = MZ_ARRAY if MZ_ARRAY in params else INTENSITY_ARRAY if INTENSITY_ARRAY in params else None
+            if kind is None:
+                continue
+            dtypes = [DTYPES[accession] for accession in params if accession in DTYPES]
+            compressions = [COMPRESSIONS[accession] for accession in params if accession in COMPRESSIONS]
+            if len(dtypes) != 1 or len(compressions) != 1:
+                raise UnsupportedSpectrum('unknown binary data type or compression')
+            binary = _child(array, 'binary')
+            decoded[kind] = decode_array(binary.text if binary is not None else None, dtypes[0], compressions[0])
+        if len(decoded) != 2:
+            raise UnsupportedSpectrum('m/z or intensity array missing')
+        return ms_level, precursor, comp_vol, decoded[MZ_ARRAY], decoded[INTENSITY_ARRAY]
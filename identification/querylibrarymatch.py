@@ -4,133 +4,506 @@
 import sys
 import os
 import uuid
-import matplotlib.pyplot as plt
 import os
 import glob
 import numpy as np
 import heapq
 import re
+import time
+import logging
+import logging.handlers
+import multiprocessing
+import traceback
+from contextlib import nullcontext, contextmanager
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 
-from LibraryHandling import LibraryLoadingStrategy, LibraryReformat, LibrarySaveStrategy, read_path
-from IdentificationMeta import QueryTargetedSpectrum, match_spectrum, group_tuples_by_same_value, filter_tuples, cosine_similarity, custom_sort, macc_score, normalize_to_100
+from LibraryHandling import LibraryLoadingStrategy, LibraryReformat, LibrarySaveStrategy, read_path, build_fragment_index, library_fingerprint
+from IdentificationMeta import QueryTargetedSpectrum, match_spectrum, group_tuples_by_same_value, filter_tuples, cosine_similarity, custom_sort, macc_score, normalize_to_100, batch_cosine_similarity
+from mirror_plots import MirrorPlotter, PlotStream, make_plot_record, sanitize_filename
+from result_writer import ResultWriter, PEAK_LIST_KEY
+from stage_profiler import StageProfiler, NULL_PROFILER
+from candidate_cache import CandidateCache, DEFAULT_CACHE_DIR
+from scan_consolidation import ConsolidatedSpectra
+from scan_store import DEFAULT_STORE_DIR
 import pandas as pd 
 
 #result_dict = defaultdict(list)
 
     
-def get_spectra(analyzer, scan_index, library, PrecursorIonMassTolerance):
-    query_spectrum = analyzer.get_query_spectrum(scan_index)
-    realtime_library = analyzer.get_realtime_lib(scan_index, library, PrecursorIonMassTolerance)
-    target_spectrum = analyzer.get_target_spectrum(scan_index, library, PrecursorIonMassTolerance)
+def get_spectra(analyzer, scan_index, library, PrecursorIonMassTolerance, profiler=NULL_PROFILER, open_search=None,
+                candidate_cache=None):
+    # open_search holds the get_open_lib options when the candidates are not selected by precursor m/z
+    with profiler.stage('get_query_spectrum'):
+        query_spectrum = analyzer.get_query_spectrum(scan_index)
+    if open_search is None and candidate_cache is not None:
+        with profiler.stage('get_cached_candidates'):
+            realtime_library, target_spectrum = analyzer.get_candidates(scan_index, library, PrecursorIonMassTolerance, candidate_cache)
+        return query_spectrum, realtime_library, target_spectrum
+    with profiler.stage('get_realtime_lib'):
+        if open_search is None:
+            realtime_library = analyzer.get_realtime_lib(scan_index, library, PrecursorIonMassTolerance)
+        else:
+            realtime_library = analyzer.get_open_lib(scan_index, library, **open_search)
+    with profiler.stage('get_target_spectrum'):
+        target_spectrum = analyzer.get_target_arrays(scan_index, library, PrecursorIonMassTolerance, realtime_library)
     return query_spectrum, realtime_library, target_spectrum
 
 
-def match_and_calculate_cosine_similarity(query_spectrum, target_spectrum, ppm_tolerance, minmatchedpeaks):
-    matched_peaks = match_spectrum(query_spectrum, target_spectrum, ppm_tolerance)
-    cosine_scores = []
-    for matched_spectrum in group_tuples_by_same_value(matched_peaks, -1):
-        filtered_matches = filter_tuples(matched_spectrum)
-        if len(filtered_matches) >= minmatchedpeaks:
-            cosine_score = cosine_similarity([t[1] for t in filtered_matches], [t[4] for t in filtered_matches])
-            cosine_scores.append((cosine_score, filtered_matches))
-    return cosine_scores
+def match_and_calculate_cosine_similarity(query_spectrum, target_spectrum, ppm_tolerance, minmatchedpeaks, tolerance_unit='ppm', pair_counts=None):
+    # all candidates of the scan are matched and scored together, see batch_cosine_similarity
+    return batch_cosine_similarity(query_spectrum, target_spectrum, ppm_tolerance, minmatchedpeaks, tolerance_unit, pair_counts)
 
-def sanitize_filename(filename):
-    # Replace any invalid characters with an underscore
-    return re.sub(r'[<>:"/\\|?*]', '_', filename)
-    
-def generate_plot(compound_info, cos, scan_index, fig_path):
-# Normalize intensities to 100
-    real_query_spectrum = cos[1]
-    library_mz = compound_info['mz']
-    library_intensity = normalize_to_100(compound_info['intensity'])
-    query_mz = [x[0] for x in real_query_spectrum]
-    query_intensity = normalize_to_100([x[1] for x in real_query_spectrum])
-    plt.rcParams['font.family'] = 'Arial'
-    # Plot library spectrum
-    plt.vlines(library_mz, [0], library_intensity, colors="red", label='Library Spectrum')
-    # Plot query spectrum (inverted)
-    plt.vlines(query_mz, [0], [-item for item in query_intensity], colors="blue", label='Query Spectrum')  
-    # Plot horizontal line at y=0
-    plt.axhline(y=0, color='gray', alpha = 0.8, linewidth=1)
-    plt.legend()
-    plt.title(f"{compound_info.get('name', 'Unknown Compound')} | Cosine Score: {cos[0]:.2f} | Scan: {scan_index}") 
-    # Sanitize the compound name for the filename
-    compound_name = compound_info.get('name', 'Unknown Compound')
-    sanitized_name = sanitize_filename(compound_name)
-    # Create the filename using the sanitized compound name
-    filename = f"{sanitized_name}_{scan_index}.svg"
-    # Save the figure
-    plt.savefig(os.path.join(fig_path, filename), dpi=300, bbox_inches='tight')
-    # plt.show()
-    plt.close()
+def generate_plot(compound_info, cos, scan_index, fig_path, plot_format='svg'):
+    # draws a single match right away, the identification streams the matches to a PlotStream
+    return MirrorPlotter(plot_format).render(make_plot_record(compound_info, cos, scan_index), fig_path)
 
 
-def main_processing_function(lowerscan,higherscan, analyzer, library, PrecursorIonMassTolerance, 
-                             cosine_threshold, ppm_tolerance, minmatchedpeaks, fig_path, generate_plots=False):
+class AnalysisCancelled(Exception):
+    """Raised when an identification run is stopped through its should_stop callback."""
+
+
+def new_result_dict(keep_peaks=False) -> dict:
     result_dict = { 'PrecursorMZ': [],'Compensation Voltage': [], 'Cosine_score': [], 'Ion_count': [], 'Scan': [], 
-                   'Compound': [], 'CompoundMZ': [], 'Adduct': [], 'Formula': [], 'Macc_score': [], 'Matched_peaks': [] }
-    #result_dict = {}
-    for scan_index in range(lowerscan,higherscan):
-        query_spectrum, realtime_library, target_spectrum = get_spectra(analyzer, scan_index, library, PrecursorIonMassTolerance)
+                    'Compound': [], 'CompoundMZ': [], 'Adduct': [], 'Formula': [], 'Macc_score': [], 'Matched_peaks': [] }
+    if keep_peaks:
+        result_dict[PEAK_LIST_KEY] = []
+    return result_dict
+
+
+def main_processing_function(lowerscan,higherscan, analyzer, library, PrecursorIonMassTolerance, 
+                             cosine_threshold, ppm_tolerance, minmatchedpeaks, fig_path, generate_plots=False, tolerance_unit='ppm',
+                             workers=1, chunksize=None, progress_callback=None, should_stop=None, plot_format='svg', plot_top_n=None,
+                             keep_peaks=False, result_sink=None, profiler=None, search_mode='precursor', open_top_k=50,
+                             candidate_cache=None, prefetch_depth=0):
+    '''Identify the scans in range(lowerscan, higherscan).
+    With workers > 1 the scan range is split into chunks that are identified in worker processes, each with its own
+    reader for analyzer.filepath and a read-only copy of the library; the result columns are merged back in scan order,
+    so the result is the same as the serial run. A worker process that dies raises BrokenProcessPool.
+    After every chunk progress_callback(done_scans, total_scans) is called and should_stop() is checked;
+    AnalysisCancelled is raised when it returns True.
+    With generate_plots the mirror plots of the matches are rendered by a PlotStream while identifying, on half of the
+    workers, keeping the plot_top_n best matches per compound (all when None); only the records of the
+    chunks in flight, or the plot_top_n best per compound, are held in memory.
+    With a result_sink (a ResultWriter) every chunk of rows is written to it as soon as it is identified and the
+    returned dict stays empty; keep_peaks adds the matched peaks of every row.
+    A StageProfiler as profiler collects the stage timings and per-scan counters, also from the worker processes.
+    search_mode 'open' ignores the precursor m/z: every scan is scored against the open_top_k library spectra that
+    share the most fragment peaks with it, found in a FragmentIndex of the whole library.
+    A CandidateCache of the library reuses the candidates of repeated precursor windows; the entries the workers
+    add are collected into it.
+    prefetch_depth > 0 decodes that many scans ahead in a reader thread (see QueryTargetedSpectrum.prefetching).'''
+    profiler = profiler or NULL_PROFILER
+    fragment_index = None
+    if search_mode == 'open':
+        with profiler.stage('build_fragment_index'):
+            fragment_index = build_fragment_index(library)
+    elif search_mode != 'precursor':
+        raise ValueError(f"Unsupported search mode: {search_mode}")
+    args = (library, PrecursorIonMassTolerance, cosine_threshold, ppm_tolerance, minmatchedpeaks, fig_path, generate_plots, tolerance_unit,
+            keep_peaks, search_mode, open_top_k, fragment_index, prefetch_depth, candidate_cache)
+    parallel = workers is not None and workers > 1 and higherscan - lowerscan >= 2
+
+    if chunksize is None:
+        # about four chunks per worker, or small chunks to report progress from a serial run
+        chunksize = max(1, -(-(higherscan - lowerscan) // (workers * 4))) if parallel else 100
+    if not parallel and progress_callback is None and should_stop is None and result_sink is None and not generate_plots:
+        chunksize = max(1, higherscan - lowerscan)
+    chunks = [(start, min(start + chunksize, higherscan)) for start in range(lowerscan, higherscan, chunksize)]
+    result_dict = new_result_dict(keep_peaks)
+    done = 0
+    pool = _scan_pool(min(workers, len(chunks)), analyzer, args, profiler) if parallel else nullcontext()
+    # the serial run prefetches the whole range with one reader thread, workers prefetch their own chunks
+    prefetch = nullcontext() if parallel else analyzer.prefetching(lowerscan, higherscan, prefetch_depth)
+    # the plot renderers share the budget of `workers` processes with the scan workers
+    plots = (PlotStream(fig_path, plot_format, plot_top_n, max(1, (workers or 1) // 2), should_stop=should_stop)
+             if generate_plots else nullcontext())
+    # leaving the block terminates the workers, the reader thread and the plot renderers, also when the run is cancelled
+    with plots, pool as executor, prefetch:
+        if parallel:
+            # in chunk order; a worker that dies raises BrokenProcessPool here instead of blocking the run
+            chunk_results = executor.map(_process_scan_chunk, chunks)
+        else:
+            chunk_results = (_process_serial_chunk(start, stop, analyzer, args, profiler) for start, stop in chunks)
+        for (start, stop), (chunk_result, chunk_plot_records, chunk_profiler, new_candidates) in zip(chunks, chunk_results):
+            if chunk_profiler is not None:
+                profiler.merge(chunk_profiler)
+            if new_candidates:
+                candidate_cache.update(new_candidates)
+            if result_sink is not None:
+                with profiler.stage('write_results'):
+                    result_sink.write(chunk_result)
+            else:
+                for key, values in chunk_result.items():
+                    result_dict[key].extend(values)
+            if chunk_plot_records:
+                with profiler.stage('render_plots'):
+                    plots.add(chunk_plot_records)
+            done += stop - start
+            if progress_callback is not None:
+                progress_callback(done, higherscan - lowerscan)
+            if should_stop is not None and should_stop():
+                raise AnalysisCancelled(f"Cancelled after {done} of {higherscan - lowerscan} scans")
+        if generate_plots:
+            with profiler.stage('render_plots'):
+                plots.close()
+    return result_dict
+
+def _process_serial_chunk(lowerscan, higherscan, analyzer, args, profiler):
+    plot_records = []
+    result_dict = process_scan_range(lowerscan, higherscan, analyzer, *args, plot_records=plot_records, profiler=profiler)
+    return result_dict, plot_records, None, None
+
+
+def _process_context():
+    # fork lets the workers share the loaded library pages copy-on-write instead of unpickling a copy each; it is only
+    # safe on Linux, macOS system frameworks (Accelerate, Objective-C runtime) do not survive it
+    if sys.platform.startswith('linux'):
+        return multiprocessing.get_context('fork')
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+@contextmanager
+def _scan_pool(workers, analyzer, args, profiler):
+    '''ProcessPoolExecutor of scan workers, terminated right away when the run fails or is cancelled.'''
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=_process_context(), initializer=_init_scan_worker,
+                               initargs=(type(analyzer), analyzer.settings(), args, profiler.settings()))
+    try:
+        yield pool
+    except BaseException:
+        for process in list(pool._processes.values()):   # the chunks in flight are not waited for
+            process.terminate()
+        raise
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+_worker_state = {}
+
+def _init_scan_worker(analyzer_class, analyzer_settings, args, profiler_settings=None):
+    # a reader of its own for every worker, of the same class (plain or consolidated) as the one of the file
+    _worker_state['analyzer'] = analyzer_class(**analyzer_settings)
+    _worker_state['args'] = args
+    _worker_state['profiler_settings'] = profiler_settings
+
+def _process_scan_chunk(bounds):
+    lowerscan, higherscan = bounds
+    plot_records = []
+    settings = _worker_state['profiler_settings']
+    profiler = StageProfiler(**settings) if settings is not None else None
+    result_dict = process_scan_range(lowerscan, higherscan, _worker_state['analyzer'], *_worker_state['args'],
+                                     plot_records=plot_records, profiler=profiler or NULL_PROFILER)
+    candidate_cache = _worker_state['args'][-1]   # the candidate cache is the last of the args
+    new_candidates = candidate_cache.new_entries() if candidate_cache is not None else None
+    return result_dict, plot_records, profiler, new_candidates
+
+
+def process_scan_range(lowerscan,higherscan, analyzer, library, PrecursorIonMassTolerance, 
+                       cosine_threshold, ppm_tolerance, minmatchedpeaks, fig_path, generate_plots=False, tolerance_unit='ppm',
+                       keep_peaks=False, search_mode='precursor', open_top_k=50, fragment_index=None, prefetch_depth=0,
+                       candidate_cache=None, plot_records=None, profiler=NULL_PROFILER):
+    '''Identify the scans in range(lowerscan, higherscan); with generate_plots a PlotRecord of every match is appended
+    to plot_records for rendering later, or the plot is drawn right away when no list is given.
+    In the 'open' search_mode the candidates come from fragment_index (built from the library when not given).
+    prefetch_depth > 0 decodes the scans ahead in a reader thread, unless the analyzer is already prefetching.'''
+    result_dict = new_result_dict(keep_peaks)
+    open_search = None
+    if search_mode == 'open':
+        open_search = {'fragment_index': fragment_index or build_fragment_index(library), 'tolerance': ppm_tolerance,
+                       'unit': tolerance_unit, 'top_k': open_top_k, 'min_shared': max(1, minmatchedpeaks)}
+    with analyzer.prefetching(lowerscan, higherscan, prefetch_depth):
+        #result_dict = {}
+        for scan_index in range(lowerscan,higherscan):
+            profiler.scan(scan_index)
+            query_spectrum, realtime_library, target_spectrum = get_spectra(analyzer, scan_index, library, PrecursorIonMassTolerance, profiler,
+                                                                            open_search, candidate_cache)
         
-        cosine_scores = match_and_calculate_cosine_similarity(query_spectrum, target_spectrum, ppm_tolerance, minmatchedpeaks)
+            # matching and scoring run together for all candidates, see batch_cosine_similarity
+            pair_counts = []
+            with profiler.stage('match_and_score'):
+                cosine_scores = match_and_calculate_cosine_similarity(query_spectrum, target_spectrum, ppm_tolerance, minmatchedpeaks,
+                                                                      tolerance_unit, pair_counts)
+            collect_start = time.perf_counter()
+            filtered_scores = []
         
-        if cosine_scores:           
-            # Filter cosine scores based on the threshold
-            filtered_scores = [cos for cos in cosine_scores if cos[0] > cosine_threshold]           
-            if not filtered_scores:
-                # If no scores meet the threshold, select the strongest top one
-                filtered_scores = [max(cosine_scores, key=lambda x: x[0])]   
-            # Process each selected score
-            for cos in filtered_scores:
-                number = int(cos[1][0][-1])
-                ioncount = round(sum([it[1] for it in cos[1]]), 3)
+            if cosine_scores:           
+                # Filter cosine scores based on the threshold
+                filtered_scores = [cos for cos in cosine_scores if cos[0] > cosine_threshold]           
+                if not filtered_scores:
+                    # If no scores meet the threshold, select the strongest top one
+                    filtered_scores = [max(cosine_scores, key=lambda x: x[0])]   
+                # Process each selected score
+                for cos in filtered_scores:
+                    number = int(cos[1][0][-1])
+                    ioncount = round(sum([it[1] for it in cos[1]]), 3)
                 
-                # Retrieve compound information
-                try:
-                    compound_info = realtime_library[number]
-                except IndexError:
-                    # Handle case where index is out of bounds
-                    compound_info = {}               
-#         if cosine_scores:
-#             cos = sorted(cosine_scores, key=lambda x: custom_sort(x), reverse=True)[0]  # here only select the top 1 matched spectrum
-#             number = int(cos[1][0][-1])
-#             ioncount = round(sum([it[1] for it in cos[1]]), 3)
-#             try:
-#                 compound_info = realtime_library[number]
+                    # Retrieve compound information
+                    try:
+                        compound_info = realtime_library[number]
+                    except IndexError:
+                        # Handle case where index is out of bounds
+                        compound_info = {}               
+    #         if cosine_scores:
+    #             cos = sorted(cosine_scores, key=lambda x: custom_sort(x), reverse=True)[0]  # here only select the top 1 matched spectrum
+    #             number = int(cos[1][0][-1])
+    #             ioncount = round(sum([it[1] for it in cos[1]]), 3)
+    #             try:
+    #                 compound_info = realtime_library[number]
             
-#             except IndexError:
-#                 # If `number` is out of bounds for `realtime_library`
-#                 compound_info = {}
+    #             except IndexError:
+    #                 # If `number` is out of bounds for `realtime_library`
+    #                 compound_info = {}
             
-            #result_dict, compound_info, number = update_results(cos, scan_index, analyzer, realtime_library, result_dict)
-            #compound_info = realtime_library.get(number, {})
-                result_dict['PrecursorMZ'].append(str(analyzer.get_precusorMZ(scan_index)))
-                result_dict['Cosine_score'].append(cos[0])
-                result_dict['Ion_count'].append(ioncount)
-                result_dict['Scan'].append(scan_index)
-                result_dict['Compound'].append(compound_info.get('name', ''))
-                result_dict['CompoundMZ'].append(compound_info.get('precursormz', ''))
-                result_dict['Adduct'].append(compound_info.get('precursortype', '').upper())
-                result_dict['Formula'].append(compound_info.get('formula', '').upper())
-                result_dict['Macc_score'].append(macc_score(len(cos[1]), cos[0]))
-                result_dict['Matched_peaks'].append(len(cos[1])) 
-                result_dict['Compensation Voltage'].append(str(analyzer.get_compensation_voltage(scan_index))) 
-                # **Generate plot for each match if enabled**
-                if generate_plots:
-                    generate_plot(compound_info, cos, scan_index, fig_path)
+                #result_dict, compound_info, number = update_results(cos, scan_index, analyzer, realtime_library, result_dict)
+                #compound_info = realtime_library.get(number, {})
+                    result_dict['PrecursorMZ'].append(analyzer.get_precusorMZ(scan_index))
+                    result_dict['Cosine_score'].append(cos[0])
+                    result_dict['Ion_count'].append(ioncount)
+                    result_dict['Scan'].append(scan_index)
+                    result_dict['Compound'].append(compound_info.get('name', ''))
+                    result_dict['CompoundMZ'].append(compound_info.get('precursormz', ''))
+                    result_dict['Adduct'].append(compound_info.get('precursortype', '').upper())
+                    result_dict['Formula'].append(compound_info.get('formula', '').upper())
+                    result_dict['Macc_score'].append(cos[2])
+                    result_dict['Matched_peaks'].append(len(cos[1])) 
+                    result_dict['Compensation Voltage'].append(analyzer.get_compensation_voltage(scan_index))
+                    if keep_peaks:
+                        result_dict[PEAK_LIST_KEY].append([(peak[0], peak[1], peak[3], peak[4]) for peak in cos[1]])
+                    # **Generate plot for each match if enabled**
+                    if generate_plots and plot_records is not None:
+                        plot_records.append(make_plot_record(compound_info, cos, scan_index))
+                    elif generate_plots:
+                        generate_plot(compound_info, cos, scan_index, fig_path)
+            profiler.add('collect_results', time.perf_counter() - collect_start)
+            if profiler.enabled and query_spectrum:
+                # all counters over the same scans, the matched pairs before the filter_tuples and minmatchedpeaks filters
+                profiler.count('candidates_per_scan', len(realtime_library))
+                profiler.count('matched_pairs_per_scan', pair_counts[0])
+                profiler.count('hits_per_scan', len(filtered_scores))
+    profiler.finish()
     return result_dict
 
     
 def save_results(result_dict, fig_path, mzml_file_path):
     
     df = pd.DataFrame(result_dict)
-    df.to_excel(os.path.join(fig_path, f"{mzml_file_path.split('/')[-1].split('.')[0]}.xlsx"), index=False)
+    df.to_excel(result_base_path(fig_path, mzml_file_path) + '.xlsx', index=False)
+
+
+def result_base_path(fig_path, mzml_file_path) -> str:
+    # results are named after the input file without its extension, so a.1.mzML and a.2.mzML get different names
+    return os.path.join(fig_path, os.path.splitext(os.path.basename(mzml_file_path))[0])
+
+
+def process_file(InputFilePath, library, lowerscan, higherscan, PrecursorIonMassTolerance, cosine_threshold, ppm_tolerance,
+                 minmatchedpeaks, intensity_threshold, fig_path, generate_plots=False, tolerance_unit='ppm', workers=1,
+                 progress_callback=None, should_stop=None, plot_format='svg', plot_top_n=None,
+                 result_format='csv', keep_peaks=False, export_excel=False, profile=False, profile_scans=None,
+                 profile_backend='cprofile', search_mode='precursor', open_top_k=50, cache_candidates=True,
+                 persist_candidates=False, candidate_cache_dir=None, consolidate_scans=False, consolidation_min_fraction=0.0,
+                 prefetch_scans=64, reader='direct', store_scans=False, scan_store_dir=None):
+    '''Identify one input file and stream its results to <fig_path>/<file name>.<result_format>, with an .xlsx copy
+    when export_excel is set; a higherscan of 1 means up to the last scan of the file. Returns the number of rows.
+    With profile the stage timings are logged and saved to <file name>_profile.json; profile_scans=(lower, higher)
+    also runs a cProfile/pyinstrument session over those scans.
+    cache_candidates reuses the candidates of repeated precursor windows within the file; with persist_candidates they
+    are also saved to and loaded from candidate_cache_dir (DEFAULT_CACHE_DIR when None) for later runs.
+    consolidate_scans identifies every group of MS2 scans with the same precursor window and compensation voltage once,
+    on their consensus spectrum (see ConsolidatedSpectra); the rows carry the first scan of the group.
+    prefetch_scans is the read-ahead depth of the reader thread, 0 decodes the scans in turn with the scoring.
+    reader selects how mzML scans are decoded: 'direct' (DirectMzMLReader, pyteomics for what it does not handle) or
+    'pyteomics'. With store_scans the file is converted once to a ScanStore in scan_store_dir (DEFAULT_STORE_DIR when
+    None) and this and later runs read the scans from it instead of the XML.'''
+    base_path = result_base_path(fig_path, InputFilePath)
+    candidate_cache = None
+    if cache_candidates and search_mode == 'precursor':
+        candidate_cache = CandidateCache(library, cache_dir=(candidate_cache_dir or DEFAULT_CACHE_DIR) if persist_candidates else None)
+    profiler = None
+    if profile or profile_scans:
+        profiler = StageProfiler(profile_scans, profile_backend, session_path=base_path + '_profile')
+    scan_store = (scan_store_dir or DEFAULT_STORE_DIR) if store_scans else None
+    with profiler.stage('open_scan_store') if profiler is not None and store_scans else nullcontext():
+        analyzer = QueryTargetedSpectrum(InputFilePath, intensity_threshold, reader=reader, scan_store=scan_store)
+    try:
+        if higherscan == 1:
+            higherscan = analyzer.get_scans()
+        if consolidate_scans:
+            with profiler.stage('consolidate_scans') if profiler is not None else nullcontext():
+                analyzer = ConsolidatedSpectra.from_reader(analyzer, ppm_tolerance, tolerance_unit, consolidation_min_fraction,
+                                                           scan_range=(lowerscan, higherscan))
+            logging.info(f"{os.path.basename(InputFilePath)}: {len(analyzer.groups)} groups of repeated MS2 window scans")
+        with ResultWriter(base_path, result_format, keep_peaks) as writer:
+            main_processing_function(lowerscan, higherscan, analyzer, library, PrecursorIonMassTolerance,
+                                     cosine_threshold, ppm_tolerance, minmatchedpeaks, fig_path,
+                                     generate_plots=generate_plots, tolerance_unit=tolerance_unit, workers=workers,
+                                     progress_callback=progress_callback, should_stop=should_stop,
+                                     plot_format=plot_format, plot_top_n=plot_top_n, keep_peaks=keep_peaks, result_sink=writer,
+                                     profiler=profiler, search_mode=search_mode, open_top_k=open_top_k,
+                                     candidate_cache=candidate_cache, prefetch_depth=prefetch_scans)
+    finally:
+        analyzer.close()   # also the readers of a ConsolidatedSpectra, it reads through them
+    if candidate_cache is not None and candidate_cache.path is not None:
+        candidate_cache.save()
+    if export_excel:
+        start = time.perf_counter()
+        writer.export_excel()
+        if profiler is not None:
+            profiler.add('export_excel', time.perf_counter() - start)
+    if profiler is not None:
+        profiler.log_summary(os.path.basename(InputFilePath))
+        profiler.save(base_path + '_profile.json')
+    return writer.rows
+
+
+def batch_processing_function(InputFilePaths, library, lowerscan, higherscan, PrecursorIonMassTolerance, cosine_threshold,
+                              ppm_tolerance, minmatchedpeaks, intensity_threshold, fig_path, generate_plots=False,
+                              tolerance_unit='ppm', workers=1, progress_callback=None, scan_progress_callback=None,
+                              should_stop=None, plot_format='svg', plot_top_n=None, result_format='csv', keep_peaks=False,
+                              export_excel=False, profile=False, profile_scans=None, profile_backend='cprofile',
+                              search_mode='precursor', open_top_k=50, cache_candidates=True, persist_candidates=False,
+                              candidate_cache_dir=None, consolidate_scans=False, consolidation_min_fraction=0.0,
+                              prefetch_scans=64, reader='direct', store_scans=False, scan_store_dir=None) -> dict:
+    '''Identify many input files with at most `workers` files in flight at once.
+
+    The library is handed to the worker processes once at pool start (shared copy-on-write with fork).
+    A file that fails is reported and skipped, the rest of the batch keeps running; when the file kills its worker
+    process the pool is rebuilt and only that file is reported as failed.
+    progress_callback(file_path, done, total, error) is called in this process after every finished file and
+    scan_progress_callback(file_path, done_scans, total_scans) after every chunk of scans, also for the chunks identified
+    in the file workers. should_stop() is checked after every chunk, and every 0.2 s while files run in workers; when it
+    returns True, files not yet started are dropped, running files stop after their current chunk and
+    AnalysisCancelled is raised. The log records of the file workers, such as the stage timings of profiled files,
+    are logged in this process.
+    Returns {file_path: None for success or the error message}.'''
+    args = (lowerscan, higherscan, PrecursorIonMassTolerance, cosine_threshold, ppm_tolerance, minmatchedpeaks,
+            intensity_threshold, fig_path, generate_plots, tolerance_unit)
+    file_options = {'plot_format': plot_format, 'plot_top_n': plot_top_n, 'result_format': result_format,
+                    'keep_peaks': keep_peaks, 'export_excel': export_excel, 'profile': profile,
+                    'profile_scans': profile_scans, 'profile_backend': profile_backend, 'search_mode': search_mode,
+                    'open_top_k': open_top_k, 'cache_candidates': cache_candidates, 'persist_candidates': persist_candidates,
+                    'candidate_cache_dir': candidate_cache_dir, 'consolidate_scans': consolidate_scans,
+                    'consolidation_min_fraction': consolidation_min_fraction, 'prefetch_scans': prefetch_scans,
+                    'reader': reader, 'store_scans': store_scans, 'scan_store_dir': scan_store_dir}
+    status = {}
+
+    def report(file_path, error):
+        status[file_path] = error
+        if progress_callback is not None:
+            progress_callback(file_path, len(status), len(InputFilePaths), error)
+
+    def check_stop():
+        if should_stop is not None and should_stop():
+            raise AnalysisCancelled(f"Cancelled after {len(status)} of {len(InputFilePaths)} files")
+
+    if workers is None or workers <= 1 or len(InputFilePaths) < 2:
+        # a single file gets the workers for its scan range instead
+        for InputFilePath in InputFilePaths:
+            check_stop()
+            scan_progress = None
+            if scan_progress_callback is not None:
+                scan_progress = lambda done, total, path=InputFilePath: scan_progress_callback(path, done, total)
+            report(InputFilePath, _run_file(InputFilePath, library, args, file_options, workers or 1, scan_progress, should_stop))
+        return status
+
+    # When a worker process dies (segfault, out of memory killer) the whole pool breaks and every unfinished file fails
+    # with BrokenProcessPool. Each worker reports the files it starts, so the files that never started are resubmitted
+    # to a new pool and the ones that were running are run again one at a time to find the file that kills its worker.
+    if cache_candidates and persist_candidates and search_mode == 'precursor':
+        library_fingerprint(library)   # hashed once here, the forked workers inherit it with the library
+    pending, suspects = list(InputFilePaths), []
+    while pending or suspects:
+        if suspects:
+            batch, isolated = [suspects.pop(0)], True
+        else:
+            batch, isolated, pending = pending, False, []
+        context = _process_context()
+        messages, cancel = context.SimpleQueue(), context.Event()
+        started, broken = set(), []
+
+        def read_messages():
+            while not messages.empty():
+                message = messages.get()
+                if message[0] == 'started':
+                    started.add(message[1])
+                elif message[0] == 'log':
+                    record = message[1]
+                    logging.getLogger(record.name).handle(record)
+                elif scan_progress_callback is not None:
+                    scan_progress_callback(*message[1:])
+
+        with ProcessPoolExecutor(max_workers=1 if isolated else min(workers, len(batch)), mp_context=context,
+                                 initializer=_init_file_worker,
+                                 initargs=(library, messages, cancel, logging.getLogger().level)) as pool:
+            futures = {pool.submit(_process_file_job, InputFilePath, args, file_options): InputFilePath for InputFilePath in batch}
+            not_done = set(futures)
+            try:
+                while not_done:
+                    # poll, so scan progress and should_stop are handled while the files run
+                    done, not_done = wait(not_done, timeout=0.2, return_when=FIRST_COMPLETED)
+                    read_messages()
+                    for future in done:
+                        try:
+                            error = future.result()
+                        except BrokenProcessPool:
+                            broken.append(futures[future])
+                            continue
+                        except Exception as e:   # e.g. the arguments could not be sent to the worker
+                            error = f"{type(e).__name__}: {e}"
+                        report(futures[future], error)
+                    check_stop()
+            except AnalysisCancelled:
+                cancel.set()   # running files stop after their current chunk of scans
+                for future in futures:
+                    future.cancel()   # the others never start
+                raise
+        read_messages()
+        if not broken:
+            continue
+        running = [InputFilePath for InputFilePath in broken if InputFilePath in started]
+        if isolated or not running:   # nothing to narrow down, or the workers die before starting any file
+            running, broken = broken, []
+        pending += [InputFilePath for InputFilePath in broken if InputFilePath not in running]
+        if len(running) == 1:
+            report(running[0], "BrokenProcessPool: the worker process died while identifying this file")
+            check_stop()
+        else:
+            suspects += running
+    return {InputFilePath: status[InputFilePath] for InputFilePath in InputFilePaths}
+
+
+def _run_file(InputFilePath, library, args, file_options, workers=1, progress_callback=None, should_stop=None):
+    try:
+        process_file(InputFilePath, library, *args, workers=workers, progress_callback=progress_callback, should_stop=should_stop,
+                     **file_options)
+    except AnalysisCancelled:
+        raise
+    except Exception:
+        return traceback.format_exc()
+    return None
 
+class _MessageLogHandler(logging.handlers.QueueHandler):
 
+    '''Sends the log records of a file worker to the batch process as ('log', record) messages.'''
 
+    def enqueue(self, record):
+        self.queue.put(('log', record))
 
 
+def _init_file_worker(library, messages, cancel, log_level=logging.WARNING):
+    # the handlers inherited through fork (e.g. the log panel of the GUI) can not show the records of this process, and
+    # their locks may have been held by another thread of the parent; the records are logged in the batch process instead
+    root = logging.getLogger()
+    root.handlers = [_MessageLogHandler(messages)]
+    root.setLevel(log_level)
+    _worker_state['library'] = library
+    _worker_state['messages'] = messages
+    _worker_state['cancel'] = cancel
 
+def _process_file_job(InputFilePath, args, file_options):
+    messages = _worker_state['messages']
+    messages.put(('started', InputFilePath))
+    scan_progress = lambda done, total: messages.put(('progress', InputFilePath, done, total))
+    return _run_file(InputFilePath, _worker_state['library'], args, file_options, 1, scan_progress, _worker_state['cancel'].is_set)
 
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''Incremental, typed writer for identification results.
+
+Rows are appended chunk by chunk while the scans are identified, to a CSV or Parquet file, so a run never holds
+more than one chunk of results in memory. Excel output is only an export of the finished file.'''
+
+import logging
+import pandas as pd
+
+# column name -> dtype of the result table, in output order
+RESULT_COLUMNS = {'PrecursorMZ': 'float64', 'Compensation Voltage': 'float64', 'Cosine_score': 'float64',
+                  'Ion_count': 'float64', 'Scan': 'int64', 'Compound': 'object', 'CompoundMZ': 'float64',
+                  'Adduct': 'object', 'Formula': 'object', 'Macc_score': 'float64', 'Matched_peaks': 'int64'}
+
+# matched peak detail table, one row per matched query/library peak pair of every result row
+PEAK_COLUMNS = {'Scan': 'int64', 'Compound': 'object', 'Query_mz': 'float64', 'Query_intensity': 'float64',
+                'Library_mz': 'float64', 'Library_intensity': 'float64'}
+
+# result_dict key holding the (query m/z, query intensity, library m/z, library intensity) pairs of each row
+PEAK_LIST_KEY = 'Matched_peak_list'
+
+RESULT_FORMATS = ('csv', 'parquet')
+EXCEL_MAX_ROWS = 1048575
+
+
+def typed_frame(columns, dtypes) -> pd.DataFrame:
+    '''DataFrame of the given columns with the dtypes, numbers that cannot be parsed become NaN.'''
+    data = {}
+    for name, dtype in dtypes.items():
+        values = columns.get(name, [])
+        if dtype == 'float64':
+            data[name] = pd.to_numeric(pd.Series(values, dtype='object'), errors='coerce').astype('float64')
+        elif dtype == 'int64':
+            data[name] = pd.Series(values, dtype='int64')
+        else:
+            data[name] = pd.Series([str(value) for value in values], dtype='object')
+    return pd.DataFrame(data)
+
+
+class ResultWriter:
+
+    '''Streams result_dict chunks into <output_base>.csv or <output_base>.parquet.
+
+    With keep_peaks the matched peaks of every row (result_dict[PEAK_LIST_KEY]) go to <output_base>_peaks.<format>.
+    Rows are buffered until chunk_rows are collected; use it as a context manager or call close().'''
+
+    def __init__(self, output_base, result_format='csv', keep_peaks=False, chunk_rows=10000):
+        if result_format not in RESULT_FORMATS:
+            raise ValueError(f"Unsupported result format: {result_format}")
+        self.output_base = output_base
+        self.result_format = result_format
+        self.keep_peaks = keep_peaks
+        self.chunk_rows = chunk_rows
+        self.path = f"{output_base}.{result_format}"
+        self.peaks_path = f"{output_base}_peaks.{result_format}" if keep_peaks else None
+        self.rows = 0
+        self.closed = False
+        self._buffers = {self.path: [], self.peaks_path: []}
+        self._dtypes = {self.path: RESULT_COLUMNS, self.peaks_path: PEAK_COLUMNS}
+        self._buffered_rows = 0
+        self._parquet_writers = {}
+        self._started = set()
+        if result_format == 'parquet':
+            try:
+                import pyarrow   # optional, only needed for Parquet output
+            except ImportError:
+                raise ImportError("Parquet output needs the pyarrow package, install it or write CSV results") from None
+
+    def write(self, result_dict):
+        '''Append the rows of a result_dict (the columns of new_result_dict).'''
+        count = len(result_dict.get('Scan', []))
+        if count == 0:
+            return
+        self._buffers[self.path].append(typed_frame(result_dict, RESULT_COLUMNS))
+        if self.keep_peaks:
+            peak_columns = {name: [] for name in PEAK_COLUMNS}
+            for scan, compound, peaks in zip(result_dict['Scan'], result_dict['Compound'], result_dict.get(PEAK_LIST_KEY, [])):
+                for query_mz, query_intensity, library_mz, library_intensity in peaks:
+                    peak_columns['Scan'].append(scan)
+                    peak_columns['Compound'].append(compound)
+                    peak_columns['Query_mz'].append(query_mz)
+                    peak_columns['Query_intensity'].append(query_intensity)
+                    peak_columns['Library_mz'].append(library_mz)
+                    peak_columns['Library_intensity'].append(library_intensity)
+            self._buffers[self.peaks_path].append(typed_frame(peak_columns, PEAK_COLUMNS))
+        self.rows += count
+        self._buffered_rows += count
+        if self._buffered_rows >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        for path, frames in self._buffers.items():
+            if path is not None and frames:
+                self._append(path, pd.concat(frames, ignore_index=True))
+                frames.clear()
+        self._buffered_rows = 0
+
+    def _append(self, path, df):
+        if self.result_format == 'csv':
+            df.to_csv(path, mode='a' if path in self._started else 'w', header=path not in self._started, index=False)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            # an explicit schema, so a first chunk with only empty strings does not fix a column to the null type
+            types = {'float64': pa.float64(), 'int64': pa.int64(), 'object': pa.string()}
+            schema = pa.schema([(name, types[dtype]) for name, dtype in self._dtypes[path].items()])
+            table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+            if path not in self._parquet_writers:
+                self._parquet_writers[path] = pq.ParquetWriter(path, schema)
+            self._parquet_writers[path].write_table(table)
+        self._started.add(path)
+
+    def close(self):
+        '''Write the remaining rows; an empty result still gets a file with the header.'''
+        if self.closed:
+            return self.path
+        self.flush()
+        for path, dtypes in self._dtypes.items():
+            if path is not None and path not in self._started:
+                self._append(path, typed_frame({}, dtypes))
+        for writer in self._parquet_writers.values():
+            writer.close()
+        self.closed = True
+        return self.path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
+
+    def export_excel(self, excel_path=None):
+        '''Convert the finished result file to <output_base>.xlsx; skipped with a warning above the Excel row limit.'''
+        self.close()
+        excel_path = excel_path or f"{self.output_base}.xlsx"
+        if self.rows > EXCEL_MAX_ROWS:
+            logging.warning(f"{self.rows} result rows do not fit in an Excel sheet, {excel_path} was not written")
+            return None
+        read_results(self.path).to_excel(excel_path, index=False)
+        return excel_path
+
+
+def read_results(path, columns=None) -> pd.DataFrame:
+    '''Read a result file written by ResultWriter (or an older .xlsx result).'''
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path, columns=columns)
+    if path.endswith('.xlsx'):
+        return pd.read_excel(path, usecols=columns)
+    # the peaks side file shares Scan and Compound with the result table; only empty numbers are missing values,
+    # so a compound, adduct or formula reads back as written ('' or 'NA' included), the same as from Parquet
+    known = {**RESULT_COLUMNS, **PEAK_COLUMNS}
+    dtypes = {name: str if dtype == 'object' else dtype for name, dtype in known.items()
+              if columns is None or name in columns}
+    missing = {name: [''] for name, dtype in dtypes.items() if dtype == 'float64'}
+    return pd.read_csv(path, usecols=columns, dtype=dtypes, keep_default_na=False, na_values=missing,
+                       float_precision='round_trip')
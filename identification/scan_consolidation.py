@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''Scan consolidation for direct-infusion runs.
+
+DI runs acquire the same isolation window (and FAIMS compensation voltage) over and over. Instead of identifying
+every one of these nearly identical MS2 scans, the scans of a window are grouped and merged into one consensus
+spectrum: the peaks of all scans are clustered within the fragment tolerance, a cluster becomes one peak at its
+intensity weighted m/z with the mean intensity over the scans of the group. Every group is identified once.'''
+
+from collections import namedtuple, OrderedDict
+
+import numpy as np
+
+from IdentificationMeta import QueryTargetedSpectrum, ScanRecord
+
+ScanGroup = namedtuple('ScanGroup', ['precursor', 'compensation_voltage', 'scans'])
+
+
+def group_scans(scan_table, lowerscan=0, higherscan=None) -> list:
+    '''Group the MS2 scans of range(lowerscan, higherscan) of a get_scan_table DataFrame by precursor m/z and
+    compensation voltage (missing values are equal to each other). Groups are ordered by their first scan.'''
+    table = scan_table.iloc[lowerscan:higherscan]
+    table = table[table['ms_level'] == 2]
+    groups = OrderedDict()
+    for scan, precursor, cv in zip(table.index.tolist(), table['precursor'].tolist(), table['compensation_voltage'].tolist()):
+        # NaN keys are replaced by None, NaN is not equal to itself
+        key = (None if precursor != precursor else precursor, None if cv != cv else cv)
+        groups.setdefault(key, []).append(scan)
+    return [ScanGroup(float('nan') if precursor is None else precursor, float('nan') if cv is None else cv, scans)
+            for (precursor, cv), scans in groups.items()]
+
+
+def consensus_spectrum(spectra, tolerance, unit='ppm', min_fraction=0.0) -> tuple:
+    '''
+    Merge the (mz, intensity) arrays of the scans of a group into one spectrum.
+
+    Peaks of all scans sorted by m/z form a cluster as long as the gap to the previous peak is within the tolerance
+    (ppm of that peak or Da). A cluster gives one peak at the intensity weighted mean m/z with the summed intensity
+    divided by the number of scans; clusters found in fewer than min_fraction of the scans are dropped as noise.
+    A group of one scan is returned unchanged.
+    '''
+    if len(spectra) == 1:
+        return spectra[0]
+    counts = [len(mz) for mz, _ in spectra]
+    if sum(counts) == 0:
+        return np.empty(0), np.empty(0)
+    mz = np.concatenate([np.asarray(mz, dtype=np.float64) for mz, _ in spectra])
+    intensity = np.concatenate([np.asarray(intensity, dtype=np.float64) for _, intensity in spectra])
+    scan = np.repeat(np.arange(len(spectra)), counts)
+    order = np.argsort(mz, kind='stable')
+    mz, intensity, scan = mz[order], intensity[order], scan[order]
+
+    if unit.lower() == 'ppm':
+        limits = mz[:-1] * tolerance / 1e6
+    elif unit.lower() == 'da':
+        limits = np.full(len(mz) - 1, float(tolerance))
+    else:
+        raise ValueError(f"Unsupported tolerance unit: {unit}")
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(mz) > limits) + 1))
+    summed = np.add.reduceat(intensity, starts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weighted = np.add.reduceat(mz * intensity, starts) / summed
+    consensus_mz = np.where(summed > 0, weighted, np.add.reduceat(mz, starts) / np.diff(np.append(starts, len(mz))))
+
+    # number of different scans with a peak in every cluster
+    cluster = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(mz))))
+    present = np.bincount(np.unique(cluster * len(spectra) + scan) // len(spectra), minlength=len(starts))
+    keep = present >= max(1, np.ceil(min_fraction * len(spectra)))
+    return consensus_mz[keep], summed[keep] / len(spectra)
+
+
+class ConsolidatedSpectra(QueryTargetedSpectrum):
+
+    '''A QueryTargetedSpectrum on which the first scan of every group of repeated MS2 window scans returns the
+    consensus spectrum of the group and its other scans are skipped (MS level 0, no peaks).
+
+    The identification runs unchanged on it: each group is matched once and its rows carry the first scan of the
+    group, with the Ion_count of the consensus (mean) intensities.'''
+
+    def __init__(self, filepath, intensity_threshold=3000, tolerance=10.0, unit='ppm', min_fraction=0.0, scan_range=None,
+                 groups=None, cache_size=8, reader='direct', scan_store=None):
+        super().__init__(filepath, intensity_threshold, cache_size, reader, scan_store)
+        self._consolidate(tolerance, unit, min_fraction, scan_range, groups)
+
+    @classmethod
+    def from_reader(cls, analyzer, tolerance=10.0, unit='ppm', min_fraction=0.0, scan_range=None, groups=None):
+        '''The ConsolidatedSpectra of the file of an open QueryTargetedSpectrum, reading through its readers instead of
+        opening and indexing the file again. The scan records are cached separately.'''
+        consolidated = cls.__new__(cls)
+        consolidated.__dict__.update(analyzer.__dict__)
+        consolidated._scan_cache = OrderedDict()
+        consolidated._prefetcher = None
+        consolidated._consolidate(tolerance, unit, min_fraction, scan_range, groups)
+        return consolidated
+
+    def _consolidate(self, tolerance, unit, min_fraction, scan_range, groups):
+        self.tolerance = tolerance
+        self.unit = unit
+        self.min_fraction = min_fraction
+        self.scan_range = scan_range
+        if groups is None:
+            lowerscan, higherscan = scan_range or (0, None)
+            groups = group_scans(self.get_scan_table(), lowerscan, higherscan)
+        self.groups = groups
+        self._groups_by_first = {group.scans[0]: group for group in groups}
+        self._skipped_scans = {scan for group in groups for scan in group.scans[1:]}
+        self._skipped = ScanRecord(0, np.empty(0), np.empty(0), float('nan'), float('nan'))
+        self._consensus = OrderedDict()
+
+    def settings(self) -> dict:
+        # the groups are passed on, so worker processes do not read the scan table again
+        return {**super().settings(), 'tolerance': self.tolerance, 'unit': self.unit, 'min_fraction': self.min_fraction,
+                'scan_range': self.scan_range, 'groups': self.groups}
+
+    def decode_order(self, lowerscan, higherscan) -> list:
+        # the first scan of a group needs all scans of the group, the other scans of the group are never decoded
+        order = []
+        for scan in range(lowerscan, higherscan):
+            group = self._groups_by_first.get(scan)
+            if group is not None:
+                order.extend(group.scans)
+            elif scan not in self._skipped_scans:
+                order.append(scan)
+        return order
+
+    def get_scan_record(self, scan) -> ScanRecord:
+        group = self._groups_by_first.get(scan)
+        if group is None:
+            if scan in self._skipped_scans:
+                return self._skipped
+            return super().get_scan_record(scan)
+        record = self._consensus.get(scan)
+        if record is not None:
+            self._consensus.move_to_end(scan)
+            return record
+        records = [super(ConsolidatedSpectra, self).get_scan_record(member) for member in group.scans]
+        mz, intensity = consensus_spectrum([(member.mz, member.intensity) for member in records], self.tolerance, self.unit,
+                                           self.min_fraction)
+        record = records[0]._replace(mz=mz, intensity=intensity)
+        self._consensus[scan] = record
+        if len(self._consensus) > self.cache_size:
+            self._consensus.popitem(last=False)
+        return record
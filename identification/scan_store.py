@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''Convert-once scan store.
+
+Tuning ppm tolerance, minimum matched peaks, intensity and cosine thresholds means identifying the same input files
+again and again, and every run decodes their XML from scratch. The first run with a scan store converts the file
+into one .discans file: the unfiltered m/z and intensity arrays of all MS2 scans concatenated, with per-scan peak
+offsets, ms level, precursor m/z and compensation voltage, in the aligned layout of the .dilib files. Later runs
+memory-map it instead of parsing the XML, the intensity threshold is applied on read. Stores are keyed by the SHA-256
+of the content of the input file, so a changed file is converted again and renamed or copied files are not.'''
+
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from LibraryHandling import write_array_file, read_array_file
+
+DEFAULT_STORE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'dimeta', 'scans')
+
+_source_hashes = {}   # (absolute path, size, mtime) -> content hash, so worker processes and readers do not hash again
+
+
+def source_hash(file_path) -> str:
+    """SHA-256 of the content of file_path."""
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if key not in _source_hashes:
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        _source_hashes[key] = digest.hexdigest()
+    return _source_hashes[key]
+
+
+def store_path(file_path, store_dir=None) -> str:
+    """Path of the scan store of file_path in store_dir (DEFAULT_STORE_DIR when None)."""
+    return os.path.join(store_dir or DEFAULT_STORE_DIR, source_hash(file_path)[:32] + '.discans')
+
+
+class ScanStore:
+
+    '''The memory-mapped scans of one converted input file, read with scan() like the XML readers.'''
+
+    MAGIC = b'DISCAN01'
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        header, arrays = read_array_file(file_path, self.MAGIC, 'scan store')
+        self.source = header.get('source')
+        self.dtypes = [np.dtype(dtype) for dtype in header['dtypes']]
+        self.peak_offsets = arrays['peak_offsets']
+        self.mz = arrays['mz']
+        self.intensity = arrays['intensity']
+        self.ms_level = arrays['ms_level']
+        self.precursor = arrays['precursor']
+        self.compensation_voltage = arrays['compensation_voltage']
+        self.mz_dtype = arrays['mz_dtype']
+        self.intensity_dtype = arrays['intensity_dtype']
+
+    def __len__(self):
+        return len(self.ms_level)
+
+    def scan(self, scan) -> tuple:
+        '''(ms level, precursor m/z, compensation voltage, m/z array, intensity array) as decoded from the file; the
+        arrays are read-only views for MS2 scans (copies when the scan had a narrower dtype than the file) and None
+        for the others.'''
+        ms_level = int(self.ms_level[scan])
+        mz = intensity = None
+        if ms_level == 2:
+            start, stop = self.peak_offsets[scan], self.peak_offsets[scan + 1]
+            mz = self.mz[start:stop].astype(self.dtypes[self.mz_dtype[scan]], copy=False)
+            intensity = self.intensity[start:stop].astype(self.dtypes[self.intensity_dtype[scan]], copy=False)
+        return ms_level, float(self.precursor[scan]), float(self.compensation_voltage[scan]), mz, intensity
+
+    def scan_table(self) -> pd.DataFrame:
+        return pd.DataFrame({'ms_level': self.ms_level.astype(np.int64), 'precursor': np.array(self.precursor),
+                             'compensation_voltage': np.array(self.compensation_voltage)})
+
+    @classmethod
+    def write(cls, file_path, scans, source=None):
+        '''
+        Write the (ms level, precursor, compensation voltage, m/z, intensity) tuples of `scans`, in scan order, to a
+        store at file_path. Only the arrays of MS2 scans are kept, in the common dtype of the file (float64 when it has
+        none) with the dtype of every scan to restore it on read. The peaks are spooled to temporary files while `scans`
+        is consumed, so only the per-scan values are held in memory. The file is written next to its final path and
+        replaced atomically.
+        '''
+        folder = os.path.dirname(os.path.abspath(file_path))
+        os.makedirs(folder, exist_ok=True)
+        temporary = []
+
+        def temporary_path():
+            fd, path = tempfile.mkstemp(suffix='.tmp', dir=folder)
+            os.close(fd)
+            temporary.append(path)
+            return path
+
+        try:
+            ms_levels, precursors, voltages, counts = [], [], [], []
+            dtypes, codes = {}, {'mz': [], 'intensity': []}
+            spools = {name: temporary_path() for name in codes}
+            with open(spools['mz'], 'wb') as mz_spool, open(spools['intensity'], 'wb') as intensity_spool:
+                for ms_level, precursor, voltage, mz, intensity in scans:
+                    ms_levels.append(ms_level)
+                    precursors.append(precursor)
+                    voltages.append(voltage)
+                    count = 0
+                    if ms_level == 2:
+                        for name, array, spool in (('mz', mz, mz_spool), ('intensity', intensity, intensity_spool)):
+                            array = np.ascontiguousarray(array)
+                            codes[name].append(dtypes.setdefault(array.dtype.str, len(dtypes)))
+                            spool.write(array.tobytes())
+                        count = len(mz)
+                    else:
+                        codes['mz'].append(0)
+                        codes['intensity'].append(0)
+                    counts.append(count)
+            peak_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+            ms_levels = np.array(ms_levels, dtype=np.int16)
+            dtype_list = [np.dtype(dtype) for dtype in dtypes]
+            peaks = {name: _spooled_peaks(spools[name], np.array(codes[name], dtype=np.uint8), ms_levels == 2,
+                                          peak_offsets, dtype_list, temporary_path)
+                     for name in codes}
+            arrays = [('peak_offsets', peak_offsets),
+                      ('mz', peaks['mz']),
+                      ('intensity', peaks['intensity']),
+                      ('ms_level', ms_levels),
+                      ('precursor', np.array(precursors, dtype=np.float64)),
+                      ('compensation_voltage', np.array(voltages, dtype=np.float64)),
+                      ('mz_dtype', np.array(codes['mz'], dtype=np.uint8)),
+                      ('intensity_dtype', np.array(codes['intensity'], dtype=np.uint8))]
+            tmp_path = temporary_path()
+            write_array_file(tmp_path, cls.MAGIC, arrays, {'source': os.path.abspath(source) if source else None,
+                                                           'dtypes': list(dtypes) or ['<f8']})
+            del arrays, peaks   # release the maps of the spool files before they are removed
+            os.replace(tmp_path, file_path)
+        finally:
+            for path in temporary:
+                if os.path.exists(path):
+                    os.remove(path)
+        return file_path
+
+
+def _spooled_peaks(spool_path, codes, is_ms2, peak_offsets, dtypes, temporary_path) -> np.ndarray:
+    '''The peaks of one kind appended to spool_path, each scan in its own dtype (dtypes[codes[scan]]), as one array
+    of their common dtype: the spool file itself when every scan has that dtype, a converted copy otherwise.'''
+    used = sorted({int(code) for code in codes[is_ms2]})
+    dtype = np.result_type(*[dtypes[code] for code in used]) if used else np.dtype(np.float64)
+    total = int(peak_offsets[-1])
+    if total == 0:
+        return np.empty(0, dtype=dtype)
+    if all(dtypes[code] == dtype for code in used):
+        return np.memmap(spool_path, dtype=dtype, mode='r', shape=(total,))
+    spool = np.memmap(spool_path, dtype=np.uint8, mode='r')
+    peaks = np.memmap(temporary_path(), dtype=dtype, mode='w+', shape=(total,))
+    position = 0
+    for scan in np.flatnonzero(is_ms2).tolist():
+        start, stop = int(peak_offsets[scan]), int(peak_offsets[scan + 1])
+        size = (stop - start) * dtypes[codes[scan]].itemsize
+        peaks[start:stop] = spool[position:position + size].view(dtypes[codes[scan]])
+        position += size
+    return peaks
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''Opt-in timing of the identification stages.
+
+A StageProfiler adds up the wall time spent in every named stage and collects per-scan counters (library candidates,
+matched peak pairs, hits). Profilers of worker processes are merged into the one of the file, which can log a summary
+and save a JSON profile. A profiling session (cProfile, or pyinstrument when installed) can also be run over a chosen
+scan range. Without a profiler the pipeline uses NULL_PROFILER, whose stages are a shared no-op context.'''
+
+import os
+import json
+import time
+import logging
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict
+
+import numpy as np
+
+PROFILE_BACKENDS = ('cprofile', 'pyinstrument')
+
+
+class NullProfiler:
+
+    '''Stands in for a StageProfiler when profiling is off.'''
+
+    enabled = False
+    _null = nullcontext()
+
+    def stage(self, name):
+        return self._null
+
+    def add(self, name, seconds, calls=1):
+        pass
+
+    def count(self, name, value):
+        pass
+
+    def scan(self, scan_index):
+        pass
+
+    def finish(self):
+        pass
+
+    def settings(self):
+        return None
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class StageProfiler:
+
+    def __init__(self, session_scans=None, session_backend='cprofile', session_path=None):
+        '''session_scans=(lower, higher) runs a cProfile/pyinstrument session over the scans lower <= scan < higher,
+        written to <session_path>_scans<first>-<last>.prof (.html for pyinstrument).'''
+        if session_backend not in PROFILE_BACKENDS:
+            raise ValueError(f"Unsupported profile backend: {session_backend}")
+        self.enabled = True
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(list)
+        self.session_scans = tuple(session_scans) if session_scans else None
+        self.session_backend = session_backend
+        self.session_path = session_path
+        self.session_files = []
+        self._session = None
+        self._session_first = self._session_last = None
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+    def add(self, name, seconds, calls=1):
+        self.times[name] += seconds
+        self.calls[name] += calls
+
+    def count(self, name, value):
+        self.counters[name].append(value)
+
+    def settings(self) -> dict:
+        # what a worker process needs to build its own profiler
+        return {'session_scans': self.session_scans, 'session_backend': self.session_backend, 'session_path': self.session_path}
+
+    def merge(self, other):
+        for name, seconds in other.times.items():
+            self.times[name] += seconds
+        for name, calls in other.calls.items():
+            self.calls[name] += calls
+        for name, values in other.counters.items():
+            self.counters[name].extend(values)
+        self.session_files.extend(other.session_files)
+
+    def scan(self, scan_index):
+        '''Called before every scan, starts and stops the profiling session at the edges of session_scans.'''
+        if self.session_scans is None:
+            return
+        inside = self.session_scans[0] <= scan_index < self.session_scans[1]
+        if inside and self._session is None:
+            self._start_session(scan_index)
+        elif not inside and self._session is not None:
+            self._stop_session()
+        if inside:
+            self._session_last = scan_index
+
+    def finish(self):
+        '''Stop a session that is still running at the end of a scan range.'''
+        if self._session is not None:
+            self._stop_session()
+
+    def _start_session(self, scan_index):
+        if self.session_backend == 'pyinstrument':
+            from pyinstrument import Profiler   # optional dependency, only needed for this backend
+            self._session = Profiler()
+            self._session.start()
+        else:
+            import cProfile
+            self._session = cProfile.Profile()
+            self._session.enable()
+        self._session_first = scan_index
+
+    def _stop_session(self):
+        session, self._session = self._session, None
+        base = self.session_path or os.path.join(os.getcwd(), 'dimeta_profile')
+        path = f"{base}_scans{self._session_first}-{self._session_last}"
+        if self.session_backend == 'pyinstrument':
+            session.stop()
+            path += '.html'
+            with open(path, 'w', encoding='utf-8') as file:
+                file.write(session.output_html())
+        else:
+            session.disable()
+            path += '.prof'
+            session.dump_stats(path)
+        self.session_files.append(path)
+
+    def summary(self) -> dict:
+        total = sum(self.times.values())
+        stages = {name: {'seconds': seconds, 'calls': self.calls[name], 'share': seconds / total if total else 0.0,
+                         'mean_us': seconds / self.calls[name] * 1e6 if self.calls[name] else 0.0}
+                  for name, seconds in sorted(self.times.items(), key=lambda item: -item[1])}
+        counters = {}
+        for name, values in self.counters.items():
+            values = np.asarray(values, dtype=np.float64)
+            counters[name] = {'scans': int(len(values)), 'total': float(values.sum()),
+                              'mean': float(values.mean()) if len(values) else 0.0,
+                              'median': float(np.median(values)) if len(values) else 0.0,
+                              'p95': float(np.percentile(values, 95)) if len(values) else 0.0,
+                              'max': float(values.max()) if len(values) else 0.0}
+        return {'total_seconds': total, 'stages': stages, 'counters': counters, 'session_files': list(self.session_files)}
+
+    def log_summary(self, label=''):
+        summary = self.summary()
+        lines = [f"Stage timings {label}".rstrip() + f" ({summary['total_seconds']:.3f} s in stages):"]
+        for name, stage in summary['stages'].items():
+            lines.append(f"  {name:22s} {stage['seconds']:10.3f} s {stage['share'] * 100:6.1f} %  "
+                         f"{stage['calls']:8d} calls {stage['mean_us']:10.1f} us/call")
+        for name, counter in summary['counters'].items():
+            lines.append(f"  {name:22s} mean {counter['mean']:.1f}  median {counter['median']:.0f}  "
+                         f"p95 {counter['p95']:.0f}  max {counter['max']:.0f}  over {counter['scans']} scans")
+        for path in summary['session_files']:
+            lines.append(f"  profile session written to {path}")
+        logging.info('\n'.join(lines))
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.summary(), file, indent=2)
+        return path
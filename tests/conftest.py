@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+# the modules are imported by their bare names, like dimeta_cli and the benchmarks do
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for _folder in (os.path.join(_root, 'Library loading'), os.path.join(_root, 'identification')):
+    if _folder not in sys.path:
+        sys.path.insert(0, _folder)
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+@pytest.fixture(scope='session')
+def run_files(tmp_path_factory):
+    '''(run.mzML, lib.msp) of the synthetic 120-scan run written by tests/data/make_run.py.'''
+    sys.path.insert(0, DATA_DIR)
+    try:
+        from make_run import write_run
+    finally:
+        sys.path.remove(DATA_DIR)
+    return write_run(str(tmp_path_factory.mktemp('run')))
@@ -0,0 +1,79 @@
+'''Write the synthetic 120-scan DI-MS/MS run and its 3000-compound library used by the end-to-end tests.
+
+Every tenth scan is an MS1 scan; the MS2 scans cycle through four isolation windows and two compensation voltages and
+hold the peaks of up to five library compounds of their window (m/z shifted by a few ppm) plus 30 noise peaks.
+The files are fully determined by the seed.'''
+
+import os
+import sys
+import zlib
+import base64
+
+import numpy as np
+
+WINDOWS = [150.5, 200.25, 250.0, 300.75]
+SCANS = 120
+COMPOUNDS = 3000
+
+
+def _b64(array):
+    return base64.b64encode(zlib.compress(array.astype('<f8').tobytes())).decode('ascii')
+
+
+def write_run(folder, seed=0) -> tuple:
+    '''Write run.mzML and lib.msp into folder and return their paths.'''
+    rng = np.random.default_rng(seed)
+    library_path, run_path = os.path.join(folder, 'lib.msp'), os.path.join(folder, 'run.mzML')
+    library = []
+    with open(library_path, 'w') as file:
+        for i in range(COMPOUNDS):
+            precursor = round(float(rng.uniform(100, 400)), 4)
+            count = int(rng.integers(3, 12))
+            mz = np.sort(rng.uniform(50, precursor, count)).round(4)
+            intensity = rng.uniform(1, 1000, count).round(2)
+            library.append((precursor, mz, intensity))
+            file.write(f"Name: Compound {i}\nPrecursorMZ: {precursor}\nPrecursor_type: [M+H]+\nFormula: C{i}H2\nNum Peaks: {count}\n")
+            for peak_mz, peak_intensity in zip(mz, intensity):
+                file.write(f"{peak_mz} {peak_intensity}\n")
+            file.write("\n")
+
+    lines = ['<?xml version="1.0" encoding="utf-8"?>', '<mzML xmlns="http://psi.hupo.org/ms/mzml" version="1.1.0">',
+             f'<run id="r"><spectrumList count="{SCANS}">']
+    for scan in range(SCANS):
+        ms_level = 1 if scan % 10 == 0 else 2
+        window = WINDOWS[scan % 4]
+        voltage = [-40.0, -60.0][scan % 2]
+        if ms_level == 2:
+            candidates = [compound for compound in library if abs(compound[0] - window) < 1][:5]
+            mzs, intensities = [], []
+            for _, compound_mz, compound_intensity in candidates:
+                mzs += list(compound_mz * (1 + rng.normal(0, 3e-6, len(compound_mz))))
+                intensities += list(compound_intensity * rng.uniform(5, 50))
+            mzs += list(rng.uniform(50, window, 30))
+            intensities += list(rng.uniform(100, 20000, 30))
+            order = np.argsort(mzs)
+            mz, intensity = np.array(mzs)[order], np.array(intensities)[order]
+        else:
+            mz, intensity = np.sort(rng.uniform(100, 500, 50)), rng.uniform(1e3, 1e5, 50)
+        lines.append(f'<spectrum index="{scan}" id="scan={scan + 1}" defaultArrayLength="{len(mz)}">')
+        lines.append(f'<cvParam cvRef="MS" accession="MS:1000511" name="ms level" value="{ms_level}"/>')
+        lines.append(f'<cvParam cvRef="MS" accession="MS:1001581" name="FAIMS compensation voltage" value="{voltage}"/>')
+        if ms_level == 2:
+            lines.append('<precursorList count="1"><precursor><isolationWindow><cvParam cvRef="MS" accession="MS:1000827" '
+                         f'name="isolation window target m/z" value="{window}"/></isolationWindow></precursor></precursorList>')
+        lines.append('<binaryDataArrayList count="2">')
+        for array, accession, name in [(mz, "MS:1000514", "m/z array"), (intensity, "MS:1000515", "intensity array")]:
+            encoded = _b64(array)
+            lines.append(f'<binaryDataArray encodedLength="{len(encoded)}"><cvParam cvRef="MS" accession="MS:1000523" '
+                         'name="64-bit float" value=""/><cvParam cvRef="MS" accession="MS:1000574" name="zlib compression" '
+                         f'value=""/><cvParam cvRef="MS" accession="{accession}" name="{name}" value=""/>'
+                         f'<binary>{encoded}</binary></binaryDataArray>')
+        lines.append('</binaryDataArrayList></spectrum>')
+    lines.append('</spectrumList></run></mzML>')
+    with open(run_path, 'w') as file:
+        file.write('\n'.join(lines))
+    return run_path, library_path
+
+
+if __name__ == '__main__':
+    write_run(sys.argv[1] if len(sys.argv) > 1 else '.')
@@ -0,0 +1,104 @@
+'''Write the small mzML files the reader tests compare between the direct reader and pyteomics.
+
+Every file holds the same six spectra: an MS1 scan, a float32 uncompressed MS2 scan with its compensation voltage in
+the scan element, a zlib float64 MS2 scan, an MS2 scan with empty arrays, one whose arrays are described by
+referenceable parameter groups and an MS2 scan with integer intensities. They differ in how the document is wrapped:
+indexed, not indexed, and both with an 'mzml:' namespace prefix on every element.'''
+
+import os
+import zlib
+import base64
+
+import numpy as np
+
+NAMES = {'MS:1000521': '32-bit float', 'MS:1000523': '64-bit float', 'MS:1000519': '32-bit integer',
+         'MS:1000576': 'no compression', 'MS:1000574': 'zlib compression',
+         'MS:1000514': 'm/z array', 'MS:1000515': 'intensity array'}
+DTYPES = {'MS:1000521': '<f4', 'MS:1000523': '<f8', 'MS:1000519': '<i4'}
+
+
+def cv(accession, value=''):
+    name = NAMES.get(accession, {'MS:1000511': 'ms level', 'MS:1001581': 'FAIMS compensation voltage',
+                                 'MS:1000827': 'isolation window target m/z'}.get(accession))
+    return f'<cvParam cvRef="MS" accession="{accession}" name="{name}" value="{value}"/>'
+
+
+def encode(values, dtype, compression):
+    raw = np.asarray(values, dtype=DTYPES[dtype]).tobytes()
+    if compression == 'MS:1000574':
+        raw = zlib.compress(raw)
+    return base64.b64encode(raw).decode('ascii') if values else ''
+
+
+def array(values, kind, dtype='MS:1000523', compression='MS:1000574', group=None):
+    params = f'<referenceableParamGroupRef ref="{group}"/>' if group else cv(dtype) + cv(compression) + cv(kind)
+    binary = encode(values, dtype, compression)
+    return (f'<binaryDataArray encodedLength="{len(binary)}">{params}'
+            + (f'<binary>{binary}</binary>' if binary else '<binary/>') + '</binaryDataArray>')
+
+
+def precursor(target):
+    return ('<precursorList count="1"><precursor><isolationWindow>' + cv('MS:1000827', target)
+            + '</isolationWindow></precursor></precursorList>')
+
+
+def spectrum(index, params, arrays, scan_params=''):
+    return (f'<spectrum index="{index}" id="scan={index + 1}" defaultArrayLength="{len(arrays[0])}">' + params
+            + f'<scanList count="1"><scan>{scan_params}</scan></scanList>'
+            + f'<binaryDataArrayList count="2">{arrays[1]}</binaryDataArrayList></spectrum>')
+
+
+def spectra() -> list:
+    mz, intensity = [100.5, 200.25, 300.125, 410.0], [5000.0, 1000.0, 9000.0, 2500.0]
+    def pair(mz, intensity, **kwargs):
+        return (mz, array(mz, 'MS:1000514', **kwargs) + array(intensity, 'MS:1000515', **kwargs))
+    return [
+        spectrum(0, cv('MS:1000511', 1) + cv('MS:1001581', -30), pair(mz, intensity)),
+        spectrum(1, cv('MS:1000511', 2) + precursor(300.5),
+                 pair(mz, intensity, dtype='MS:1000521', compression='MS:1000576'), cv('MS:1001581', -30)),
+        spectrum(2, cv('MS:1000511', 2) + cv('MS:1001581', -45.5) + precursor(410.25), pair(mz[::2], intensity[::2])),
+        spectrum(3, cv('MS:1000511', 2) + cv('MS:1001581', -50) + precursor(500), pair([], [])),
+        spectrum(4, cv('MS:1000511', 2) + precursor(400),
+                 (mz, array(mz, 'MS:1000514', group='mz_params') + array(intensity, 'MS:1000515', group='intensity_params'))),
+        spectrum(5, cv('MS:1000511', 2) + cv('MS:1001581', -60) + precursor(250.125),
+                 (mz, array(mz, 'MS:1000514') + array([7000, 2000, 4000, 3000], 'MS:1000515', dtype='MS:1000519'))),
+    ]
+
+
+def document(indexed=False, prefix=''):
+    groups = ('<referenceableParamGroupList count="2">'
+              '<referenceableParamGroup id="mz_params">' + cv('MS:1000523') + cv('MS:1000574') + cv('MS:1000514')
+              + '</referenceableParamGroup><referenceableParamGroup id="intensity_params">' + cv('MS:1000523')
+              + cv('MS:1000574') + cv('MS:1000515') + '</referenceableParamGroup></referenceableParamGroupList>')
+    items = spectra()
+    body = (groups + '<run id="run"><spectrumList count="%d">\n' % len(items) + '\n'.join(items)
+            + '\n</spectrumList></run>')
+    namespace = f'xmlns{":" + prefix if prefix else ""}="http://psi.hupo.org/ms/mzml"'
+    if not indexed:
+        text = f'<?xml version="1.0" encoding="utf-8"?>\n<mzML {namespace} version="1.1.0">' + body + '</mzML>\n'
+    else:
+        text = (f'<?xml version="1.0" encoding="utf-8"?>\n<indexedmzML {namespace}>\n<mzML version="1.1.0">' + body
+                + '</mzML>\n')
+    if prefix:   # prefix every element of the mzML namespace
+        text = text.replace('<', f'<{prefix}:').replace(f'<{prefix}:/', f'</{prefix}:').replace(f'<{prefix}:?', '<?')
+    if indexed:
+        start = f'<{prefix}:spectrum ' if prefix else '<spectrum '
+        offsets, position = [], text.find(start)
+        while position >= 0:
+            offsets.append(position)
+            position = text.find(start, position + 1)
+        p = f'{prefix}:' if prefix else ''
+        index = (f'<{p}indexList count="1"><{p}index name="spectrum">'
+                 + ''.join(f'<{p}offset idRef="scan={i + 1}">{offset}</{p}offset>' for i, offset in enumerate(offsets))
+                 + f'</{p}index></{p}indexList>\n')
+        index_offset = len(text.encode('utf-8'))
+        text += index + f'<{p}indexListOffset>{index_offset}</{p}indexListOffset>\n</{p}indexedmzML>\n'
+    return text
+
+
+if __name__ == '__main__':
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for name, kwargs in [('indexed.mzML', {'indexed': True}), ('plain.mzML', {}),
+                         ('prefixed.mzML', {'prefix': 'mzml'}), ('prefixed_indexed.mzML', {'indexed': True, 'prefix': 'mzml'})]:
+        with open(os.path.join(folder, name), 'w', encoding='utf-8', newline='\n') as file:
+            file.write(document(**kwargs))
@@ -0,0 +1,137 @@
+import os
+import time
+import logging
+import multiprocessing
+
+import pytest
+
+import querylibrarymatch
+
+
+pytestmark = pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(),
+                                reason="the patched process_file reaches the workers through fork")
+
+
+def fake_process_file(InputFilePath, library, *args, progress_callback=None, should_stop=None, **kwargs):
+    if InputFilePath.startswith('crash'):
+        os._exit(1)
+    if InputFilePath.startswith('error'):
+        raise ValueError(InputFilePath)
+    if InputFilePath.startswith('log'):
+        logging.getLogger('dimeta.test').info("%s from pid %d", InputFilePath, os.getpid())
+    if os.path.basename(InputFilePath).startswith('slow'):
+        for chunk in range(1, 101):
+            time.sleep(0.05)
+            progress_callback(chunk, 100)
+            if should_stop():
+                raise querylibrarymatch.AnalysisCancelled(InputFilePath)
+        with open(InputFilePath, 'w'):   # only reached when the worker was not stopped
+            pass
+
+
+def run_batch(paths, workers, **kwargs):
+    return querylibrarymatch.batch_processing_function(paths, None, 0, 10, 1.0, 0.5, 10, 3, 3000, '.', workers=workers, **kwargs)
+
+
+@pytest.mark.parametrize('workers', [2, 3])
+def test_dead_worker_fails_only_its_file(monkeypatch, workers):
+    monkeypatch.setattr(querylibrarymatch, 'process_file', fake_process_file)
+    paths = ['a.mzML', 'crash.mzML', 'b.mzML', 'error.mzML', 'c.mzML', 'd.mzML']
+    status = run_batch(paths, workers)
+    assert list(status) == paths
+    assert status['crash.mzML'].startswith('BrokenProcessPool')
+    assert 'ValueError: error.mzML' in status['error.mzML']
+    assert all(status[path] is None for path in ('a.mzML', 'b.mzML', 'c.mzML', 'd.mzML'))
+
+
+def test_every_file_crashing_terminates(monkeypatch):
+    monkeypatch.setattr(querylibrarymatch, 'process_file', fake_process_file)
+    status = run_batch(['crash1.mzML', 'crash2.mzML', 'crash3.mzML'], 2)
+    assert all(error.startswith('BrokenProcessPool') for error in status.values())
+
+
+def test_scan_progress_and_cancel_reach_the_file_workers(monkeypatch, tmp_path):
+    monkeypatch.setattr(querylibrarymatch, 'process_file', fake_process_file)
+    paths = [str(tmp_path / 'slow1'), str(tmp_path / 'slow2'), str(tmp_path / 'slow3')]
+    progress = []
+    with pytest.raises(querylibrarymatch.AnalysisCancelled):
+        run_batch(paths, 2, scan_progress_callback=lambda path, done, total: progress.append((path, done, total)),
+                  should_stop=lambda: len(progress) >= 3)
+    assert progress[0][0] in paths[:2] and progress[0][2] == 100
+    # the running files stopped after a few chunks instead of finishing, the third never started
+    assert not any(os.path.exists(path) for path in paths)
+
+
+def test_file_worker_logs_reach_the_parent_handlers(monkeypatch, caplog):
+    monkeypatch.setattr(querylibrarymatch, 'process_file', fake_process_file)
+    caplog.set_level(logging.INFO)
+    status = run_batch(['log1.mzML', 'log2.mzML', 'log3.mzML'], 2)
+    assert all(error is None for error in status.values())
+    records = [record for record in caplog.records if record.name == 'dimeta.test']
+    assert sorted(record.getMessage().split()[0] for record in records) == ['log1.mzML', 'log2.mzML', 'log3.mzML']
+    assert all(record.process != os.getpid() for record in records)
+
+
+@pytest.mark.parametrize('method', ['fork', 'spawn'])
+def test_scan_workers_give_the_serial_result(run_files, monkeypatch, method):
+    from IdentificationMeta import QueryTargetedSpectrum
+    from LibraryHandling import LibraryLoadingStrategy
+
+    run, library_path = run_files
+    library = LibraryLoadingStrategy(library_path).load_library()
+    monkeypatch.setattr(querylibrarymatch, '_process_context', lambda: multiprocessing.get_context(method))
+    results = [querylibrarymatch.main_processing_function(0, 120, QueryTargetedSpectrum(run, 3000), library, 0.5, 0.7, 10, 3,
+                                                          '.', workers=workers, keep_peaks=True)
+               for workers in (1, 3)]
+    assert len(results[0]['Scan']) == 125
+    assert results[0] == results[1]
+
+
+def crashing_scan_chunk(bounds):
+    if bounds[0] > 0:
+        os._exit(1)
+    return querylibrarymatch.new_result_dict(), [], None, None
+
+
+def test_dead_scan_worker_raises(run_files, monkeypatch):
+    from IdentificationMeta import QueryTargetedSpectrum
+
+    monkeypatch.setattr(querylibrarymatch, '_process_scan_chunk', crashing_scan_chunk)
+    with pytest.raises(querylibrarymatch.BrokenProcessPool):
+        querylibrarymatch.main_processing_function(0, 120, QueryTargetedSpectrum(run_files[0], 3000), [], 0.5, 0.7, 10, 3,
+                                                   '.', workers=2)
+
+
+def test_profile_summaries_of_file_workers_are_logged_here(run_files, tmp_path, caplog):
+    from LibraryHandling import LibraryLoadingStrategy
+
+    run, library_path = run_files
+    paths = []
+    for name in ('first', 'second'):
+        paths.append(str(tmp_path / f"{name}.mzML"))
+        with open(run, 'rb') as source, open(paths[-1], 'wb') as copy:
+            copy.write(source.read())
+    caplog.set_level(logging.INFO)
+    status = querylibrarymatch.batch_processing_function(paths, LibraryLoadingStrategy(library_path).load_library(), 0, 1,
+                                                         0.5, 0.7, 10, 3, 3000, str(tmp_path), workers=2, profile=True)
+    assert all(error is None for error in status.values())
+    summaries = [record for record in caplog.records if record.getMessage().startswith('Stage timings')]
+    assert sorted(record.getMessage().split()[2] for record in summaries) == ['first.mzML', 'second.mzML']
+    assert all(record.process != os.getpid() for record in summaries)
+
+
+def test_dotted_input_names_get_their_own_results(run_files, tmp_path):
+    from LibraryHandling import LibraryLoadingStrategy
+
+    run, library_path = run_files
+    paths = [str(tmp_path / 'a.1.mzML'), str(tmp_path / 'a.2.mzML')]
+    for path in paths:
+        with open(run, 'rb') as source, open(path, 'wb') as copy:
+            copy.write(source.read())
+    output = tmp_path / 'out'
+    output.mkdir()
+    status = querylibrarymatch.batch_processing_function(paths, LibraryLoadingStrategy(library_path).load_library(), 0, 1,
+                                                         0.5, 0.7, 10, 3, 3000, str(output), workers=2, export_excel=True)
+    assert all(error is None for error in status.values())
+    assert sorted(os.listdir(output)) == ['a.1.csv', 'a.1.xlsx', 'a.2.csv', 'a.2.xlsx']
+    assert querylibrarymatch.result_base_path('out', '/runs/a.1.mzML') == os.path.join('out', 'a.1')
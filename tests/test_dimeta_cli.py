@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+import dimeta_cli
+
+
+@pytest.fixture
+def run_args(monkeypatch):
+    '''The parsed arguments run_identify would have been called with.'''
+    calls = []
+    monkeypatch.setattr(dimeta_cli, 'run_identify', lambda args: calls.append(args) or 0)
+    return calls
+
+
+def write_config(tmp_path, config):
+    path = tmp_path / 'config.json'
+    path.write_text(json.dumps(config))
+    return str(path)
+
+
+REQUIRED = ['--library', 'lib.msp', '--inputs', 'runs', '--output-dir', 'out']
+
+
+@pytest.mark.parametrize('ppm', ['10', '10.0', '7'])
+def test_command_line_wins_over_config(tmp_path, run_args, ppm):
+    config = write_config(tmp_path, {'workers': 4, 'identify': {'ppm': 5, 'pimt': 0.2}})
+    assert dimeta_cli.main(['--config', config, 'identify', '--ppm', ppm] + REQUIRED) == 0
+    args = run_args[0]
+    assert args.ppm == float(ppm)
+    assert args.pimt == 0.2 and args.workers == 4
+    assert args.command == 'identify'
+
+
+def test_config_fills_required_options(tmp_path, run_args):
+    config = write_config(tmp_path, {'identify': {'library': 'lib.msp', 'inputs': ['runs'], 'output-dir': 'out'}})
+    dimeta_cli.main(['--config', config, 'identify'])
+    assert (run_args[0].library, run_args[0].inputs, run_args[0].output_dir) == ('lib.msp', ['runs'], 'out')
+    assert run_args[0].ppm == 10.0
+
+
+@pytest.mark.parametrize('config', [{'identify': {'pimt_typo': 1}}, {'identify': {'func': 'x'}},
+                                    {'identify': {'required': []}}, {'identify': {'topnum': 3}}, {'no_such_option': 1}])
+def test_unknown_config_keys_are_rejected(tmp_path, run_args, config, capsys):
+    with pytest.raises(SystemExit):
+        dimeta_cli.main(['--config', write_config(tmp_path, config), 'identify'] + REQUIRED)
+    assert 'unknown identify options' in capsys.readouterr().err
+    assert run_args == []
+
+
+def test_top_level_options_of_other_subcommands_are_ignored(tmp_path, run_args):
+    # topnum belongs to reformat, a shared config may hold it
+    dimeta_cli.main(['--config', write_config(tmp_path, {'topnum': 3}), 'identify'] + REQUIRED)
+    assert not hasattr(run_args[0], 'topnum')
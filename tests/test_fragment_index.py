@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from IdentificationMeta import QueryTargetedSpectrum, match_peak_indices
+from LibraryHandling import LibraryLoadingStrategy, LibrarySaveStrategy, CompiledLibrary, FragmentIndex, build_fragment_index
+from querylibrarymatch import process_scan_range
+
+TOLERANCES = [('ppm', 10), ('da', 0.02)]
+
+
+@pytest.fixture(scope='module', params=['msp', 'dilib'])
+def library(request, run_files, tmp_path_factory):
+    library = LibraryLoadingStrategy(run_files[1]).load_library()
+    if request.param == 'dilib':
+        path = str(tmp_path_factory.mktemp('dilib') / 'lib.dilib')
+        LibrarySaveStrategy.save_library_to_compiled(library, path)
+        library = CompiledLibrary(path)
+    return library
+
+
+def source_positions(library):
+    '''Library positions in the order of the source library, the order of the shortlists.'''
+    source_order = getattr(library, 'source_order', None)
+    return np.arange(len(library)) if source_order is None else np.argsort(source_order, kind='stable')
+
+
+def matched_query_peaks(query_mz, spectrum, tolerance, unit):
+    query_index, _ = match_peak_indices(query_mz, np.sort(np.asarray(spectrum['mz'], dtype=np.float64)), tolerance, unit)
+    return len(np.unique(query_index))
+
+
+@pytest.mark.parametrize('unit,tolerance', TOLERANCES)
+def test_shortlist_keeps_every_spectrum_with_matching_peaks(library, unit, tolerance):
+    rng = np.random.default_rng(1)
+    index = FragmentIndex(library)
+    for _ in range(5):
+        # peaks of a few library spectra, shifted within the tolerance, and noise
+        picked = rng.choice(len(library), 4, replace=False)
+        query_mz = np.concatenate([np.asarray(library[int(i)]['mz'])[:3] for i in picked] + [rng.uniform(50, 400, 20)])
+        query_mz = np.sort(query_mz * (1 + rng.uniform(-5e-6, 5e-6, len(query_mz))))
+        for min_shared in (1, 3):
+            full = index.shortlist(query_mz, tolerance, unit, top_k=0, min_shared=min_shared)
+            matching = [i for i in source_positions(library).tolist()
+                        if matched_query_peaks(query_mz, library[i], tolerance, unit) >= min_shared]
+            assert set(matching) <= set(full.tolist())
+            assert full.tolist() == [i for i in source_positions(library).tolist() if i in set(full.tolist())]
+            spectra, shared = index.shared_peaks(query_mz, tolerance, unit)
+            counts = dict(zip(spectra.tolist(), shared.tolist()))
+            top = index.shortlist(query_mz, tolerance, unit, top_k=10, min_shared=min_shared)
+            assert len(top) == min(10, len(full)) and set(top.tolist()) <= set(full.tolist())
+            dropped = set(full.tolist()) - set(top.tolist())
+            assert all(counts[i] >= counts[j] for i in top.tolist() for j in dropped)
+
+
+@pytest.mark.parametrize('unit,tolerance', TOLERANCES)
+def test_open_search_without_top_k_equals_scoring_the_whole_library(library, run_files, monkeypatch, unit, tolerance):
+    run, _ = run_files
+    fragment_index = build_fragment_index(library)
+    open_result = process_scan_range(0, 40, QueryTargetedSpectrum(run, 3000), library, 0.5, 0.7, tolerance, 3, None,
+                                     tolerance_unit=unit, search_mode='open', open_top_k=0, fragment_index=fragment_index)
+    everything = [library[i] for i in source_positions(library).tolist()]
+    monkeypatch.setattr(QueryTargetedSpectrum, 'get_open_lib', lambda self, scan, library, **options: everything)
+    brute_force = process_scan_range(0, 40, QueryTargetedSpectrum(run, 3000), library, 0.5, 0.7, tolerance, 3, None,
+                                     tolerance_unit=unit, search_mode='open', fragment_index=fragment_index)
+    assert len(open_result['Scan']) > 0
+    # the scores are summed over differently sized candidate tables, equal up to rounding
+    for key in ('Cosine_score', 'Macc_score'):
+        np.testing.assert_allclose(open_result.pop(key), brute_force.pop(key), rtol=1e-12)
+    assert open_result == brute_force
@@ -0,0 +1,82 @@
+import numpy as np
+
+import LibraryHandling
+from LibraryHandling import LibraryLoadingStrategy, LibraryCache, build_fragment_index, library_fingerprint
+from candidate_cache import CandidateCache
+
+
+def write_msp(path, seed=0, spectra=60):
+    rng = np.random.default_rng(seed)
+    with open(path, 'w') as file:
+        for i in range(spectra):
+            # few distinct precursors, so every window has several spectra out of precursor order
+            file.write(f"Name: compound {i}\nPrecursorMZ: {rng.choice([100.05, 100.1, 100.2, 150.0])}\n")
+            mz = np.sort(rng.choice(np.arange(50.0, 60.0, 0.5), size=4, replace=False))
+            file.write(f"Num Peaks: {len(mz)}\n")
+            for value in mz:
+                file.write(f"{value} {rng.integers(1, 1000)}\n")
+            file.write("\n")
+
+
+def names(spectra):
+    return [spectrum['name'] for spectrum in spectra]
+
+
+def test_cached_library_keeps_source_order(tmp_path):
+    source = tmp_path / 'lib.msp'
+    write_msp(source)
+    plain = LibraryLoadingStrategy(str(source)).load_library()
+    cache = LibraryCache(str(tmp_path / 'cache'))
+    for _ in range(2):   # the miss and the hit
+        cached = LibraryLoadingStrategy(str(source), cache=cache).load_library()
+        for precursor, tolerance in [(100.1, 0.2), (100.1, 0.06), (125.0, 30.0), (150.0, 0.01)]:
+            assert names(cached.search(precursor, tolerance)) == names(plain.search(precursor, tolerance))
+            assert names(cached[i] for i in cached.search_positions(precursor, tolerance)) == names(plain.search(precursor, tolerance))
+        query = np.arange(50.0, 60.0, 0.5)
+        for top_k in (5, 50):
+            shortlist = build_fragment_index(cached).shortlist(query, 10, top_k=top_k)
+            expected = build_fragment_index(plain).shortlist(query, 10, top_k=top_k)
+            assert names(cached[i] for i in shortlist) == names(plain[i] for i in expected)
+
+
+def test_cache_key_includes_version(tmp_path, monkeypatch):
+    source = tmp_path / 'lib.msp'
+    write_msp(source)
+    cache = LibraryCache(str(tmp_path / 'cache'))
+    entry = cache.entry_path(str(source))
+    monkeypatch.setattr(LibraryCache, 'VERSION', LibraryCache.VERSION + 1)
+    assert cache.entry_path(str(source)) != entry
+
+
+def test_fingerprint_depends_on_source_order(tmp_path):
+    first, second = tmp_path / 'first.msp', tmp_path / 'second.msp'
+    write_msp(first)
+    with open(first) as file:
+        records = file.read().split('\n\n')
+    # two spectra at different precursor m/z swapped: the same .dilib arrays, only the source order differs
+    low = next(i for i, record in enumerate(records) if 'PrecursorMZ: 100.05\n' in record)
+    high = next(i for i, record in enumerate(records) if 'PrecursorMZ: 150.0\n' in record)
+    records[low], records[high] = records[high], records[low]
+    second.write_text('\n\n'.join(records))
+    cache = LibraryCache(str(tmp_path / 'cache'))
+    libraries = [LibraryLoadingStrategy(str(path), cache=cache).load_library() for path in (first, second)]
+    assert np.array_equal(libraries[0].mz, libraries[1].mz)
+    assert library_fingerprint(libraries[0]) != library_fingerprint(libraries[1])
+
+
+def test_candidate_cache_hashes_the_library_only_to_persist(tmp_path, monkeypatch):
+    source = tmp_path / 'lib.msp'
+    write_msp(source)
+    library = LibraryLoadingStrategy(str(source)).load_library()
+    calls = []
+    compute = LibraryHandling._library_fingerprint
+    monkeypatch.setattr(LibraryHandling, '_library_fingerprint', lambda library: calls.append(1) or compute(library))
+    cache = CandidateCache(library)
+    cache.candidates(100.1, 0.2)
+    assert calls == []
+    for _ in range(2):   # e.g. two files of a batch
+        persisted = CandidateCache(library, cache_dir=str(tmp_path / 'candidates'))
+        persisted.candidates(100.1, 0.2)
+        persisted.save()
+    assert calls == [1]
+    assert len(CandidateCache(library, cache_dir=str(tmp_path / 'candidates'))) == 1
@@ -0,0 +1,41 @@
+import numpy as np
+
+from LibraryHandling import LibraryLoadingStrategy, LibraryReformat, LibrarySaveStrategy, CompiledLibrary
+
+
+def write_msp(path):
+    with open(path, 'w') as file:
+        file.write("Name: short\nPrecursorMZ: 100.1\nNum Peaks: 2\n60.0 10\n50.0 40\n\n")
+        file.write("Name: long\nPrecursorMZ: 150.0\nNum Peaks: 5\n50.0 5\n51.0 50\n52.0 1\n53.0 20\n54.0 30\n\n")
+
+
+def msp_records(path):
+    with open(path) as file:
+        return [record.splitlines() for record in file.read().strip().split('\n\n')]
+
+
+def test_msp_output_has_no_features_by_default(tmp_path):
+    source, output = tmp_path / 'lib.msp', tmp_path / 'out.msp'
+    write_msp(source)
+    library = LibraryReformat(3).reformat_library(LibraryLoadingStrategy(str(source)).load_library())
+    LibrarySaveStrategy.save_library_to_msp_class(library, str(output))
+    short, long = msp_records(output)
+    assert not any(line.startswith('Base peak') for line in short + long)
+    assert 'Num peaks: 2' in short
+    assert 'Num peaks: 3' in long
+    assert sum(line[0].isdigit() for line in long) == 3
+
+    LibrarySaveStrategy.save_library_to_msp_class(library, str(output), include_features=True)
+    assert 'Base peak mz: 51.0' in msp_records(output)[1]
+
+
+def test_compiled_library_keeps_features(tmp_path):
+    source, output = tmp_path / 'lib.msp', tmp_path / 'lib.dilib'
+    write_msp(source)
+    library = LibraryReformat(3).reformat_library(LibraryLoadingStrategy(str(source)).load_library())
+    LibrarySaveStrategy.save_library_to_compiled(library, str(output))
+    compiled = CompiledLibrary(str(output))
+    long = next(spectrum for spectrum in compiled if spectrum['name'] == 'long')
+    assert long['base peak mz'] == 51.0 and long['base peak intensity'] == 50.0
+    np.testing.assert_array_equal(long['mz'], [51.0, 53.0, 54.0])
+    np.testing.assert_array_equal(long['normalized intensity'], [100.0, 40.0, 60.0])
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+from LibraryHandling import PrecursorIndexedLibrary, CompiledLibrary, LibrarySaveStrategy
+from IdentificationMeta import search_library, search_library_positions
+
+
+def linear_search(spectra, precursor, PIMT):
+    # the scan search_library did over the whole library before the precursor index, a spectrum without a usable
+    # precursor m/z (which the old scan raised on) is never inside a window
+    def precursor_of(spectrum):
+        try:
+            return float(spectrum['precursormz'])
+        except (KeyError, TypeError, ValueError):
+            return float('nan')
+    return [i for i, spectrum in enumerate(spectra) if precursor - PIMT < precursor_of(spectrum) < precursor + PIMT]
+
+
+def spectrum(name, precursor=None, **fields):
+    spectrum = {'name': name, 'mz': np.array([50.0, 60.0]), 'intensity': np.array([1.0, 2.0]), **fields}
+    if precursor is not None:
+        spectrum['precursormz'] = precursor
+    return spectrum
+
+
+def libraries(spectra, tmp_path):
+    # the indexed library and the compiled file of the same spectra, both searched in source library order
+    path = str(tmp_path / 'lib.dilib')
+    LibrarySaveStrategy.save_library_to_compiled(spectra, path)
+    return {'indexed': PrecursorIndexedLibrary(spectra), 'compiled': CompiledLibrary(path)}
+
+
+def assert_same_as_linear(library, spectra, precursor, PIMT):
+    expected = linear_search(spectra, precursor, PIMT)
+    names = [spectra[i]['name'] for i in expected]
+    # positions into the library object: source positions for the indexed library, file positions for a compiled one
+    assert [library[i]['name'] for i in search_library_positions(library, precursor, PIMT)] == names, (precursor, PIMT)
+    assert [hit['name'] for hit in search_library(library, precursor, PIMT)] == names, (precursor, PIMT)
+
+
+@pytest.fixture
+def edge_spectra():
+    # duplicated precursors on both sides of every window, precursors given as text and as integers,
+    # and spectra without a usable precursor between them
+    return [spectrum('a', 100.5), spectrum('b', 100.0), spectrum('nan', float('nan')), spectrum('c', 101.0),
+            spectrum('d', '100.5'), spectrum('missing'), spectrum('e', 100), spectrum('none', None, precursormz=None),
+            spectrum('f', 101.0), spectrum('text', 'n/a'), spectrum('g', 0.2), spectrum('h', 0.30000000000000004),
+            spectrum('i', 100.25), spectrum('inf', float('inf'))]
+
+
+@pytest.mark.parametrize('kind', ['indexed', 'compiled'])
+def test_window_bounds_are_strict(tmp_path, edge_spectra, kind):
+    library = libraries(edge_spectra, tmp_path)[kind]
+    # precursors exactly at precursor +/- PIMT are left out on both sides
+    assert [hit['name'] for hit in library.search(100.5, 0.5)] == ['a', 'd', 'i']
+    assert [hit['name'] for hit in library.search(100.25, 0.25)] == ['i']
+    assert [hit['name'] for hit in library.search(100.5, 0.5000001)] == ['a', 'b', 'c', 'd', 'e', 'f', 'i']
+    # 0.3 - 0.1 rounds below 0.2 and 0.3 + 0.1 above 0.30000000000000004: both are inside, as in the linear scan
+    assert [hit['name'] for hit in library.search(0.3, 0.1)] == ['g', 'h']
+    for precursor, PIMT in [(100.5, 0.5), (100.25, 0.25), (100.0, 1.0), (100.75, 0.25), (0.3, 0.1), (0.25, 0.05),
+                            (100.5, 0.0), (100.5, -1.0), (50.0, 1e6), (101.0, 1e-12)]:
+        assert_same_as_linear(library, edge_spectra, precursor, PIMT)
+
+
+@pytest.mark.parametrize('kind', ['indexed', 'compiled'])
+def test_missing_precursors_are_never_found(tmp_path, edge_spectra, kind):
+    library = libraries(edge_spectra, tmp_path)[kind]
+    unusable = {'nan', 'missing', 'none', 'text'}
+    everything = library.search(0.0, np.finfo(np.float64).max)
+    assert {hit['name'] for hit in everything} == {item['name'] for item in edge_spectra} - unusable - {'inf'}
+    # a NaN or infinite query precursor or a NaN tolerance has no window, an infinite tolerance holds every precursor
+    for precursor, PIMT in [(float('nan'), 1.0), (100.5, float('nan')), (float('inf'), 1.0)]:
+        assert linear_search(edge_spectra, precursor, PIMT) == []
+        assert library.search(precursor, PIMT) == [] and library.search_positions(precursor, PIMT).tolist() == []
+    assert_same_as_linear(library, edge_spectra, 100.5, float('inf'))
+    assert len(library.search(100.5, float('inf'))) == len(everything)
+
+
+@pytest.mark.parametrize('kind', ['indexed', 'compiled'])
+def test_empty_library(tmp_path, kind):
+    library = libraries([], tmp_path)[kind]
+    assert len(library) == 0
+    for precursor, PIMT in [(100.0, 0.5), (float('nan'), 0.5), (0.0, 1e6)]:
+        assert search_library(library, precursor, PIMT) == []
+        positions = search_library_positions(library, precursor, PIMT)
+        assert positions.tolist() == [] and positions.dtype.kind == 'i'
+
+
+@pytest.mark.parametrize('kind', ['indexed', 'compiled'])
+def test_search_matches_linear_scan(tmp_path, kind):
+    # precursors and windows on a coarse grid, so many precursors sit exactly on a window edge
+    rng = np.random.default_rng(7)
+    precursors = np.round(rng.uniform(100.0, 102.0, 400), 2)
+    spectra = [spectrum(str(i), value) for i, value in enumerate(precursors)]
+    for i in rng.choice(len(spectra), 20, replace=False):
+        spectra[i] = spectrum(str(i), float('nan'))
+    library = libraries(spectra, tmp_path)[kind]
+    for precursor in np.round(rng.uniform(99.9, 102.1, 200), 2):
+        for PIMT in (0.0, 0.01, 0.05, 0.1, 0.5, 3.0):
+            assert_same_as_linear(library, spectra, float(precursor), PIMT)
+
+
+def test_plain_list_falls_back_to_the_linear_scan(edge_spectra):
+    # spectra without a usable precursor are skipped by the fallback as well, the old scan raised on them
+    indexed = PrecursorIndexedLibrary(edge_spectra)
+    for precursor, PIMT in [(100.5, 0.5), (100.5, 0.5000001), (0.3, 0.1), (0.0, 1e6), (float('nan'), 1.0)]:
+        assert search_library(edge_spectra, precursor, PIMT) == search_library(indexed, precursor, PIMT)
+        assert (search_library_positions(edge_spectra, precursor, PIMT).tolist()
+                == indexed.search_positions(precursor, PIMT).tolist())
@@ -0,0 +1,57 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from meta_quan_merge import Meta_df_Merge, MergedTable
+from result_writer import read_results
+
+
+def write_samples(folder, n_samples=5, n_rows=60, seed=0):
+    # no rows without a CV: reformat_df labels them NaN or '<m/z>_nan' depending on the pandas version
+    rng = np.random.default_rng(seed)
+    voltages = [-45.3, -60.7, -30.1, 0.1 + 0.2]
+    for number in range(n_samples):
+        pd.DataFrame({'PrecursorMZ': rng.choice([110.3149, 110.3121, 250.4449, 250.455, 512.1], n_rows) + rng.integers(0, 3, n_rows) * 0.001,
+                      'Compensation Voltage': rng.choice(voltages, n_rows),
+                      'Ion_count': rng.uniform(1e3, 1e6, n_rows).round(3),
+                      'Compound': 'x'}).to_csv(os.path.join(folder, f"sample{number}.csv"), index=False)
+
+
+def baseline_merge(merger):
+    # merge_dfs before the long format: reformat_df of every file, concatenated side by side
+    frames = []
+    for label, path in merger.result_files().items():
+        frame = merger.reformat_df(read_results(path))
+        frame.columns = [label]
+        frames.append(frame)
+    return pd.concat(frames, axis=1)
+
+
+def test_rounded_labels_match_reformat_df(tmp_path):
+    write_samples(str(tmp_path))
+    merger = Meta_df_Merge(str(tmp_path))
+    expected = baseline_merge(merger)
+    merged = merger.merge_dfs(workers=1, mz_tolerance=None)
+    assert sorted(merged.index) == sorted(expected.index)
+    pd.testing.assert_frame_equal(merged.sort_index(), expected.sort_index(), check_names=False)
+
+
+def test_label_does_not_depend_on_sample_count(tmp_path):
+    for number in range(3):
+        pd.DataFrame({'PrecursorMZ': [110.3149], 'Compensation Voltage': [-45.3], 'Ion_count': [1e4 + number]}).to_csv(
+            os.path.join(str(tmp_path), f"s{number}.csv"), index=False)
+    for mz_tolerance in (None, 10.0):
+        table = Meta_df_Merge(str(tmp_path)).merge_long(workers=1, mz_tolerance=mz_tolerance)
+        assert table.features['compensation_voltage'].tolist() == [-45.3]
+    assert table.features['label'].tolist() == ['110.3149_-45.3']
+
+
+def test_save_merged_quotes_labels(tmp_path):
+    features = pd.DataFrame({'label': ['110.3_-45.3', 'a,b', 'say "hi"']})
+    values = pd.DataFrame({'feature': [0, 1, 2, 2], 'sample': [0, 1, 0, 1], 'Ion_count': [1.5, 2.0, 3.25, 4.0]})
+    table = MergedTable(features, ['s,1', 's2'], values)
+    merger = Meta_df_Merge(str(tmp_path))
+    merger.save_merged(table, chunk_features=2)
+    saved = pd.read_csv(os.path.join(str(tmp_path), 'merged_output.csv'), index_col='label')
+    pd.testing.assert_frame_equal(saved, merger.to_wide(table))
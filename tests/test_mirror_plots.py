@@ -0,0 +1,109 @@
+import os
+import random
+
+import pytest
+
+import mirror_plots
+import querylibrarymatch
+from mirror_plots import PlotRecord, PlotStream, select_top_hits
+from LibraryHandling import LibraryLoadingStrategy
+from IdentificationMeta import QueryTargetedSpectrum
+from querylibrarymatch import main_processing_function
+
+
+class FakePlotter:
+
+    rendered = []
+
+    def __init__(self, plot_format):
+        pass
+
+    def render(self, record, fig_path):
+        self.rendered.append(record)
+        return os.path.join(fig_path, f"{record.name}_{record.scan}")
+
+
+@pytest.fixture
+def fake_plotter(monkeypatch):
+    FakePlotter.rendered = []
+    monkeypatch.setattr(mirror_plots, 'MirrorPlotter', FakePlotter)
+    return FakePlotter.rendered
+
+
+def random_records(count, seed=0):
+    rng = random.Random(seed)
+    # few compounds and score levels, so ties between records of a compound are common
+    return [PlotRecord(f"compound {rng.randrange(8)}", rng.choice([0.7, 0.8, 0.9, 0.95]), scan, [], [], [], [])
+            for scan in range(count)]
+
+
+@pytest.mark.parametrize('top_n', [1, 2, 5])
+def test_top_n_stream_selects_like_select_top_hits(fake_plotter, top_n):
+    records = random_records(300)
+    with PlotStream('.', top_n=top_n) as stream:
+        for start in range(0, len(records), 7):
+            stream.add(records[start:start + 7])
+        assert fake_plotter == []   # the selection is only known at the end
+    assert fake_plotter == select_top_hits(records, top_n)
+
+
+def test_stream_renders_while_records_arrive(fake_plotter):
+    records = random_records(100)
+    with PlotStream('.', chunksize=16) as stream:
+        stream.add(records[:40])
+        assert fake_plotter == records[:32]   # full chunks are rendered right away, the rest waits for the next ones
+        stream.add(records[40:])
+    assert fake_plotter == records
+    assert len(stream.paths) == 100
+
+
+def test_stream_stops_and_drops_on_error(fake_plotter):
+    records = random_records(100)
+    calls = []
+    with PlotStream('.', chunksize=10, should_stop=lambda: calls.append(1) or len(calls) > 2) as stream:
+        stream.add(records)
+    assert fake_plotter == records[:20]
+    fake_plotter.clear()
+    with pytest.raises(RuntimeError):
+        with PlotStream('.', chunksize=16) as stream:
+            stream.add(records[:10])
+            raise RuntimeError
+    assert fake_plotter == []
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+@pytest.mark.parametrize('top_n', [None, 2])
+def test_identification_streams_the_plots_of_every_match(run_files, tmp_path, workers, top_n):
+    run, library_path = run_files
+    library = LibraryLoadingStrategy(library_path).load_library()
+    result = main_processing_function(0, 120, QueryTargetedSpectrum(run, 3000), library, 0.5, 0.7, 10, 3, str(tmp_path),
+                                      generate_plots=True, workers=workers, plot_top_n=top_n, plot_format='png')
+    hits = [PlotRecord(name, score, scan, [], [], [], [])
+            for name, score, scan in zip(result['Compound'], result['Cosine_score'], result['Scan'])]
+    assert len(hits) == 125
+    expected = {mirror_plots.plot_filename(record, 'png') for record in select_top_hits(hits, top_n)}
+    assert set(os.listdir(tmp_path)) == expected
+
+
+@pytest.mark.parametrize('workers,plot_workers', [(1, 1), (2, 1), (4, 2), (7, 3)])
+def test_plot_renderers_share_the_worker_budget(run_files, tmp_path, monkeypatch, workers, plot_workers):
+    streams = []
+
+    class RecordingStream(PlotStream):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            streams.append(self)
+
+    monkeypatch.setattr(querylibrarymatch, 'PlotStream', RecordingStream)
+    run, library_path = run_files
+    main_processing_function(0, 20, QueryTargetedSpectrum(run, 3000), LibraryLoadingStrategy(library_path).load_library(),
+                             0.5, 0.7, 10, 3, str(tmp_path), generate_plots=True, workers=workers, plot_top_n=1)
+    assert [stream.workers for stream in streams] == [plot_workers]
+
+
+def test_plot_pool_is_not_forked(tmp_path):
+    records = [PlotRecord('compound', 0.9, scan, [100.0], [10.0], [100.0], [5.0]) for scan in range(4)]
+    with PlotStream(str(tmp_path), 'png', workers=2, chunksize=2) as stream:
+        stream.add(records)
+        assert stream._pool._ctx.get_start_method() in ('forkserver', 'spawn')
+    assert len(os.listdir(tmp_path)) == 4
@@ -0,0 +1,106 @@
+import gzip
+
+import numpy as np
+import pytest
+
+from LibraryHandling import LibraryLoadingStrategy
+
+
+def reference_msp(text):
+    '''The line by line parser the block parser replaced, with its documented differences: values keep their case, peak
+    lines keep their first two columns and the NUMERIC_KEYS are converted to numbers.'''
+    spectra, spectrum = [], {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.lower().startswith('name:') and 'mz' in spectrum:
+            spectra.append(spectrum)
+            spectrum = {}
+        if ':' in line:
+            key, value = line.split(':', 1)
+            spectrum[key.strip().lower()] = value.strip()
+        else:
+            mz, intensity = line.split()[:2]
+            spectrum.setdefault('mz', []).append(float(mz))
+            spectrum.setdefault('intensity', []).append(float(intensity))
+    if 'mz' in spectrum:
+        spectra.append(spectrum)
+    for spectrum in spectra:
+        spectrum['mz'], spectrum['intensity'] = np.array(spectrum['mz']), np.array(spectrum['intensity'])
+        for key, convert in LibraryLoadingStrategy.NUMERIC_KEYS.items():
+            if key in spectrum:
+                try:
+                    spectrum[key] = convert(spectrum[key])
+                except ValueError:
+                    pass
+    return spectra
+
+
+FIXTURES = {
+    'plain': "Name: Alanine\nPrecursorMZ: 90.055\nNum Peaks: 2\n44.05 999\n72.04 120\n\n"
+             "Name: Glycine\nPrecursorMZ: 76.039\nNum Peaks: 1\n30.03 1000\n",
+    'mixed_case_keys': "NAME: Caffeine\nPRECURSORMZ: 195.0877\nprecursor_type: [M+H]+\nNUM PEAKS: 2\n138.066 1000\n110.071 85\n\n"
+                       "name: lower\nPrecursorMz: 100\nExactMass: 99.5\n50 5\n",
+    'annotated_peaks': 'Name: Annotated\nPrecursorMZ: 300.1\nNum Peaks: 3\n100.1 50 "b2"\n150.2\t75\t"y1 0.5ppm"\n200.3 10 ?\n\n'
+                       "Name: Next\nPrecursorMZ: 10\n1 2\n",
+    'blank_peak_lines': "Name: Gaps\nPrecursorMZ: 123.4\nNum Peaks: 3\n\n10 1\n\n   \n20 2\n30 3\n\n\n\nName: After\nPrecursorMZ: 1\n5 5\n",
+    'missing_num_peaks': "Name: NoCount\nPrecursorMZ: 55.5\n11 1\n12 2\n\nName: NoCount2\nPrecursorMZ: 66.6\n13 3\n",
+    'numeric_keys': "Name: Typed\nPrecursorMZ: n/a\nExactMass: 180.0634\nNum Peaks: 2\nBase peak mz: 91.5\nBase peak intensity: 100\n"
+                    "Comments: \"SMILES=C(C)O\" \"InChIKey=ABC:DEF\"\n91.5 100\n92.5 50\n",
+    'no_trailing_newline': "  Name: Indented\n  PrecursorMZ: 77.7\n  1 1\n  2 2",
+    'leading_text': "\n\n# header comment: kept as metadata\n\nName: First\nPrecursorMZ: 88.8\n3 3\n",
+}
+
+
+def assert_same_spectra(spectra, expected):
+    assert len(spectra) == len(expected)
+    for spectrum, expected_spectrum in zip(spectra, expected):
+        assert sorted(spectrum) == sorted(expected_spectrum)
+        for key, value in expected_spectrum.items():
+            if key in ('mz', 'intensity'):
+                np.testing.assert_array_equal(spectrum[key], value)
+                assert spectrum[key].dtype == np.float64
+            else:
+                assert spectrum[key] == value and type(spectrum[key]) is type(value), key
+
+
+def write_fixture(tmp_path, text, compressed):
+    if compressed:
+        path = tmp_path / 'lib.msp.gz'
+        with gzip.open(path, 'wt', encoding='utf-8') as file:
+            file.write(text)
+    else:
+        path = tmp_path / 'lib.msp'
+        path.write_text(text, encoding='utf-8')
+    return str(path)
+
+
+@pytest.mark.parametrize('name', sorted(FIXTURES))
+@pytest.mark.parametrize('block_size', [1, 7, 64, LibraryLoadingStrategy.BLOCK_SIZE])
+@pytest.mark.parametrize('compressed', [False, True])
+def test_block_parser_matches_line_parser(tmp_path, monkeypatch, name, block_size, compressed):
+    monkeypatch.setattr(LibraryLoadingStrategy, 'BLOCK_SIZE', block_size)
+    path = write_fixture(tmp_path, FIXTURES[name], compressed)
+    assert_same_spectra(list(LibraryLoadingStrategy(path).iter_msp()), reference_msp(FIXTURES[name]))
+
+
+def test_numeric_keys_are_typed(tmp_path):
+    spectra = list(LibraryLoadingStrategy(write_fixture(tmp_path, FIXTURES['numeric_keys'], False)).iter_msp())
+    assert spectra[0]['precursormz'] == 'n/a'   # left as text when it is not a number
+    assert spectra[0]['exactmass'] == 180.0634 and spectra[0]['num peaks'] == 2
+    assert spectra[0]['base peak intensity'] == 100.0
+    assert spectra[0]['comments'] == '"SMILES=C(C)O" "InChIKey=ABC:DEF"'
+
+
+@pytest.mark.parametrize('block_size', [1, 13, 4096])
+def test_records_straddling_blocks(tmp_path, monkeypatch, block_size):
+    rng = np.random.default_rng(0)
+    records = []
+    for number in range(200):
+        peaks = ''.join(f"{mz:.4f} {intensity}\n" for mz, intensity in zip(rng.uniform(50, 500, number % 7 + 1),
+                                                                            rng.integers(1, 1000, number % 7 + 1)))
+        records.append(f"Name: compound {number}\nPrecursorMZ: {rng.uniform(100, 900):.4f}\nNum Peaks: {number % 7 + 1}\n{peaks}")
+    text = '\n'.join(records)
+    monkeypatch.setattr(LibraryLoadingStrategy, 'BLOCK_SIZE', block_size)
+    assert_same_spectra(list(LibraryLoadingStrategy(write_fixture(tmp_path, text, False)).iter_msp()), reference_msp(text))
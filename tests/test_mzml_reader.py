@@ -0,0 +1,106 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import DATA_DIR
+from IdentificationMeta import QueryTargetedSpectrum
+from mzml_reader import DirectMzMLReader, UnsupportedSpectrum
+
+# written by tests/data/mzml/make_fixtures.py
+FIXTURES = ['indexed.mzML', 'plain.mzML', 'prefixed.mzML', 'prefixed_indexed.mzML']
+
+
+def fixture(name):
+    return os.path.join(DATA_DIR, 'mzml', name)
+
+
+@pytest.mark.parametrize('name', FIXTURES)
+def test_direct_reader_matches_pyteomics(name):
+    direct = QueryTargetedSpectrum(fixture(name), 2000)
+    reference = QueryTargetedSpectrum(fixture(name), 2000, reader='pyteomics')
+    table = reference.get_scan_table()
+    assert len(table) == 6
+    pd.testing.assert_frame_equal(direct.get_scan_table(), table)
+    for scan in range(len(table)):
+        ms_level, precursor, voltage, mz, intensity = direct.read_scan(scan)
+        expected = reference.read_scan(scan)
+        assert ms_level == expected[0]
+        np.testing.assert_array_equal([precursor, voltage], expected[1:3])
+        if expected[3] is None:
+            assert mz is None and intensity is None
+            continue
+        for array, expected_array in ((mz, expected[3]), (intensity, expected[4])):
+            assert array.dtype == expected_array.dtype
+            np.testing.assert_array_equal(array, expected_array)
+        record, expected_record = direct.decode_scan(scan), reference.decode_scan(scan)
+        np.testing.assert_array_equal(record.mz, expected_record.mz)
+        np.testing.assert_array_equal(record.intensity, expected_record.intensity)
+
+
+@pytest.mark.parametrize('name', ['indexed.mzML', 'plain.mzML'])
+def test_direct_reader_finds_every_spectrum(name):
+    reader = DirectMzMLReader(fixture(name))
+    try:
+        assert len(reader) == 6
+        assert reader.header(1) == (2, 300.5, pytest.approx(float('nan'), nan_ok=True))
+        with pytest.raises(UnsupportedSpectrum):   # referenceable parameter groups
+            reader.spectrum(4)
+    finally:
+        reader.close()
+
+
+@pytest.mark.parametrize('name', ['prefixed.mzML', 'prefixed_indexed.mzML'])
+def test_prefixed_file_is_not_read_as_empty(name):
+    with pytest.raises(UnsupportedSpectrum):
+        DirectMzMLReader(fixture(name))
+
+
+def test_empty_file_is_unsupported(tmp_path):
+    path = tmp_path / 'empty.mzML'
+    path.write_bytes(b'')
+    with pytest.raises(UnsupportedSpectrum):
+        DirectMzMLReader(str(path))
+
+
+def open_handles(path):
+    '''File descriptors and memory maps of this process on path.'''
+    path = os.path.realpath(path)
+    fds = [fd for fd in os.listdir('/proc/self/fd') if os.path.realpath(os.path.join('/proc/self/fd', fd)) == path]
+    with open('/proc/self/maps') as maps:
+        mapped = [line for line in maps if line.rstrip().endswith(path)]
+    return len(fds) + len(mapped)
+
+
+needs_proc = pytest.mark.skipif(not os.path.exists('/proc/self/maps'), reason='counts handles through /proc')
+
+
+@needs_proc
+@pytest.mark.parametrize('reader', ['direct', 'pyteomics'])
+@pytest.mark.parametrize('name', ['indexed.mzML', 'prefixed.mzML'])
+def test_close_releases_the_file(name, reader):
+    path = fixture(name)
+    with QueryTargetedSpectrum(path, 2000, reader=reader) as analyzer:
+        analyzer.read_scan(1)
+        analyzer.tmp   # the pyteomics reader the direct one falls back to
+        assert open_handles(path) > 0
+    assert open_handles(path) == 0
+    analyzer.close()   # a second close does nothing
+
+
+@pytest.mark.parametrize('consolidate', [False, True])
+def test_process_file_closes_its_reader(run_files, tmp_path, monkeypatch, consolidate):
+    from LibraryHandling import LibraryLoadingStrategy
+    from querylibrarymatch import process_file
+
+    closed = []
+    close = QueryTargetedSpectrum.close
+    monkeypatch.setattr(QueryTargetedSpectrum, 'close', lambda self: closed.append(self.filepath) or close(self))
+    run, library_path = run_files
+    library = LibraryLoadingStrategy(library_path).load_library()
+    process_file(run, library, 0, 1, 0.5, 0.7, 10, 3, 3000, str(tmp_path), consolidate_scans=consolidate)
+    assert closed == [run]
+    with pytest.raises(ValueError):
+        process_file(run, library, 0, 1, 0.5, 0.7, 10, 3, 3000, str(tmp_path), search_mode='bad')
+    assert closed == [run, run]
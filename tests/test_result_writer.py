@@ -0,0 +1,154 @@
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import result_writer
+from result_writer import ResultWriter, read_results, RESULT_COLUMNS, PEAK_COLUMNS, PEAK_LIST_KEY, RESULT_FORMATS
+
+
+def result_rows(scans, seed=0):
+    # a result_dict chunk with the awkward values: unparsable and missing numbers, empty and 'NA' strings,
+    # CSV quoting, floats that only survive a round-trip parse
+    rng = np.random.default_rng(seed)
+    count = len(scans)
+    rows = {'PrecursorMZ': list(rng.uniform(50, 1000, count)), 'Compensation Voltage': list(rng.uniform(-80, 0, count)),
+            'Cosine_score': list(rng.random(count)), 'Ion_count': list(rng.uniform(1e3, 1e7, count)),
+            'Scan': list(scans), 'Compound': [f'compound "{scan}", isomer' for scan in scans],
+            'CompoundMZ': list(rng.uniform(50, 1000, count)), 'Adduct': ['[M+H]+'] * count,
+            'Formula': ['C6H12O6'] * count, 'Macc_score': list(rng.random(count)),
+            'Matched_peaks': [int(scan % 4) + 1 for scan in scans],
+            PEAK_LIST_KEY: [[(100.0 + peak, 10.0 * peak, 100.0 + peak + 1e-4, 0.1 + 0.2) for peak in range(scan % 4 + 1)]
+                            for scan in scans]}
+    if count:
+        rows['PrecursorMZ'][0] = 'not a number'
+        rows['Compensation Voltage'][0] = ''
+        rows['Adduct'][0] = ''
+        rows['Formula'][0] = 'NA'
+        rows['Compound'][-1] = ''
+    return rows
+
+
+def expected_results(chunks):
+    return pd.concat([result_writer.typed_frame(chunk, RESULT_COLUMNS) for chunk in chunks], ignore_index=True)
+
+
+def expected_peaks(chunks):
+    peaks = [(scan, compound, *peak) for chunk in chunks
+             for scan, compound, scan_peaks in zip(chunk['Scan'], chunk['Compound'], chunk[PEAK_LIST_KEY])
+             for peak in scan_peaks]
+    return result_writer.typed_frame(dict(zip(PEAK_COLUMNS, map(list, zip(*peaks)))) if peaks else {}, PEAK_COLUMNS)
+
+
+def assert_typed_equal(df, expected, dtypes):
+    assert list(df.columns) == list(dtypes)
+    for name, dtype in dtypes.items():
+        if dtype == 'object':
+            assert df[name].tolist() == expected[name].tolist(), name
+        else:
+            assert df[name].dtype == dtype, name
+            np.testing.assert_array_equal(df[name].to_numpy(), expected[name].to_numpy(), err_msg=name)
+
+
+@pytest.mark.parametrize('result_format', RESULT_FORMATS)
+@pytest.mark.parametrize('chunk_rows', [1, 7, 10000])
+def test_round_trip_keeps_values_and_dtypes(tmp_path, result_format, chunk_rows):
+    chunks = [result_rows(range(0, 5)), result_rows([], seed=1), result_rows(range(5, 25), seed=2)]
+    with ResultWriter(str(tmp_path / 'run'), result_format, chunk_rows=chunk_rows) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    assert writer.path == str(tmp_path / f'run.{result_format}')
+    assert writer.rows == 25
+    assert not os.path.exists(tmp_path / f'run_peaks.{result_format}')
+    assert_typed_equal(read_results(writer.path), expected_results(chunks), RESULT_COLUMNS)
+
+
+def test_csv_and_parquet_read_back_the_same(tmp_path):
+    chunks = [result_rows(range(0, 12)), result_rows(range(12, 20), seed=3)]
+    frames = {}
+    for result_format in RESULT_FORMATS:
+        with ResultWriter(str(tmp_path / result_format), result_format, chunk_rows=5) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+        frames[result_format] = read_results(writer.path)
+    pd.testing.assert_frame_equal(frames['csv'], frames['parquet'])
+    assert frames['csv'].loc[0, 'Adduct'] == '' and frames['csv'].loc[0, 'Formula'] == 'NA'
+    assert np.isnan(frames['csv'].loc[0, 'PrecursorMZ']) and np.isnan(frames['csv'].loc[0, 'Compensation Voltage'])
+
+
+@pytest.mark.parametrize('result_format', RESULT_FORMATS)
+def test_read_selected_columns(tmp_path, result_format):
+    chunks = [result_rows(range(0, 10))]
+    with ResultWriter(str(tmp_path / 'run'), result_format) as writer:
+        writer.write(chunks[0])
+    columns = ['Compound', 'Scan', 'Ion_count']
+    df = read_results(writer.path, columns=columns)
+    assert sorted(df.columns) == sorted(columns)
+    assert_typed_equal(df[columns], expected_results(chunks)[columns], {name: RESULT_COLUMNS[name] for name in columns})
+
+
+@pytest.mark.parametrize('result_format', RESULT_FORMATS)
+@pytest.mark.parametrize('chunk_rows', [1, 10000])
+def test_keep_peaks_side_file(tmp_path, result_format, chunk_rows):
+    chunks = [result_rows(range(0, 6)), result_rows(range(6, 15), seed=4)]
+    with ResultWriter(str(tmp_path / 'run'), result_format, keep_peaks=True, chunk_rows=chunk_rows) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    assert writer.peaks_path == str(tmp_path / f'run_peaks.{result_format}')
+    peaks = read_results(writer.peaks_path)
+    assert_typed_equal(peaks, expected_peaks(chunks), PEAK_COLUMNS)
+    assert len(peaks) == sum(sum(chunk['Matched_peaks']) for chunk in chunks)
+    # every peak row belongs to a result row, with the result row's peak count
+    results = read_results(writer.path)
+    counts = peaks.groupby('Scan').size()
+    assert counts.to_dict() == dict(zip(results['Scan'], results['Matched_peaks']))
+
+
+@pytest.mark.parametrize('result_format', RESULT_FORMATS)
+def test_empty_run_writes_headers(tmp_path, result_format):
+    with ResultWriter(str(tmp_path / 'run'), result_format, keep_peaks=True) as writer:
+        writer.write(result_rows([]))
+    assert writer.rows == 0
+    results, peaks = read_results(writer.path), read_results(writer.peaks_path)
+    assert list(results.columns) == list(RESULT_COLUMNS) and results.empty
+    assert list(peaks.columns) == list(PEAK_COLUMNS) and peaks.empty
+    assert results['Scan'].dtype == 'int64' and results['Cosine_score'].dtype == 'float64'
+
+
+def test_unknown_format_is_rejected(tmp_path):
+    with pytest.raises(ValueError, match='Unsupported result format'):
+        ResultWriter(str(tmp_path / 'run'), 'xlsx')
+
+
+def test_excel_row_limit_leaves_room_for_the_header():
+    assert result_writer.EXCEL_MAX_ROWS == 2 ** 20 - 1
+
+
+@pytest.mark.parametrize('result_format', RESULT_FORMATS)
+def test_excel_export_at_the_row_limit(tmp_path, monkeypatch, result_format):
+    monkeypatch.setattr(result_writer, 'EXCEL_MAX_ROWS', 8)
+    chunks = [result_rows(range(0, 8))]
+    writer = ResultWriter(str(tmp_path / 'run'), result_format)
+    writer.write(chunks[0])
+    excel_path = writer.export_excel()
+    assert excel_path == str(tmp_path / 'run.xlsx')
+    df = read_results(excel_path)
+    assert len(df) == 8 and list(df.columns) == list(RESULT_COLUMNS)
+    np.testing.assert_array_equal(df['Scan'].to_numpy(), np.arange(8))
+    np.testing.assert_allclose(df['Cosine_score'].to_numpy(), expected_results(chunks)['Cosine_score'].to_numpy())
+
+
+@pytest.mark.parametrize('result_format', RESULT_FORMATS)
+def test_excel_export_over_the_row_limit_is_skipped(tmp_path, monkeypatch, caplog, result_format):
+    monkeypatch.setattr(result_writer, 'EXCEL_MAX_ROWS', 8)
+    writer = ResultWriter(str(tmp_path / 'run'), result_format, chunk_rows=4)
+    writer.write(result_rows(range(0, 5)))
+    writer.write(result_rows(range(5, 9), seed=1))
+    with caplog.at_level(logging.WARNING):
+        assert writer.export_excel() is None
+    assert not os.path.exists(tmp_path / 'run.xlsx')
+    assert '9 result rows do not fit in an Excel sheet' in caplog.text
+    # the result file itself is complete
+    assert len(read_results(writer.path)) == 9
@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import mzml_reader
+from IdentificationMeta import QueryTargetedSpectrum
+from LibraryHandling import LibraryLoadingStrategy
+from scan_consolidation import group_scans, consensus_spectrum, ConsolidatedSpectra
+from querylibrarymatch import main_processing_function
+
+NAN = float('nan')
+
+
+def test_group_scans():
+    table = pd.DataFrame({'ms_level': [1, 2, 2, 2, 2, 2, 2, 1, 2],
+                          'precursor': [NAN, 100.0, 200.0, 100.0, NAN, 100.0, NAN, NAN, 200.0],
+                          'compensation_voltage': [NAN, -40.0, -40.0, -40.0, NAN, -60.0, NAN, NAN, -40.0]})
+    groups = group_scans(table)
+    assert [group.scans for group in groups] == [[1, 3], [2, 8], [4, 6], [5]]
+    assert (groups[0].precursor, groups[0].compensation_voltage) == (100.0, -40.0)
+    assert np.isnan(groups[2].precursor) and np.isnan(groups[2].compensation_voltage)
+    assert [group.scans for group in group_scans(table, 2, 6)] == [[2], [3], [4], [5]]
+
+
+def test_consensus_of_one_scan_is_unchanged():
+    mz, intensity = np.array([100.0, 200.0]), np.array([5.0, 7.0])
+    result = consensus_spectrum([(mz, intensity)], 10)
+    assert result[0] is mz and result[1] is intensity
+
+
+@pytest.mark.parametrize('unit,tolerance,clusters', [('ppm', 10, 3), ('ppm', 30, 2), ('da', 0.001, 3), ('da', 0.003, 2)])
+def test_consensus_clusters_within_the_tolerance(unit, tolerance, clusters):
+    # 100.000 and 100.002 are 20 ppm (0.002 Da) apart
+    spectra = [(np.array([100.000, 300.0]), np.array([10.0, 4.0])),
+               (np.array([100.002, 300.0]), np.array([30.0, 8.0]))]
+    mz, intensity = consensus_spectrum(spectra, tolerance, unit)
+    assert len(mz) == clusters
+    if clusters == 2:
+        np.testing.assert_allclose(mz, [100.0015, 300.0])   # intensity weighted m/z
+        np.testing.assert_allclose(intensity, [20.0, 6.0])  # summed intensity over the number of scans
+    else:
+        np.testing.assert_allclose(intensity, [5.0, 15.0, 6.0])
+
+
+@pytest.mark.parametrize('min_fraction,expected', [(0.0, [50.0, 100.0, 150.0]), (0.5, [100.0, 150.0]),
+                                                    (0.6, [100.0, 150.0]), (0.67, [100.0]), (1.0, [100.0])])
+def test_consensus_min_fraction(min_fraction, expected):
+    spectra = [(np.array([50.0, 100.0, 150.0]), np.ones(3)), (np.array([100.0, 150.0]), np.ones(2)),
+               (np.array([100.0]), np.ones(1))]
+    mz, _ = consensus_spectrum(spectra, 10, min_fraction=min_fraction)
+    np.testing.assert_allclose(mz, expected)
+
+
+def test_consensus_edge_cases():
+    empty = consensus_spectrum([(np.empty(0), np.empty(0))] * 2, 10)
+    assert len(empty[0]) == len(empty[1]) == 0
+    mz, intensity = consensus_spectrum([(np.array([100.0]), np.array([0.0])), (np.array([100.0004]), np.array([0.0]))], 10)
+    np.testing.assert_allclose(mz, [100.0002])   # no intensity, plain mean m/z
+    with pytest.raises(ValueError):
+        consensus_spectrum([(np.array([1.0]), np.array([1.0]))] * 2, 10, unit='mmu')
+
+
+def test_consolidated_spectra(run_files):
+    run, _ = run_files
+    plain = QueryTargetedSpectrum(run, 3000)
+    consolidated = ConsolidatedSpectra(run, 3000, 10, 'ppm')
+    assert len(consolidated.groups) == 4   # four windows, each with one compensation voltage
+    for group in consolidated.groups:
+        members = [plain.get_scan_record(scan) for scan in group.scans]
+        expected = consensus_spectrum([(record.mz, record.intensity) for record in members], 10, 'ppm')
+        record = consolidated.get_scan_record(group.scans[0])
+        np.testing.assert_array_equal(record.mz, expected[0])
+        np.testing.assert_array_equal(record.intensity, expected[1])
+        assert record.precursor == members[0].precursor
+        for scan in group.scans[1:]:
+            assert consolidated.get_scan_record(scan).ms_level == 0
+    assert consolidated.get_scan_record(0).ms_level == 1   # MS1 scans are not grouped
+
+
+def test_from_reader_does_not_open_the_file_again(run_files, monkeypatch):
+    run, library_path = run_files
+    library = LibraryLoadingStrategy(library_path).load_library()
+    expected = main_processing_function(0, 120, ConsolidatedSpectra(run, 3000, 10, 'ppm', scan_range=(0, 120)), library,
+                                        0.5, 0.7, 10, 3, '.')
+    analyzer = QueryTargetedSpectrum(run, 3000)
+    opened = []
+    monkeypatch.setattr(mzml_reader.DirectMzMLReader, '__init__', lambda self, path: opened.append(path))
+    monkeypatch.setattr(QueryTargetedSpectrum, '_open_pyteomics', lambda self: opened.append(self.filepath))
+    consolidated = ConsolidatedSpectra.from_reader(analyzer, 10, 'ppm', scan_range=(0, 120))
+    assert main_processing_function(0, 120, consolidated, library, 0.5, 0.7, 10, 3, '.') == expected
+    assert opened == []
+    assert len(expected['Scan']) > 0
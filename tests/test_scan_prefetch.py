@@ -0,0 +1,100 @@
+import time
+import threading
+
+import pytest
+
+from IdentificationMeta import ScanPrefetcher, QueryTargetedSpectrum
+from LibraryHandling import LibraryLoadingStrategy
+from querylibrarymatch import main_processing_function, AnalysisCancelled
+
+
+class FakeReader:
+
+    def __init__(self, failing=None):
+        self.decoded = []
+        self.failing = failing
+
+    def decode_scan(self, scan):
+        if scan == self.failing:
+            raise ValueError(f"can not decode {scan}")
+        self.decoded.append(scan)
+        return ('record', scan)
+
+
+def prefetch_threads():
+    return [thread for thread in threading.enumerate() if thread.name == 'scan-prefetch']
+
+
+def wait_for(condition, timeout=5.0):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize('depth', [1, 4, 64])
+def test_take_in_order(depth):
+    reader = FakeReader()
+    prefetcher = ScanPrefetcher(reader, range(20), depth)
+    try:
+        assert [prefetcher.take(scan) for scan in range(20)] == [('record', scan) for scan in range(20)]
+        assert prefetcher.take(20) is None
+    finally:
+        prefetcher.close()
+    assert reader.decoded == list(range(20))
+
+
+def test_out_of_order_scans_fall_back():
+    prefetcher = ScanPrefetcher(FakeReader(), range(10), 4)
+    try:
+        assert prefetcher.take(5) == ('record', 5)   # 0 to 4 are dropped
+        assert prefetcher.take(2) is None            # behind the queue, decoded by the caller
+        assert prefetcher.take(8) == ('record', 8)
+        assert prefetcher.take(7) is None
+        assert prefetcher.take(42) is None           # never prefetched
+        assert prefetcher.take(9) == ('record', 9)
+    finally:
+        prefetcher.close()
+
+
+def test_decode_error_reaches_the_consumer():
+    prefetcher = ScanPrefetcher(FakeReader(failing=3), range(10), 4)
+    try:
+        assert [prefetcher.take(scan) for scan in range(3)] == [('record', scan) for scan in range(3)]
+        with pytest.raises(ValueError, match='can not decode 3'):
+            prefetcher.take(3)
+        assert prefetcher.take(4) is None   # the thread ended, later scans are decoded by the caller
+    finally:
+        prefetcher.close()
+
+
+def test_close_with_a_full_queue_stops_the_thread():
+    reader = FakeReader()
+    prefetcher = ScanPrefetcher(reader, range(1000), 2)
+    wait_for(prefetcher.queue.full)
+    prefetcher.close()
+    assert not prefetcher._thread.is_alive()
+    assert prefetch_threads() == []
+    assert len(reader.decoded) < 10
+
+
+def test_prefetching_gives_the_same_result(run_files):
+    run, library_path = run_files
+    library = LibraryLoadingStrategy(library_path).load_library()
+    results = [main_processing_function(0, 120, QueryTargetedSpectrum(run, 3000), library, 0.5, 0.7, 10, 3, '.',
+                                        prefetch_depth=depth, chunksize=7, progress_callback=lambda done, total: None)
+               for depth in (0, 1, 16)]
+    assert results[0] == results[1] == results[2]
+    assert prefetch_threads() == []
+
+
+def test_cancelling_through_should_stop_stops_the_thread(run_files):
+    run, library_path = run_files
+    analyzer = QueryTargetedSpectrum(run, 3000)
+    checks = []
+    with pytest.raises(AnalysisCancelled):
+        main_processing_function(0, 120, analyzer, LibraryLoadingStrategy(library_path).load_library(), 0.5, 0.7, 10, 3,
+                                 '.', chunksize=10, prefetch_depth=4, should_stop=lambda: checks.append(1) or len(checks) >= 2)
+    assert len(checks) == 2
+    assert analyzer._prefetcher is None
+    assert prefetch_threads() == []
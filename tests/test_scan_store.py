@@ -0,0 +1,48 @@
+import os
+
+import numpy as np
+import pytest
+
+from conftest import DATA_DIR
+from IdentificationMeta import QueryTargetedSpectrum
+from scan_store import ScanStore
+
+
+def assert_same_scans(store, reader):
+    assert len(store) == reader.get_scans()
+    for scan in range(len(store)):
+        stored, expected = store.scan(scan), reader.read_scan(scan)
+        assert stored[0] == expected[0]
+        np.testing.assert_array_equal(stored[1:3], expected[1:3])
+        if expected[3] is None:
+            assert stored[3] is None and stored[4] is None
+            continue
+        for array, expected_array in zip(stored[3:], expected[3:]):
+            assert array.dtype == expected_array.dtype
+            np.testing.assert_array_equal(array, expected_array)
+
+
+@pytest.mark.parametrize('name', ['indexed.mzML', 'prefixed.mzML'])
+def test_store_keeps_the_dtype_of_every_scan(tmp_path, name):
+    # float32, float64 and int32 arrays in one file are stored in their common dtype
+    reader = QueryTargetedSpectrum(os.path.join(DATA_DIR, 'mzml', name), 2000)
+    path = ScanStore.write(str(tmp_path / 'scans.discans'), (reader.read_scan(scan) for scan in range(reader.get_scans())))
+    store = ScanStore(path)
+    assert store.mz.dtype == np.float64 and store.intensity.dtype == np.float64
+    assert_same_scans(store, reader)
+    assert os.listdir(tmp_path) == ['scans.discans']
+
+
+def test_store_of_a_run(tmp_path, run_files):
+    reader = QueryTargetedSpectrum(run_files[0], 3000)
+    store = ScanStore(ScanStore.write(str(tmp_path / 'run.discans'), (reader.read_scan(scan) for scan in range(120))))
+    assert_same_scans(store, reader)
+
+
+def test_failed_conversion_leaves_nothing(tmp_path):
+    def scans():
+        yield 2, 100.0, -30.0, np.arange(5.0), np.ones(5)
+        raise RuntimeError('decoding failed')
+    with pytest.raises(RuntimeError):
+        ScanStore.write(str(tmp_path / 'scans.discans'), scans())
+    assert os.listdir(tmp_path) == []
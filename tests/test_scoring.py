@@ -0,0 +1,149 @@
+'''Randomized equivalence of the vectorized matching and batch scoring with the nested-loop code they replaced.'''
+
+from collections import defaultdict
+
+import numpy as np
+import pytest
+
+import IdentificationMeta
+from IdentificationMeta import QueryTargetedSpectrum, match_spectrum, batch_cosine_similarity, target_arrays, macc_score
+from LibraryHandling import LibraryLoadingStrategy
+from querylibrarymatch import process_scan_range
+from stage_profiler import StageProfiler
+
+
+# the matching and scoring of the original code, kept here as the reference
+def baseline_match_spectrum(query_spectrum, target_spectrum, tolerance, unit='ppm'):
+    matches = []
+    for query_mz, query_intensity, query_label in query_spectrum:
+        for target_mz, target_intensity, target_label in target_spectrum:
+            if unit == 'ppm':
+                within = abs(query_mz - target_mz) <= query_mz * tolerance / 1e6
+            else:
+                within = abs(query_mz - target_mz) <= tolerance
+            if within:
+                matches.append((query_mz, query_intensity, query_label, target_mz, target_intensity, target_label))
+    return matches
+
+
+def baseline_filter_tuples(tuples):
+    max_second_by_fourth = defaultdict(lambda: (None, float('-inf'), None, None))
+    for t in tuples:
+        if t[1] > max_second_by_fourth[t[3]][1]:
+            max_second_by_fourth[t[3]] = t
+    unique_by_first = {}
+    for t in max_second_by_fourth.values():
+        if t[0] not in unique_by_first or unique_by_first[t[0]][1] < t[1]:
+            unique_by_first[t[0]] = t
+    return list(unique_by_first.values())
+
+
+def baseline_cosine_scores(query_spectrum, target_spectrum, tolerance, minmatchedpeaks, unit='ppm'):
+    grouped = {}
+    for match in baseline_match_spectrum(query_spectrum, target_spectrum, tolerance, unit):
+        grouped.setdefault(match[-1], []).append(match)
+    cosine_scores = []
+    for matched_spectrum in grouped.values():
+        filtered_matches = baseline_filter_tuples(matched_spectrum)
+        if len(filtered_matches) >= minmatchedpeaks:
+            q, t = np.array([m[1] for m in filtered_matches]), np.array([m[4] for m in filtered_matches])
+            cosine_scores.append((np.dot(q, t) / (np.linalg.norm(q) * np.linalg.norm(t)), filtered_matches))
+    return cosine_scores
+
+
+def random_scan(rng, candidates):
+    '''A query and the library spectra of its window, on a coarse m/z grid with few intensity levels so that
+    duplicate m/z values, several targets per query peak and intensity ties are common.'''
+    grid = np.round(np.arange(100.0, 101.0, 0.0005), 4)
+    query_mz = rng.choice(grid, size=rng.integers(1, 40))
+    query = [(float(mz), float(rng.choice([1000.0, 2000.0, 5000.0])), 'query') for mz in query_mz]
+    library = []
+    for _ in range(candidates):
+        size = rng.integers(0, 25)
+        mz = np.sort(np.where(rng.random(size) < 0.6, rng.choice(query_mz, size) + rng.choice([0, 0.0005, -0.0005], size),
+                              rng.choice(grid, size)))
+        library.append({'mz': mz, 'intensity': rng.choice([10.0, 20.0, 50.0, 0.5], size)})
+    return query, library
+
+
+def target_tuples(library):
+    '''The target spectrum of QueryTargetedSpectrum.get_target_spectrum.'''
+    target = []
+    for i, spectrum in enumerate(library):
+        target.extend(zip(spectrum['mz'], spectrum['intensity'], [str(i)] * len(spectrum['mz'])))
+    return sorted(target, key=lambda peak: peak[0])
+
+
+def assert_same_scores(scores, expected):
+    assert len(scores) == len(expected)
+    for (score, matches, macc), (expected_score, expected_matches) in zip(scores, expected):
+        assert [tuple(map(str, m)) for m in matches] == [tuple(map(str, m)) for m in expected_matches]
+        np.testing.assert_allclose(score, expected_score, rtol=1e-12)
+        np.testing.assert_allclose(macc, macc_score(len(expected_matches), expected_score), rtol=1e-12)
+
+
+@pytest.mark.parametrize('seed', range(40))
+@pytest.mark.parametrize('unit,tolerance', [('ppm', 10), ('da', 0.0006)])
+def test_match_spectrum_matches_nested_loop(seed, unit, tolerance):
+    rng = np.random.default_rng(seed)
+    query, library = random_scan(rng, rng.integers(1, 12))
+    target = target_tuples(library)
+    assert match_spectrum(query, target, tolerance, unit) == baseline_match_spectrum(query, target, tolerance, unit)
+    shuffled = [target[i] for i in rng.permutation(len(target))]   # unsorted targets keep their order per query peak
+    assert match_spectrum(query, shuffled, tolerance, unit) == baseline_match_spectrum(query, shuffled, tolerance, unit)
+
+
+@pytest.mark.parametrize('seed', range(60))
+@pytest.mark.parametrize('small_window', [0, IdentificationMeta.SMALL_WINDOW, 1000])
+def test_batch_cosine_similarity_matches_group_filter_cosine(monkeypatch, seed, small_window):
+    # 0 and 1000 force the batch and the small window path for every scan
+    monkeypatch.setattr(IdentificationMeta, 'SMALL_WINDOW', small_window)
+    rng = np.random.default_rng(1000 + seed)
+    query, library = random_scan(rng, rng.integers(1, 15))
+    minmatchedpeaks = int(rng.integers(1, 4))
+    unit, tolerance = [('ppm', 10), ('da', 0.0006)][seed % 2]
+    target = target_tuples(library)
+    expected = baseline_cosine_scores(query, target, tolerance, minmatchedpeaks, unit)
+    pair_counts = []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        assert_same_scores(batch_cosine_similarity(query, target, tolerance, minmatchedpeaks, unit, pair_counts), expected)
+        assert_same_scores(batch_cosine_similarity(query, target_arrays(library), tolerance, minmatchedpeaks, unit, pair_counts), expected)
+    assert pair_counts == [len(baseline_match_spectrum(query, target, tolerance, unit))] * 2
+
+
+
+@pytest.mark.parametrize('small_window', [0, 1000])
+def test_zero_intensities_score_nan_on_both_paths(monkeypatch, small_window):
+    monkeypatch.setattr(IdentificationMeta, 'SMALL_WINDOW', small_window)
+    query = [(100.0, 1000.0, 'query'), (100.5, 2000.0, 'query'), (101.0, 500.0, 'query')]
+    library = [{'mz': np.array([100.0, 100.5, 101.0]), 'intensity': np.zeros(3)},
+               {'mz': np.array([100.0, 100.5, 101.0]), 'intensity': np.array([1.0, 2.0, 0.5])}]
+    for target in (target_tuples(library), target_arrays(library)):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = batch_cosine_similarity(query, target, 10, 3)
+        assert np.isnan(scores[0][0]) and np.isnan(scores[0][2])
+        assert scores[1][0] == pytest.approx(1.0)
+
+
+def test_path_follows_the_candidates_with_matched_peaks(monkeypatch):
+    # many candidates in the window, but only the first two share peaks with the query
+    calls = []
+    small_window = IdentificationMeta._small_window_cosine_similarity
+    monkeypatch.setattr(IdentificationMeta, '_small_window_cosine_similarity', lambda *args: calls.append(1) or small_window(*args))
+    query = [(100.0 + 0.1 * i, 1000.0, 'query') for i in range(5)]
+    library = [{'mz': np.array([100.0 + 0.1 * i for i in range(5)]), 'intensity': np.arange(1.0, 6.0)} for _ in range(2)]
+    library += [{'mz': np.array([200.0 + i, 300.0 + i]), 'intensity': np.ones(2)} for i in range(IdentificationMeta.SMALL_WINDOW * 2)]
+    for target in (target_tuples(library), target_arrays(library)):
+        assert len(batch_cosine_similarity(query, target, 10, 3)) == 2
+    assert len(calls) == 2
+
+def test_profiler_counters_cover_the_same_scans(run_files):
+    run, library_path = run_files
+    profiler = StageProfiler()
+    result = process_scan_range(0, 120, QueryTargetedSpectrum(run, 3000), LibraryLoadingStrategy(library_path).load_library(),
+                                0.5, 0.7, 10, 3, None, profiler=profiler)
+    counters = profiler.counters
+    assert len(counters['candidates_per_scan']) == len(counters['matched_pairs_per_scan']) == len(counters['hits_per_scan'])
+    assert sum(counters['hits_per_scan']) == len(result['Scan'])
+    # every pair of a hit is a matched pair, and the pairs of candidates below minmatchedpeaks count as well
+    assert sum(counters['matched_pairs_per_scan']) > sum(result['Matched_peaks'])